@@ -1,2 +1,4 @@
 __version_info__ = (2, 0, 1)
 __version__ = '.'.join([str(v) for v in __version_info__])
+
+default_app_config = 'mama_cas.apps.MamaCasConfig'
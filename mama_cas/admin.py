@@ -0,0 +1,34 @@
+from django.contrib import admin
+from django.utils.translation import ugettext_lazy as _
+
+from mama_cas.models import Service
+from mama_cas.models import SignOutMessage
+
+
+class ServiceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'pattern', 'position', 'enabled', 'proxy_allow', 'logout_allow')
+    list_editable = ('position', 'enabled')
+    list_filter = ('enabled', 'proxy_allow', 'logout_allow')
+    search_fields = ('name', 'pattern')
+    fieldsets = (
+        (None, {'fields': ('name', 'pattern', 'position', 'enabled')}),
+        (_('Proxy authentication'), {'fields': ('proxy_allow', 'proxy_pattern')}),
+        (_('Attributes'), {'fields': ('callbacks', 'attributes')}),
+        (_('Single logout'), {'fields': ('logout_allow', 'logout_url', 'logout_batch')}),
+    )
+
+
+class SignOutMessageAdmin(admin.ModelAdmin):
+    list_display = ('ticket', 'url', 'attempts', 'next_attempt', 'dead')
+    list_filter = ('dead',)
+    search_fields = ('ticket', 'url', 'service')
+    actions = ['requeue']
+
+    def requeue(self, request, queryset):
+        count = SignOutMessage.objects.requeue(queryset)
+        self.message_user(request, _('%d messages were queued to be sent again.') % count)
+    requeue.short_description = _('Send the selected messages again')
+
+
+admin.site.register(Service, ServiceAdmin)
+admin.site.register(SignOutMessage, SignOutMessageAdmin)
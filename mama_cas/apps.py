@@ -0,0 +1,19 @@
+from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save
+from django.utils.translation import ugettext_lazy as _
+
+
+class MamaCasConfig(AppConfig):
+    name = 'mama_cas'
+    verbose_name = _('MamaCAS')
+
+    def ready(self):
+        from mama_cas.callbacks import callback_registry
+        from mama_cas.cas import invalidate_attributes
+        callback_registry.load()
+
+        def user_saved(sender, instance, **kwargs):
+            invalidate_attributes(instance)
+        post_save.connect(user_saved, sender=get_user_model(), weak=False,
+                          dispatch_uid='mama_cas.invalidate_attributes')
@@ -0,0 +1,567 @@
+"""
+Ticket storage backends. ``TicketManager`` delegates storing, looking
+up and consuming tickets to the backend configured by the
+``MAMA_CAS_TICKET_BACKEND`` setting.
+"""
+from __future__ import unicode_literals
+
+import calendar
+from collections import defaultdict
+from datetime import datetime
+import hashlib
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.crypto import salted_hmac
+from django.utils.encoding import force_bytes
+from django.utils.encoding import force_text
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+
+from mama_cas.callbacks import get_deferred_user_fields
+from mama_cas.utils import clean_service_url
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'mama_cas.backends.DatabaseTicketBackend'
+
+SIGNED_TICKET_RE = re.compile(r'^[A-Z]{2,3}-[0-9]{10,}-[0-9]+-[01]-[a-zA-Z0-9-]+-[0-9a-f]{16}-[0-9a-f]{40}$')
+
+_backends = {}
+
+
+def get_backend(model):
+    """
+    Return the ticket backend instance for a ``Ticket`` model, as
+    configured by ``MAMA_CAS_TICKET_BACKEND``.
+    """
+    path = getattr(settings, 'MAMA_CAS_TICKET_BACKEND', DEFAULT_BACKEND)
+    try:
+        return _backends[(path, model)]
+    except KeyError:
+        backend = _backends[(path, model)] = import_string(path)(model)
+        return backend
+
+
+def get_protected_lookups(model, prefix='', seen=None):
+    """
+    Return the lookups that find rows of ``model`` which cannot be
+    deleted, because a ``PROTECT`` foreign key references them either
+    directly or through rows that would be deleted in cascade.
+    """
+    seen = seen or set([model])
+    lookups = []
+    for rel in model._meta.related_objects:
+        if rel.on_delete is models.PROTECT:
+            lookups.append(prefix + rel.name)
+        elif rel.on_delete is models.CASCADE and rel.related_model not in seen:
+            lookups.extend(get_protected_lookups(rel.related_model, prefix + rel.name + '__',
+                                                 seen | set([rel.related_model])))
+    return lookups
+
+
+def get_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def to_timestamp(value):
+    """Convert a datetime to an integer Unix timestamp."""
+    if timezone.is_aware(value):
+        return calendar.timegm(value.utctimetuple())
+    return int(time.mktime(value.timetuple()))
+
+
+def to_microseconds(value):
+    """Convert a datetime to an integer Unix timestamp in microseconds."""
+    return to_timestamp(value) * 1000000 + value.microsecond
+
+
+def from_timestamp(value):
+    """Convert a Unix timestamp to a datetime."""
+    if settings.USE_TZ:
+        return datetime.fromtimestamp(value, timezone.utc)
+    return datetime.fromtimestamp(value)
+
+
+class TicketBackend(object):
+    """
+    Base class for ticket storage backends. A backend instance is
+    created for each ``Ticket`` model.
+    """
+    def __init__(self, model):
+        self.model = model
+
+    def create(self, **kwargs):
+        """Store and return a new ``Ticket``."""
+        raise NotImplementedError
+
+    def is_valid_format(self, ticket):
+        """
+        Check that a ticket string has the format of the tickets
+        created by this backend.
+        """
+        return bool(self.model.TICKET_RE.match(ticket))
+
+    def get_issued(self, ticket):
+        """
+        Return the issue time embedded in a ticket string as a Unix
+        timestamp, or ``None`` if it cannot be parsed.
+        """
+        try:
+            return int(ticket.split('-')[1])
+        except (IndexError, ValueError):
+            return None
+
+    def get(self, ticket, service=None):
+        """
+        Return the ``Ticket`` for the given ticket string. If it does
+        not exist, raise the model's ``DoesNotExist`` exception. The
+        service being validated is provided for backends that do not
+        store the ticket's service URL.
+        """
+        raise NotImplementedError
+
+    def consume(self, ticket):
+        """
+        Consume a ``Ticket``. Return ``True`` if the ticket was consumed
+        by this call, and ``False`` if it was already consumed.
+        """
+        raise NotImplementedError
+
+    def consume_tickets(self, users):
+        """
+        Consume all valid ``Ticket``s for the specified users, given as
+        user instances or primary keys.
+        """
+        raise NotImplementedError
+
+    def get_consumed_tickets(self, user, since):
+        """
+        Return the ``Ticket``s for the specified user that were consumed
+        at or after ``since``.
+        """
+        raise NotImplementedError
+
+    def delete_invalid_tickets(self, batch_size=1000, deadline=None, dry_run=False):
+        """
+        Delete consumed or expired ``Ticket``s in batches of
+        ``batch_size``, stopping once the ``deadline`` timestamp has
+        passed. Return a dictionary mapping model labels to the number
+        of rows deleted. If ``dry_run`` is ``True``, count the invalid
+        tickets that are not referenced by other tickets instead, without
+        the rows that would be deleted in cascade.
+        """
+        raise NotImplementedError
+
+
+class DatabaseTicketBackend(TicketBackend):
+    """
+    Store tickets in the database using the ``Ticket`` models. This is
+    the default backend.
+    """
+    @property
+    def manager(self):
+        return self.model._default_manager
+
+    def create(self, **kwargs):
+        return self.manager.create(**kwargs)
+
+    def get(self, ticket, service=None):
+        queryset = self.manager.select_related('user')
+        if service:
+            # Skip loading user fields not needed for the service
+            deferred = get_deferred_user_fields(service, get_user_model())
+            if deferred:
+                queryset = queryset.defer(*['user__%s' % name for name in deferred])
+        return queryset.get(ticket=ticket)
+
+    def consume(self, ticket):
+        """
+        Consume a ``Ticket`` with a single conditional ``UPDATE``, so
+        concurrent attempts to consume the same ticket cannot both
+        succeed.
+        """
+        consumed = now()
+        if self.manager.filter(pk=ticket.pk, consumed__isnull=True).update(consumed=consumed):
+            ticket.consumed = consumed
+            return True
+        ticket.consumed = self.manager.filter(pk=ticket.pk).values_list('consumed', flat=True).first()
+        if ticket.consumed is None:
+            # The ticket was deleted after the update, so it is invalid
+            ticket.consumed = consumed
+        return False
+
+    def consume_tickets(self, users):
+        self.manager.filter(user__in=users, consumed__isnull=True,
+                            expires__gt=now()).update(consumed=now())
+
+    def get_consumed_tickets(self, user, since):
+        return self.manager.filter(user=user, consumed__gte=since)
+
+    def delete_invalid_tickets(self, batch_size=1000, deadline=None, dry_run=False):
+        """
+        Delete invalid tickets with bulk ``DELETE`` statements. Rows
+        that are protected by other tickets are excluded in the query
+        rather than failing the delete, and each batch is selected again
+        so chains of tickets are deleted from the end inwards.
+        """
+        invalid = self.manager.filter(Q(consumed__isnull=False) | Q(expires__lte=now()))
+        for lookup in get_protected_lookups(self.model):
+            invalid = invalid.exclude(**{lookup + '__isnull': False})
+
+        if dry_run:
+            return {get_label(self.model): invalid.count()}
+
+        deleted = defaultdict(int)
+        skipped = []
+        while deadline is None or time.time() < deadline:
+            pks = list(invalid.exclude(pk__in=skipped).order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            try:
+                result = self.manager.filter(pk__in=pks).delete()
+            except models.ProtectedError:
+                # A new reference was created after the batch was
+                # selected, so fall back to deleting row by row
+                result = self.delete_tickets(pks, skipped)
+            if result is None:  # Django 1.8 does not return counts
+                result = (len(pks), {get_label(self.model): len(pks)})
+            for label, count in result[1].items():
+                deleted[label] += count
+        return dict(deleted)
+
+    def delete_tickets(self, pks, skipped):
+        """
+        Delete tickets one at a time, adding the primary keys of
+        protected tickets to ``skipped``.
+        """
+        deleted = defaultdict(int)
+        for ticket in self.manager.filter(pk__in=pks):
+            try:
+                result = ticket.delete()
+            except models.ProtectedError:
+                skipped.append(ticket.pk)
+            else:
+                if result is None:
+                    result = (1, {get_label(self.model): 1})
+                for label, count in result[1].items():
+                    deleted[label] += count
+        return sum(deleted.values()), deleted
+
+
+class CacheTicketBackend(TicketBackend):
+    """
+    Store tickets in the Django cache configured by
+    ``MAMA_CAS_TICKET_CACHE``. Tickets are never written to the
+    database and expire from the cache along with the ticket itself.
+
+    Consumption is atomic, as the consumed marker for a ticket is
+    written with ``cache.add()``. Consumed tickets are kept for
+    ``SESSION_COOKIE_AGE`` seconds, so single logout requests can be
+    sent for them when the user logs out.
+
+    Each user has an index of their ticket strings, so tickets can be
+    found at logout. Every index entry is stored under its own key,
+    numbered by atomically incrementing a counter, so concurrent logins
+    never overwrite each other's entries. Counters are versioned by
+    ``SESSION_COOKIE_AGE`` periods, and outlive the entries they count.
+    Index entries outlive the tickets they point to, and every period
+    that can still hold a live entry is read at logout. If a counter is
+    evicted, it is started again and entries are added to the first
+    free numbers, so existing entries are never overwritten.
+    """
+    key_prefix = 'mama_cas'
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'MAMA_CAS_TICKET_CACHE', 'default')]
+
+    def make_key(self, ticket):
+        return '%s:%s' % (self.key_prefix, ticket)
+
+    def make_consumed_key(self, ticket):
+        return '%s:%s:consumed' % (self.key_prefix, ticket)
+
+    def make_index_key(self, user, version):
+        return '%s:%s:%s:%d' % (self.key_prefix, self.model._meta.model_name,
+                                getattr(user, 'pk', user), version)
+
+    def get_timeout(self, ticket):
+        """Return the number of seconds until a ``Ticket`` expires."""
+        remaining = (ticket.expires - now()).total_seconds()
+        return max(int(remaining) + 1, 1)
+
+    def get_record_timeout(self, ticket):
+        """
+        Return the number of seconds to keep a consumed ``Ticket``,
+        which is the lifetime of the user's session.
+        """
+        return max(settings.SESSION_COOKIE_AGE, self.get_timeout(ticket))
+
+    def get_index_timeout(self):
+        """
+        Return the number of seconds to keep an index entry, which is
+        longer than any ``Ticket`` is kept.
+        """
+        return max(settings.SESSION_COOKIE_AGE, self.model.TICKET_EXPIRE) + 1
+
+    def incr_index(self, key, timeout):
+        """
+        Increment an index counter and return the new count, or
+        ``None`` if the counter cannot be incremented. If the counter
+        does not exist, it is created first.
+        """
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # The counter was evicted or expired after it was added
+            self.cache.add(key, 0, timeout)
+            try:
+                return self.cache.incr(key)
+            except ValueError:
+                return None
+
+    def add_user_ticket(self, ticket, attempts=100):
+        """Add a ``Ticket`` to the index of its user's tickets."""
+        age = settings.SESSION_COOKIE_AGE
+        timeout = self.get_index_timeout()
+        key = self.make_index_key(ticket.user, int(time.time()) // age)
+        # Entries are added for one period and kept for one more, so
+        # the counter must live for both
+        self.cache.add(key, 0, age + timeout)
+        for _ in range(attempts):
+            count = self.incr_index(key, age + timeout)
+            if count is None:
+                break
+            # If the counter was started again, skip the numbers that
+            # already have entries rather than overwriting them
+            if self.cache.add('%s:%d' % (key, count), ticket.ticket, timeout):
+                return
+        logger.warning("Could not add %s to the index of %s's tickets" %
+                       (ticket.ticket, ticket.user))
+
+    def get_user_ticket_strs(self, user):
+        """Return the indexed ticket strings for the specified user."""
+        age = settings.SESSION_COOKIE_AGE
+        current = int(time.time())
+        first = (current - self.get_index_timeout()) // age
+        index_keys = [self.make_index_key(user, v) for v in range(first, current // age + 1)]
+        counts = self.cache.get_many(index_keys)
+        keys = ['%s:%d' % (key, n) for key in index_keys
+                for n in range(1, counts.get(key, 0) + 1)]
+        if not keys:
+            return []
+        values = self.cache.get_many(keys)
+        return [values[key] for key in keys if key in values]
+
+    def create(self, **kwargs):
+        t = self.model(**kwargs)
+        timeout = self.get_timeout(t)
+        self.cache.set(self.make_key(t.ticket), t, timeout)
+        if t.consumed:
+            self.cache.add(self.make_consumed_key(t.ticket), t.consumed, self.get_record_timeout(t))
+        self.add_user_ticket(t)
+        return t
+
+    def get(self, ticket, service=None):
+        key = self.make_key(ticket)
+        consumed_key = self.make_consumed_key(ticket)
+        values = self.cache.get_many([key, consumed_key])
+        try:
+            t = values[key]
+        except KeyError:
+            raise self.model.DoesNotExist("%s %s does not exist" %
+                                          (self.model._meta.verbose_name, ticket))
+        t.consumed = values.get(consumed_key)
+        return t
+
+    def consume(self, ticket):
+        consumed = now()
+        key = self.make_consumed_key(ticket.ticket)
+        timeout = self.get_record_timeout(ticket)
+        if self.cache.add(key, consumed, timeout):
+            ticket.consumed = consumed
+            # Keep consumed tickets for sending single logout requests
+            self.cache.set(self.make_key(ticket.ticket), ticket, timeout)
+            return True
+        ticket.consumed = self.cache.get(key, consumed)
+        return False
+
+    def get_user_tickets(self, user):
+        """Return all stored ``Ticket``s for the specified user."""
+        tickets = self.get_user_ticket_strs(user)
+        if not tickets:
+            return []
+        keys = [self.make_key(t) for t in tickets]
+        keys.extend([self.make_consumed_key(t) for t in tickets])
+        values = self.cache.get_many(keys)
+
+        user_tickets = []
+        for ticket in tickets:
+            t = values.get(self.make_key(ticket))
+            if t is not None:
+                t.consumed = values.get(self.make_consumed_key(ticket))
+                user_tickets.append(t)
+        return user_tickets
+
+    def consume_tickets(self, users):
+        for user in users:
+            for ticket in self.get_user_tickets(user):
+                if ticket.consumed is None and not ticket.is_expired():
+                    self.consume(ticket)
+
+    def get_consumed_tickets(self, user, since):
+        return [t for t in self.get_user_tickets(user)
+                if t.consumed is not None and t.consumed >= since]
+
+    def delete_invalid_tickets(self, batch_size=1000, deadline=None, dry_run=False):
+        # Tickets are removed by the cache as they expire
+        return {}
+
+
+class SignedTicketBackend(CacheTicketBackend):
+    """
+    Issue self-describing service tickets signed with ``SECRET_KEY``,
+    so no storage is needed until a ticket is validated. A signed
+    ticket encodes the time it was issued in microseconds, its expiry,
+    the primary credentials flag, the user's primary key and a digest
+    of the service URL:
+
+    ST-<issued>-<expires>-<primary>-<user>-<service digest>-<signature>
+
+    One-time use is enforced by a consumed marker in the cache, keyed
+    by the ticket signature. Logging out records a revocation time for
+    the user, which invalidates all tickets issued before that time.
+    Ticket types other than service tickets are stored as with
+    ``CacheTicketBackend``.
+    """
+    signed_prefixes = ('ST',)
+    salt = 'mama_cas.backends.SignedTicketBackend'
+    user_re = re.compile(r'^[a-zA-Z0-9-]+$')
+
+    @property
+    def signed(self):
+        return self.model.TICKET_PREFIX in self.signed_prefixes
+
+    def get_service_digest(self, service):
+        service = clean_service_url(service) if service else ''
+        return hashlib.sha256(force_bytes(service)).hexdigest()[:16]
+
+    def get_signature(self, value):
+        return salted_hmac(self.salt, value).hexdigest()
+
+    def sign(self, ticket):
+        """Return a signed ticket string for an unsaved ``Ticket``."""
+        user = force_text(ticket.user.pk)
+        if not self.user_re.match(user):
+            raise ValueError("User primary key %s cannot be encoded in a ticket" % user)
+        value = '-'.join([self.model.TICKET_PREFIX,
+                          '%d' % (time.time() * 1000000),
+                          '%d' % to_timestamp(ticket.expires),
+                          '1' if getattr(ticket, 'primary', False) else '0',
+                          user,
+                          self.get_service_digest(ticket.service)])
+        return '%s-%s' % (value, self.get_signature(value))
+
+    def unsign(self, ticket):
+        """
+        Verify a signed ticket string and return its fields. If the
+        signature is invalid, raise the model's ``DoesNotExist``
+        exception.
+        """
+        value, _, signature = ticket.rpartition('-')
+        if not constant_time_compare(signature, self.get_signature(value)):
+            raise self.model.DoesNotExist("%s %s has an invalid signature" %
+                                          (self.model._meta.verbose_name, ticket))
+        parts = value.split('-')
+        return {'issued': int(parts[1]),
+                'expires': int(parts[2]),
+                'primary': parts[3] == '1',
+                'user': '-'.join(parts[4:-1]),
+                'service_digest': parts[-1]}
+
+    def is_valid_format(self, ticket):
+        if not self.signed:
+            return super(SignedTicketBackend, self).is_valid_format(ticket)
+        return bool(SIGNED_TICKET_RE.match(ticket))
+
+    def get_issued(self, ticket):
+        issued = super(SignedTicketBackend, self).get_issued(ticket)
+        if issued is not None and self.signed:
+            issued //= 1000000
+        return issued
+
+    def make_consumed_key(self, ticket):
+        if not self.signed:
+            return super(SignedTicketBackend, self).make_consumed_key(ticket)
+        return '%s:%s:consumed' % (self.key_prefix, ticket.rpartition('-')[2])
+
+    def make_revoked_key(self, user):
+        return '%s:%s:%s:revoked' % (self.key_prefix, self.model._meta.model_name,
+                                     getattr(user, 'pk', user))
+
+    def create(self, **kwargs):
+        if not self.signed:
+            return super(SignedTicketBackend, self).create(**kwargs)
+        t = self.model(**kwargs)
+        t.ticket = self.sign(t)
+        if t.consumed:
+            self.cache.add(self.make_consumed_key(t.ticket), t.consumed, self.get_timeout(t))
+        return t
+
+    def get(self, ticket, service=None):
+        if not self.signed:
+            return super(SignedTicketBackend, self).get(ticket, service)
+        fields = self.unsign(ticket)
+        user_model = get_user_model()
+        users = user_model._default_manager.all()
+        if service:
+            users = users.defer(*get_deferred_user_fields(service, user_model))
+        try:
+            user = users.get(pk=fields['user'])
+        except (user_model.DoesNotExist, ValueError):
+            raise self.model.DoesNotExist("User for %s %s does not exist" %
+                                          (self.model._meta.verbose_name, ticket))
+
+        # The service URL is not part of the ticket, so the provided
+        # service is used if it matches the signed service digest
+        if self.get_service_digest(service) == fields['service_digest']:
+            service = clean_service_url(service)
+        else:
+            service = ''
+        t = self.model(ticket=ticket, user=user, service=service,
+                       primary=fields['primary'],
+                       expires=from_timestamp(fields['expires']))
+
+        consumed_key = self.make_consumed_key(ticket)
+        revoked_key = self.make_revoked_key(user)
+        values = self.cache.get_many([consumed_key, revoked_key])
+        t.consumed = values.get(consumed_key)
+        revoked = values.get(revoked_key)
+        if t.consumed is None and revoked is not None and fields['issued'] < to_microseconds(revoked):
+            t.consumed = revoked
+        return t
+
+    def consume(self, ticket):
+        consumed = super(SignedTicketBackend, self).consume(ticket)
+        if consumed and self.signed:
+            # Signed tickets are only indexed once they are consumed
+            self.add_user_ticket(ticket)
+        return consumed
+
+    def consume_tickets(self, users):
+        if not self.signed:
+            return super(SignedTicketBackend, self).consume_tickets(users)
+        revoked = now()
+        self.cache.set_many(dict((self.make_revoked_key(user), revoked) for user in users),
+                            self.model.TICKET_EXPIRE)
@@ -0,0 +1,214 @@
+"""
+A time-rotated Bloom filter of recently issued ticket strings. The
+filter is stored in a memory-mapped file, so it is shared by every
+server process on a host. It allows validation to reject tickets that
+were never issued without looking them up.
+
+The file holds a number of generations, each covering a fixed interval
+of ticket issue times. A ticket is added to the generation matching the
+issue time embedded in its ticket string, and the slot of the oldest
+generation is cleared and reused as time moves on. Lookups for tickets
+outside the retained generations are inconclusive.
+"""
+from __future__ import division
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_bytes
+
+from mama_cas import stats
+from mama_cas.compat import fcntl
+
+
+_filters = {}
+
+
+def get_ticket_filter():
+    """
+    Return the ``TicketFilter`` configured by ``MAMA_CAS_TICKET_FILTER``,
+    or ``None`` if the filter is not enabled.
+
+    The filter only holds tickets issued on this host, so it must also
+    be enabled with ``MAMA_CAS_TICKET_FILTER_SINGLE_HOST``.
+    """
+    path = getattr(settings, 'MAMA_CAS_TICKET_FILTER', None)
+    if not path:
+        return None
+    if not getattr(settings, 'MAMA_CAS_TICKET_FILTER_SINGLE_HOST', False):
+        raise ImproperlyConfigured(
+            'MAMA_CAS_TICKET_FILTER only holds tickets issued on this host. Set '
+            'MAMA_CAS_TICKET_FILTER_SINGLE_HOST if tickets are always validated '
+            'on the host that issued them.')
+    config = (path,
+              getattr(settings, 'MAMA_CAS_TICKET_FILTER_CAPACITY', 100000),
+              getattr(settings, 'MAMA_CAS_TICKET_FILTER_ERROR_RATE', 0.01),
+              getattr(settings, 'MAMA_CAS_TICKET_FILTER_INTERVAL', 600))
+    try:
+        return _filters[config]
+    except KeyError:
+        ticket_filter = _filters[config] = TicketFilter(*config)
+        return ticket_filter
+
+
+class TicketFilter(object):
+    """
+    A Bloom filter of ticket strings, split into generations by issue
+    time and stored in a shared memory-mapped file.
+
+    Each bit is stored in its own byte, so processes setting bits
+    concurrently cannot overwrite each other's writes. Reusing a
+    generation slot is serialized with a file lock.
+    """
+    magic = b'MAMACASF'
+    generations = 3
+    # Magic, bits, hashes, generations and interval
+    file_header = struct.Struct('<8sQIIQ')
+    # Generation number and creation time
+    slot_header = struct.Struct('<qd')
+
+    def __init__(self, path, capacity, error_rate, interval):
+        if fcntl is None:  # pragma: no cover
+            raise ImproperlyConfigured('MAMA_CAS_TICKET_FILTER requires fcntl file locking')
+        self.path = path
+        self.interval = int(interval)
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(int(round(self.bits / capacity * math.log(2))), 1)
+        self.slot_size = self.slot_header.size + self.bits
+        self.size = self.file_header.size + self.generations * self.slot_size
+        self.open()
+
+    def open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                header = self.file_header.pack(self.magic, self.bits, self.hashes,
+                                               self.generations, self.interval)
+                size = os.fstat(fd).st_size
+                if size:
+                    # Other processes may have the file mapped, so a file
+                    # created with different settings is never changed
+                    if size != self.size or os.read(fd, len(header)) != header:
+                        raise ImproperlyConfigured(
+                            'Ticket filter %s was created with different settings. '
+                            'Remove it or use another path.' % self.path)
+                else:
+                    # Initialize a new file
+                    os.ftruncate(fd, self.size)
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, header)
+                    for slot in range(self.generations):
+                        os.lseek(fd, self.get_slot_offset(slot), os.SEEK_SET)
+                        os.write(fd, self.slot_header.pack(-1, 0))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def get_slot_offset(self, slot):
+        return self.file_header.size + slot * self.slot_size
+
+    def read_slot_header(self, offset):
+        return self.slot_header.unpack_from(self.map, offset)
+
+    def get_positions(self, ticket):
+        digest = hashlib.md5(force_bytes(ticket)).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def get_slot(self, generation, create=False):
+        """
+        Return the offset of the slot holding the given generation, or
+        ``None`` if it is not retained. If ``create`` is ``True``, reuse
+        the slot of an older generation if necessary.
+        """
+        offset = self.get_slot_offset(generation % self.generations)
+        current = self.read_slot_header(offset)[0]
+        if current == generation:
+            return offset
+        if not create or current > generation:
+            return None
+
+        with open(self.path, 'rb') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                if self.read_slot_header(offset)[0] < generation:
+                    # Invalidate the slot before clearing it, so lookups
+                    # in progress treat it as inconclusive
+                    self.slot_header.pack_into(self.map, offset, -1, 0)
+                    start = offset + self.slot_header.size
+                    self.map[start:start + self.bits] = b'\x00' * self.bits
+                    self.slot_header.pack_into(self.map, offset, generation, time.time())
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return offset
+
+    def add(self, ticket, issued):
+        """Add a ticket string issued at the given timestamp."""
+        offset = self.get_slot(issued // self.interval, create=True)
+        if offset is None:
+            return
+        start = offset + self.slot_header.size
+        for position in self.get_positions(ticket):
+            self.map[start + position:start + position + 1] = b'\x01'
+
+    def lookup(self, ticket, issued):
+        """
+        Check for a ticket string issued at the given timestamp. Return
+        ``False`` if the ticket was definitely not issued, ``True`` if it
+        may have been issued, or ``None`` if the filter does not cover
+        the issue time.
+        """
+        generation = issued // self.interval
+        offset = self.get_slot(generation)
+        if offset is None:
+            return None
+        created = self.read_slot_header(offset)[1]
+        if issued <= int(created):
+            # Tickets issued before the generation was created may not
+            # have been added
+            return None
+
+        start = offset + self.slot_header.size
+        found = all(self.map[start + p:start + p + 1] != b'\x00'
+                    for p in self.get_positions(ticket))
+        if self.read_slot_header(offset) != (generation, created):
+            # The slot was reused during the lookup
+            return None
+        return found
+
+    def get_stats(self):
+        """
+        Return the memory footprint of the filter, the estimated false
+        positive rate of each retained generation and the observed false
+        positive rate.
+        """
+        generations = []
+        for slot in range(self.generations):
+            offset = self.get_slot_offset(slot)
+            generation, created = self.read_slot_header(offset)
+            if generation < 0:
+                continue
+            start = offset + self.slot_header.size
+            fill = (self.bits - self.map[start:start + self.bits].count(b'\x00')) / self.bits
+            generations.append({'generation': generation,
+                                'created': created,
+                                'fill_ratio': fill,
+                                'false_positive_rate': fill ** self.hashes})
+
+        rejected = stats.get('tickets.filter_rejected')
+        false_positives = stats.get('tickets.filter_false_positives')
+        observed = false_positives / (rejected + false_positives) if rejected + false_positives else 0.0
+        return {'size': self.size,
+                'bits': self.bits,
+                'hashes': self.hashes,
+                'generations': sorted(generations, key=lambda g: g['generation']),
+                'observed_false_positive_rate': observed}
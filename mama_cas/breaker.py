@@ -0,0 +1,282 @@
+"""
+Circuit breakers for the endpoints single logout requests are sent to.
+An endpoint is a logout URL, so a broken logout URL does not affect
+other services on the same host. The state of each endpoint is kept in
+the cache configured by ``MAMA_CAS_SLO_BREAKER_CACHE``, so every server
+process and worker shares it. At most ``MAMA_CAS_SLO_BREAKER_ENDPOINTS``
+endpoints are tracked, and requests to other endpoints are sent without
+a circuit breaker. Endpoints without requests for ten reset periods are
+forgotten.
+
+An endpoint's circuit opens after ``MAMA_CAS_SLO_BREAKER_THRESHOLD``
+consecutive failures, and requests to it are skipped. Only connection
+errors, timeouts and server errors count as failures, as an endpoint
+returning a client error is still available. After
+``MAMA_CAS_SLO_BREAKER_RESET`` seconds the circuit is half-open, and a
+single trial request is allowed. The circuit closes if the trial
+succeeds, and opens again if it fails.
+
+The consecutive failures are counted with ``cache.incr()`` and the
+circuit is opened with ``cache.add()``, so concurrent requests from
+several processes are all counted, and only the trial request closes an
+open circuit. The totals of requests, failures and latency shown by the
+``slohealthcas`` management command are updated from the record read to
+allow a request, so they are approximate when requests overlap.
+"""
+from __future__ import division
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.encoding import force_bytes
+
+import requests
+
+from mama_cas import stats
+from mama_cas.client import get_timeout
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """A request was not sent because the endpoint's circuit is open."""
+
+
+def get_cache():
+    return caches[getattr(settings, 'MAMA_CAS_SLO_BREAKER_CACHE', 'default')]
+
+
+class CircuitBreaker(object):
+    """The circuit breaker and health record for an endpoint."""
+    key_prefix = 'mama_cas:breaker'
+    endpoints_key = 'mama_cas:breaker:endpoints'
+
+    def __init__(self, url):
+        self.url = url
+        digest = hashlib.md5(force_bytes(url)).hexdigest()
+        self.key = '%s:%s' % (self.key_prefix, digest)
+        self.failures_key = '%s:failures' % self.key
+        self.opened_key = '%s:opened' % self.key
+        self.trial_key = '%s:trial' % self.key
+        self.values = None
+        self.trial = False
+
+    @property
+    def threshold(self):
+        return getattr(settings, 'MAMA_CAS_SLO_BREAKER_THRESHOLD', 5)
+
+    @property
+    def reset_timeout(self):
+        return getattr(settings, 'MAMA_CAS_SLO_BREAKER_RESET', 60)
+
+    @property
+    def max_endpoints(self):
+        return getattr(settings, 'MAMA_CAS_SLO_BREAKER_ENDPOINTS', 1000)
+
+    @property
+    def record_timeout(self):
+        """The number of seconds an unused health record is kept."""
+        return max(self.reset_timeout, 60) * 10
+
+    @property
+    def trial_timeout(self):
+        """A trial request is claimed until its request has timed out."""
+        return sum(get_timeout()) + 1
+
+    def read(self):
+        """
+        Return the health record of the endpoint, the number of
+        consecutive failures and the time the circuit opened, read in a
+        single cache request. The health record holds the totals of
+        requests, failures and latency, and is ``None`` if the endpoint
+        is not tracked.
+        """
+        values = get_cache().get_many([self.key, self.failures_key, self.opened_key])
+        return (values.get(self.key), values.get(self.failures_key, 0),
+                values.get(self.opened_key))
+
+    def make_record(self):
+        """Return a new health record for the endpoint."""
+        return {'url': self.url, 'requests': 0, 'failures': 0, 'latency': 0.0, 'indexed': 0}
+
+    def track(self, record):
+        """
+        Add the endpoint to the index, refreshing the index before it
+        expires and dropping endpoints whose records have expired.
+        Return ``False`` if the endpoint is not tracked, as the maximum
+        number of endpoints are tracked already.
+        """
+        current = time.time()
+        if record.get('indexed', 0) >= current - self.record_timeout:
+            return True
+        endpoints = set(get_endpoints())
+        if self.url not in endpoints and len(endpoints) >= self.max_endpoints:
+            stats.incr('slo.circuit_untracked')
+            return False
+        endpoints.add(self.url)
+        get_cache().set(self.endpoints_key, endpoints, 2 * self.record_timeout)
+        record['indexed'] = current
+        return True
+
+    def get_circuit_state(self, opened):
+        """Return the circuit state for the time the circuit opened."""
+        if opened is None:
+            return CLOSED
+        if time.time() < opened + self.reset_timeout:
+            return OPEN
+        return HALF_OPEN
+
+    def get_state(self):
+        """Return whether the circuit is closed, open or half-open."""
+        return self.get_circuit_state(get_cache().get(self.opened_key))
+
+    def get_retry_delay(self):
+        """
+        Return the number of seconds to wait before a rejected request
+        is tried again. This is the time until the circuit is half-open,
+        or the trial timeout once it is half-open, as another process
+        holds the trial request.
+        """
+        opened = get_cache().get(self.opened_key)
+        if opened is None:
+            return 0
+        return max(opened + self.reset_timeout - time.time(), self.trial_timeout)
+
+    def allow(self):
+        """
+        Return ``True`` if a request may be sent to the endpoint. When
+        the circuit is half-open, only one process is allowed to send a
+        trial request.
+        """
+        if not self.threshold:
+            return True
+        # Keep the values read, so the result of the request is recorded
+        # without reading them again
+        self.values = self.read()
+        state = self.get_circuit_state(self.values[2])
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and get_cache().add(self.trial_key, True, self.trial_timeout):
+            self.trial = True
+            return True
+        stats.incr('slo.circuit_rejected')
+        return False
+
+    def pop_values(self):
+        """
+        Return the values read when the request was allowed, or read
+        them if the request was not checked.
+        """
+        values, self.values = self.values, None
+        return values if values is not None else self.read()
+
+    def release(self):
+        """
+        Release the trial request claimed while the circuit was
+        half-open. There is no trial request to release otherwise.
+        """
+        if self.trial:
+            get_cache().delete(self.trial_key)
+            self.trial = False
+
+    def incr_failures(self):
+        """Increment the number of consecutive failures and return it."""
+        cache = get_cache()
+        try:
+            return cache.incr(self.failures_key)
+        except ValueError:
+            # The counter does not exist, or expired after it was read
+            if cache.add(self.failures_key, 1, self.record_timeout):
+                return 1
+            return cache.incr(self.failures_key)
+
+    def save_record(self, record, latency, failed):
+        """Add the result of a request to the totals of the record."""
+        record['requests'] += 1
+        record['failures'] += int(failed)
+        record['latency'] += latency
+        get_cache().set(self.key, record, self.record_timeout)
+
+    def record_success(self, latency):
+        """
+        Record a successful request. A successful trial request closes
+        the circuit, while other requests only reset the consecutive
+        failures, so a request allowed before the circuit opened does
+        not close it.
+        """
+        record, failures, _ = self.pop_values()
+        record = record or self.make_record()
+        if not self.track(record):
+            self.release()
+            return
+        if self.trial:
+            get_cache().delete_many([self.failures_key, self.opened_key, self.trial_key])
+            self.trial = False
+        elif failures:
+            get_cache().delete(self.failures_key)
+        self.save_record(record, latency, False)
+
+    def record_failure(self, latency):
+        """
+        Record a failed request, opening the circuit if the endpoint has
+        reached the failure threshold or a trial request failed.
+        """
+        record, failures, _ = self.pop_values()
+        record = record or self.make_record()
+        if not self.track(record):
+            self.release()
+            return
+        cache = get_cache()
+        failures = self.incr_failures()
+        if self.trial:
+            cache.set(self.opened_key, time.time(), self.record_timeout)
+        elif self.threshold and failures >= self.threshold:
+            if cache.add(self.opened_key, time.time(), self.record_timeout):
+                stats.incr('slo.circuit_opened')
+        self.release()
+        self.save_record(record, latency, True)
+
+    def reset(self):
+        """Discard the health record of the endpoint, closing the circuit."""
+        cache = get_cache()
+        cache.delete_many([self.key, self.failures_key, self.opened_key, self.trial_key])
+        endpoints = cache.get(self.endpoints_key) or set()
+        if self.url in endpoints:
+            endpoints.discard(self.url)
+            cache.set(self.endpoints_key, endpoints, 2 * self.record_timeout)
+
+    def get_health(self):
+        """
+        Return a dictionary describing the circuit state, failure rate
+        and average latency of the endpoint.
+        """
+        record, failures, opened = self.read()
+        record = record or self.make_record()
+        count = record['requests']
+        return {
+            'url': self.url,
+            'state': self.get_circuit_state(opened),
+            'consecutive_failures': failures,
+            'requests': count,
+            'failures': record['failures'],
+            'failure_rate': record['failures'] / count if count else 0.0,
+            'latency': record['latency'] / count if count else 0.0,
+        }
+
+
+def get_breaker(url):
+    """Return the ``CircuitBreaker`` for a logout URL."""
+    return CircuitBreaker(url)
+
+
+def get_endpoints():
+    """Return the endpoints with a health record."""
+    cache = get_cache()
+    endpoints = cache.get(CircuitBreaker.endpoints_key) or []
+    breakers = dict((CircuitBreaker(endpoint).key, endpoint) for endpoint in endpoints)
+    return sorted(breakers[key] for key in cache.get_many(list(breakers)))
@@ -1,10 +1,114 @@
+"""
+Attribute callbacks provided to cover basic use cases, and the registry
+resolving configured callbacks.
+
+Each provided callback is built from extractors, which pair an attribute
+name with an accessor and the user fields it reads. The extractors for a
+user model are computed once, and limited to the attributes allowed for
+the service, so a callback only evaluates the attributes that will be
+released.
+
+Custom callbacks may declare an ``attributes`` sequence naming the
+attributes they return, and a ``fields`` sequence naming the user fields
+they read. Callbacks declaring neither are always run with a fully
+loaded user.
+"""
+from operator import attrgetter
+import threading
+import warnings
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from mama_cas.utils import get_service_policy
+
+
+IGNORE_FIELDS = ('id', 'password')
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def user_name_extractors(model):
+    return (('username', lambda user: user.get_username(), (model.USERNAME_FIELD,)),
+            ('full_name', lambda user: user.get_full_name(), None),
+            ('short_name', lambda user: user.get_short_name(), None))
+
+
+def user_model_extractors(model):
+    return tuple((field.name, attrgetter(field.name), (field.name,))
+                 for field in model._meta.fields if field.name not in IGNORE_FIELDS)
+
+
+def user_info_extractors(model):
+    return user_name_extractors(model) + (
+        ('email', attrgetter('email'), ('email',)),
+        ('first_name', attrgetter('first_name'), ('first_name',)),
+        ('last_name', attrgetter('last_name'), ('last_name',)),
+        ('uid', attrgetter('pk'), ()))
+
+
+def get_plan(extractors, model, allowed=None):
+    """
+    Return the extractors for a user model, limited to the ``allowed``
+    attribute names if provided. Plans are computed once for each
+    combination of arguments.
+    """
+    key = (extractors, model, allowed)
+    try:
+        return _plans[key]
+    except KeyError:
+        plan = extractors(model)
+        if allowed is not None:
+            plan = tuple(extractor for extractor in plan if extractor[0] in allowed)
+        with _plans_lock:
+            _plans[key] = plan
+        return plan
+
+
+def extract(extractors, user, service):
+    """Return the attributes of a user allowed for a service."""
+    plan = get_plan(extractors, user._meta.concrete_model,
+                    get_service_policy(service).attributes)
+    return dict((name, accessor(user)) for name, accessor, _ in plan)
+
+
+def get_callback_attributes(callback, model):
+    """
+    Return the names of the attributes a callback can return for a user
+    model, or ``None`` if they are unknown.
+    """
+    extractors = getattr(callback, 'extractors', None)
+    if extractors is not None:
+        return frozenset(extractor[0] for extractor in get_plan(extractors, model))
+    names = getattr(callback, 'attributes', None)
+    return frozenset(names) if names is not None else None
+
+
+def get_callback_fields(callback, model, allowed=None):
+    """
+    Return the names of the user fields a callback reads when returning
+    the ``allowed`` attributes, or ``None`` if they are unknown.
+    """
+    extractors = getattr(callback, 'extractors', None)
+    if extractors is None:
+        fields = getattr(callback, 'fields', None)
+        return frozenset(fields) if fields is not None else None
+    fields = set()
+    for _, _, needed in get_plan(extractors, model, allowed):
+        if needed is None:
+            return None
+        fields.update(needed)
+    return frozenset(fields)
+
+
 def user_name_attributes(user, service):
     """Return all available user name related fields and methods."""
-    attributes = {}
-    attributes['username'] = user.get_username()
-    attributes['full_name'] = user.get_full_name()
-    attributes['short_name'] = user.get_short_name()
-    return attributes
+    return extract(user_name_extractors, user, service)
+
+
+user_name_attributes.extractors = user_name_extractors
 
 
 def user_model_attributes(user, service):
@@ -12,21 +116,137 @@ def user_model_attributes(user, service):
     Return all fields on the user object that are not in the list
     of fields to ignore.
     """
-    ignore_fields = ['id', 'password']
-    attributes = {}
-    for field in user._meta.fields:
-        if field.name not in ignore_fields:
-            attributes[field.name] = getattr(user, field.name)
-    return attributes
+    return extract(user_model_extractors, user, service)
+
+
+user_model_attributes.extractors = user_model_extractors
+
 
 def user_info_attributes(user, service):
-    attributes = {}
-    print(dir(user))
-    attributes['username'] = user.get_username()
-    attributes['full_name'] = user.get_full_name()
-    attributes['short_name'] = user.get_short_name()
-    attributes['email'] = user.email
-    attributes['first_name'] = user.first_name
-    attributes['last_name'] = user.last_name
-    attributes['uid'] = user.id
-    return attributes
+    """
+    Return the user name related fields and methods, along with the
+    email address, first and last names and primary key of the user.
+    """
+    return extract(user_info_extractors, user, service)
+
+
+user_info_attributes.extractors = user_info_extractors
+
+
+class CallbackRegistry(object):
+    """
+    Resolves the dotted paths of attribute callbacks to callables, so
+    each path is imported once per process rather than per validation.
+    """
+    def __init__(self):
+        self.resolved = {}
+        self.callbacks = {}
+        self.plans = {}
+        self.warned = False
+        self.lock = threading.Lock()
+
+    def resolve(self, path):
+        """
+        Return the callable for a dotted path, raising
+        ``ImproperlyConfigured`` if it cannot be imported.
+        """
+        try:
+            return self.resolved[path]
+        except KeyError:
+            pass
+        try:
+            callback = import_string(path)
+        except ImportError as e:
+            raise ImproperlyConfigured("Error importing attribute callback %s: %s" % (path, e))
+        if not callable(callback):
+            raise ImproperlyConfigured("Attribute callback %s is not callable" % path)
+        with self.lock:
+            self.resolved[path] = callback
+        return callback
+
+    def get_global_paths(self):
+        paths = tuple(getattr(settings, 'MAMA_CAS_ATTRIBUTE_CALLBACKS', ()))
+        if paths and not self.warned:
+            self.warned = True
+            warnings.warn(
+                'The MAMA_CAS_ATTRIBUTE_CALLBACKS setting is deprecated. Service callbacks '
+                'should be configured using MAMA_CAS_VALID_SERVICES.', DeprecationWarning)
+        return paths
+
+    def get_paths(self, policy):
+        """
+        Return a tuple of the global callback paths followed by the
+        callback paths configured for a ``ServicePolicy``.
+        """
+        return self.get_global_paths() + policy.callbacks
+
+    def get_callbacks(self, policy):
+        """
+        Return a tuple of the global callbacks followed by the
+        callbacks configured for a ``ServicePolicy``.
+        """
+        key = self.get_paths(policy)
+        try:
+            return self.callbacks[key]
+        except KeyError:
+            callbacks = tuple(self.resolve(path) for path in key)
+            with self.lock:
+                self.callbacks[key] = callbacks
+            return callbacks
+
+    def get_release_plan(self, policy, model):
+        """
+        Return a tuple of the callback paths and callbacks that can
+        produce attributes allowed by a ``ServicePolicy``, and the names
+        of the user fields they read. The field names are ``None`` if any
+        of the callbacks does not declare the fields it reads.
+        """
+        key = (self.get_paths(policy), policy.attributes, model)
+        try:
+            return self.plans[key]
+        except KeyError:
+            pass
+
+        paths, callbacks, fields = [], [], set([model.USERNAME_FIELD])
+        for path, callback in zip(key[0], self.get_callbacks(policy)):
+            if policy.attributes is not None:
+                names = get_callback_attributes(callback, model)
+                if names is not None and not names & policy.attributes:
+                    continue
+            paths.append(path)
+            callbacks.append(callback)
+            if fields is not None:
+                needed = get_callback_fields(callback, model, policy.attributes)
+                fields = fields | needed if needed is not None else None
+
+        plan = (tuple(paths), tuple(callbacks), frozenset(fields) if fields is not None else None)
+        with self.lock:
+            self.plans[key] = plan
+        return plan
+
+    def load(self):
+        """
+        Resolve every callback configured in settings, so misconfigured
+        paths are reported when the server starts.
+        """
+        paths = list(self.get_global_paths())
+        for service in getattr(settings, 'MAMA_CAS_VALID_SERVICES', []):
+            if isinstance(service, dict):
+                paths.extend(service.get('CALLBACKS', []))
+        for path in paths:
+            self.resolve(path)
+
+
+callback_registry = CallbackRegistry()
+
+
+def get_deferred_user_fields(service, model):
+    """
+    Return the names of the user fields not read when releasing the
+    attributes allowed for a service, so they need not be loaded.
+    """
+    fields = callback_registry.get_release_plan(get_service_policy(service), model)[2]
+    if fields is None:
+        return ()
+    return tuple(field.name for field in model._meta.concrete_fields
+                 if field.name not in fields and not field.primary_key)
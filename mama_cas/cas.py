@@ -1,18 +1,26 @@
+import hashlib
 import logging
+import time
+import uuid
 import warnings
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import logout
-from django.utils.module_loading import import_string
+from django.core.cache import caches
+from django.utils import six
+from django.utils.encoding import force_bytes
 from django.utils.translation import ugettext_lazy as _
 
+from mama_cas import stats
+from mama_cas.callbacks import callback_registry
 from mama_cas.models import ServiceTicket
 from mama_cas.models import ProxyTicket
 from mama_cas.models import ProxyGrantingTicket
 from mama_cas.exceptions import InvalidTicketSpec
 from mama_cas.exceptions import ValidationError
-from mama_cas.utils import get_config
+from mama_cas.pool import run_concurrently
+from mama_cas.utils import get_service_policy
 
 
 logger = logging.getLogger(__name__)
@@ -93,34 +101,160 @@ def validate_proxy_granting_ticket(pgt, target_service):
         return pt, None
 
 
+class AttributeCache(object):
+    """
+    Caches the attributes returned for a user, service URL and set of
+    callbacks for ``MAMA_CAS_ATTRIBUTE_CACHE_TIMEOUT`` seconds. Each
+    entry is stored under its own key, which includes a version token
+    for the user, so the attributes of a user are invalidated together
+    by discarding the token.
+    """
+    key_prefix = 'mama_cas:attributes'
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'MAMA_CAS_ATTRIBUTE_CACHE', 'default')]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'MAMA_CAS_ATTRIBUTE_CACHE_TIMEOUT', 0)
+
+    def make_version_key(self, user):
+        return '%s:%s:version' % (self.key_prefix, getattr(user, 'pk', user))
+
+    def make_key(self, user, version, key):
+        digest = hashlib.md5(force_bytes(repr(key))).hexdigest()
+        return '%s:%s:%s:%s' % (self.key_prefix, getattr(user, 'pk', user), version, digest)
+
+    def get_version(self, user):
+        """Return the current version token for a user's attributes."""
+        version_key = self.make_version_key(user)
+        version = self.cache.get(version_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not self.cache.add(version_key, version, self.timeout):
+                version = self.cache.get(version_key, version)
+        return version
+
+    def get(self, user, version, key):
+        """
+        Return the cached attributes for a user, version token and key
+        identifying the service, callbacks and released attributes, or
+        ``None`` if they are not cached.
+        """
+        attributes = self.cache.get(self.make_key(user, version, key))
+        stats.incr('attributes.cache_misses' if attributes is None else 'attributes.cache_hits')
+        return attributes
+
+    def set(self, user, version, key, attributes):
+        """
+        Cache attributes under the version token read before they were
+        gathered, so attributes gathered while the user's attributes
+        were invalidated are never returned.
+        """
+        self.cache.set(self.make_key(user, version, key), attributes, self.timeout)
+
+    def invalidate(self, user):
+        """Discard the cached attributes for a user or user primary key."""
+        # A new random token is added when the attributes are next read
+        self.cache.delete(self.make_version_key(user))
+
+
+attribute_cache = AttributeCache()
+
+
+def invalidate_attributes(user):
+    """
+    Discard the cached attributes for a user or user primary key, so
+    they are gathered from the callbacks on the next validation. This is
+    called automatically when a user is saved.
+    """
+    attribute_cache.invalidate(user)
+
+
+def run_callback(path, callback, user, service):
+    """Call an attribute callback, recording its duration."""
+    start = time.time()
+    try:
+        return callback(user, service)
+    finally:
+        stats.observe('callbacks.%s' % path, time.time() - start)
+
+
 def get_attributes(user, service):
     """
     Return a dictionary of user attributes from the set of configured
-    callback functions.
+    callback functions, skipping callbacks that cannot produce any of
+    the attributes allowed for the service. If
+    ``MAMA_CAS_ATTRIBUTE_CACHE_TIMEOUT`` is set, the attributes are
+    cached for each user, service URL and set of callbacks.
+
+    If ``MAMA_CAS_CALLBACK_CONCURRENCY`` is set, multiple callbacks are
+    run concurrently, and callbacks that do not start or do not finish
+    within ``MAMA_CAS_CALLBACK_TIMEOUT`` seconds are omitted.
     """
     attributes = {}
 
-    callbacks = list(getattr(settings, 'MAMA_CAS_ATTRIBUTE_CALLBACKS', []))
-    if callbacks:
-        warnings.warn(
-            'The MAMA_CAS_ATTRIBUTE_CALLBACKS setting is deprecated. Service callbacks '
-            'should be configured using MAMA_CAS_VALID_SERVICES.', DeprecationWarning)
-    callbacks.extend(get_config(service, 'CALLBACKS'))
+    # Only run the callbacks that can produce an allowed attribute
+    policy = get_service_policy(service)
+    paths, callbacks, _ = callback_registry.get_release_plan(policy, user._meta.concrete_model)
+    if not callbacks:
+        return attributes
 
-    for path in callbacks:
-        callback = import_string(path)
-        attributes.update(callback(user, service))
+    if attribute_cache.timeout:
+        allowed = tuple(sorted(policy.attributes)) if policy.attributes is not None else None
+        key = (service, paths, allowed)
+        version = attribute_cache.get_version(user)
+        cached = attribute_cache.get(user, version, key)
+        if cached is not None:
+            return cached
 
+    complete = True
+    concurrency = getattr(settings, 'MAMA_CAS_CALLBACK_CONCURRENCY', 0)
+    if concurrency and len(callbacks) > 1:
+        calls = [(run_callback, (path, callback, user, service))
+                 for path, callback in zip(paths, callbacks)]
+        timeout = getattr(settings, 'MAMA_CAS_CALLBACK_TIMEOUT', 5.0)
+        results = run_concurrently(calls, concurrency, name='callbacks', timeout=timeout, call_timeout=timeout)
+        for path, (finished, value, exc_info) in zip(paths, results):
+            if not finished:
+                complete = False
+                stats.incr('callbacks.timeouts')
+                logger.warning("Attribute callback %s timed out and was omitted" % path)
+            elif exc_info is not None:
+                six.reraise(*exc_info)
+            else:
+                attributes.update(value)
+    else:
+        for path, callback in zip(paths, callbacks):
+            attributes.update(run_callback(path, callback, user, service))
+
+    if policy.attributes is not None:
+        attributes = dict((name, value) for name, value in attributes.items()
+                          if name in policy.attributes)
+
+    if attribute_cache.timeout and complete:
+        attribute_cache.set(user, version, key, attributes)
     return attributes
 
 
+def revoke_tickets(users):
+    """
+    Consume all valid tickets of every type for the specified users,
+    given as a list or queryset of users or user primary keys. This
+    issues one query per ticket type regardless of the number of users,
+    and is suitable for account lockouts or offboarding.
+    """
+    ServiceTicket.objects.bulk_consume_tickets(users)
+    ProxyTicket.objects.bulk_consume_tickets(users)
+    ProxyGrantingTicket.objects.bulk_consume_tickets(users)
+
+
 def logout_user(request):
     """End a single sign-on session for the current user."""
     logger.debug("Logout request received for %s" % request.user)
     if request.user.is_authenticated():
-        ServiceTicket.objects.consume_tickets(request.user)
-        ProxyTicket.objects.consume_tickets(request.user)
-        ProxyGrantingTicket.objects.consume_tickets(request.user)
+        revoke_tickets([request.user])
 
         if getattr(settings, 'MAMA_CAS_ENABLE_SINGLE_SIGN_OUT', True):
             warnings.warn(
@@ -0,0 +1,107 @@
+"""
+A shared HTTP client for the requests sent to services, such as single
+logout requests and proxy callbacks. Each server process uses a single
+``requests`` session, so connections to a host are kept alive and
+reused instead of opening a new connection for every request.
+"""
+import os
+import threading
+
+from django.conf import settings
+from django.utils.six.moves import http_cookiejar
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class NoCookiesPolicy(http_cookiejar.DefaultCookiePolicy):
+    """
+    A cookie policy rejecting all cookies, so cookies set by one
+    service are never sent to another by the shared session.
+    """
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session():
+    """
+    Return a new ``requests.Session`` configured by the
+    ``MAMA_CAS_HTTP_POOL_CONNECTIONS`` and ``MAMA_CAS_HTTP_POOL_MAXSIZE``
+    settings. Certificates are verified against ``REQUESTS_CA_BUNDLE``
+    when it is set.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(NoCookiesPolicy())
+    session.verify = os.environ.get('REQUESTS_CA_BUNDLE', True)
+    adapter = HTTPAdapter(pool_connections=getattr(settings, 'MAMA_CAS_HTTP_POOL_CONNECTIONS', 10),
+                          pool_maxsize=getattr(settings, 'MAMA_CAS_HTTP_POOL_MAXSIZE', 10))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Return the process-wide ``requests.Session``."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def reset_session():
+    """Close the process-wide session, so a new one is created when next used."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_timeout():
+    """
+    Return the ``(connect, read)`` timeout in seconds for requests sent
+    to services, as configured by ``MAMA_CAS_HTTP_TIMEOUT``.
+    """
+    timeout = getattr(settings, 'MAMA_CAS_HTTP_TIMEOUT', 3.0)
+    if isinstance(timeout, (int, float)):
+        return (timeout, timeout)
+    return tuple(timeout)
+
+
+def get_pool_stats():
+    """
+    Return a dictionary of the number of requests sent and connections
+    opened by the process-wide session, in total and for each host, and
+    the proportion of requests that reused an open connection. Hosts
+    whose connection pool has been discarded are not included.
+    """
+    hosts = {}
+    session = _session
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = '%s://%s:%s' % (pool.scheme, pool.host, pool.port)
+                hosts[host] = {'requests': pool.num_requests,
+                               'connections': pool.num_connections}
+
+    total_requests = sum(host['requests'] for host in hosts.values())
+    total_connections = sum(host['connections'] for host in hosts.values())
+    if total_requests:
+        hit_rate = max(total_requests - total_connections, 0) / float(total_requests)
+    else:
+        hit_rate = 0.0
+    return {'requests': total_requests, 'connections': total_connections,
+            'hit_rate': hit_rate, 'hosts': hosts}
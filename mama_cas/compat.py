@@ -6,8 +6,8 @@ except ImportError:  # pragma: no cover
     import xml.etree.ElementTree as etree
 
 
-# gevent is optional, and allows for asynchronous single logout
-# requests. If it is not present, synchronous requests will be sent.
+# gevent is optional, and is used for concurrent requests when the
+# server has patched the process. MamaCAS never patches it itself.
 try:
     import gevent
 except ImportError:  # pragma: no cover
@@ -28,3 +28,20 @@ try:
 except ImportError:  # pragma: no cover
     from urllib import urlencode
     from urlparse import parse_qsl, urlparse, urlunparse
+
+
+# fcntl is not available on all platforms, and is used to lock the
+# shared ticket filter file. If it is not present, the ticket filter
+# cannot be enabled.
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+# The regular expression parser moved to a private module in Python 3.11,
+# and is used to find the literal prefixes of service patterns.
+try:
+    from re import _parser as sre_parse
+except ImportError:  # pragma: no cover
+    import sre_parse
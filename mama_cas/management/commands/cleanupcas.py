@@ -1,11 +1,15 @@
-from django.core.management.base import NoArgsCommand
+from collections import defaultdict
+import time
 
+from django.core.management.base import BaseCommand
+
+from mama_cas.backends import get_label
 from mama_cas.models import ServiceTicket
 from mama_cas.models import ProxyTicket
 from mama_cas.models import ProxyGrantingTicket
 
 
-class Command(NoArgsCommand):
+class Command(BaseCommand):
     """
     A management command for deleting invalid tickets from the
     database. A ticket is invalidated either by being consumed or
@@ -19,11 +23,47 @@ class Command(NoArgsCommand):
 
     This command calls ``delete_invalid_tickets()`` for each applicable
     model, which deletes all invalid tickets of that type that are not
-    referenced by other ``Ticket``s.
+    referenced by other ``Ticket``s. Models are processed in dependency
+    order, so tickets referenced by proxy-granting tickets are deleted
+    after those proxy-granting tickets.
+
+    With ``--dry-run``, only the invalid tickets that are not referenced
+    by other tickets are counted, so a real run may delete more.
     """
     help = "Delete consumed or expired CAS tickets from the database"
+    ticket_models = (ProxyGrantingTicket, ProxyTicket, ServiceTicket)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of tickets deleted per statement')
+        parser.add_argument('--max-runtime', type=float, default=None,
+                            help='Stop deleting tickets after this many seconds')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Count the invalid tickets not referenced by other tickets, '
+                                 'without deleting them')
+
+    def handle(self, **options):
+        deadline = None
+        if options['max_runtime'] is not None:
+            deadline = time.time() + options['max_runtime']
+
+        deleted = defaultdict(int)
+        elapsed = {}
+        for model in self.ticket_models:
+            start = time.time()
+            counts = model.objects.delete_invalid_tickets(batch_size=options['batch_size'],
+                                                          deadline=deadline,
+                                                          dry_run=options['dry_run'])
+            elapsed[model] = time.time() - start
+            for label, count in counts.items():
+                deleted[label] += count
 
-    def handle_noargs(self, **options):
-        ProxyGrantingTicket.objects.delete_invalid_tickets()
-        ProxyTicket.objects.delete_invalid_tickets()
-        ServiceTicket.objects.delete_invalid_tickets()
+        if options['verbosity'] >= 1:
+            action = 'Would delete' if options['dry_run'] else 'Deleted'
+            for model in self.ticket_models:
+                self.stdout.write("%s %d %s in %.2fs" % (action, deleted[get_label(model)],
+                                                         model._meta.verbose_name_plural,
+                                                         elapsed[model]))
+            if options['dry_run']:
+                self.stdout.write("Only top-level candidates are counted. Tickets deleted in cascade, "
+                                  "or no longer referenced once other tickets are deleted, are not.")
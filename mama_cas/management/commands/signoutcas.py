@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mama_cas.models import SignOutMessage
+
+
+class Command(BaseCommand):
+    """
+    A management command for sending the single logout requests queued
+    when ``MAMA_CAS_SLO_OUTBOX`` is enabled. Logging out only inserts
+    the requests into the outbox, so slow services do not delay the
+    logout response.
+
+    The command runs until it is stopped, claiming batches of due
+    messages and sending them. Failed requests are retried with an
+    exponential backoff, and dead-lettered after
+    ``MAMA_CAS_SLO_MAX_ATTEMPTS`` attempts. Several workers can run at
+    once, as each message is claimed by a single worker.
+    """
+    help = "Send queued single logout requests"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of messages claimed at a time')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when no messages are due')
+        parser.add_argument('--lease', type=int, default=60,
+                            help='Seconds before a claimed message can be claimed again, renewed before each request')
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Exit once no messages are due')
+        parser.add_argument('--max-runtime', type=float, default=None,
+                            help='Stop sending messages after this many seconds')
+        parser.add_argument('--stats', action='store_true', default=False,
+                            help='Print the queue depth and exit')
+
+    def handle(self, **options):
+        if options['stats']:
+            self.write_queue_depth()
+            return
+
+        deadline = None
+        if options['max_runtime'] is not None:
+            deadline = time.time() + options['max_runtime']
+
+        sent = 0
+        while deadline is None or time.time() < deadline:
+            count = SignOutMessage.objects.deliver(batch_size=options['batch_size'],
+                                                   lease=options['lease'])
+            sent += count
+            if not count:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+
+        if options['verbosity'] >= 1:
+            self.stdout.write("Attempted %d single logout requests" % sent)
+            self.write_queue_depth()
+
+    def write_queue_depth(self):
+        depth = SignOutMessage.objects.get_queue_depth()
+        self.stdout.write("Pending: %(pending)d, due: %(due)d, dead: %(dead)d" % depth)
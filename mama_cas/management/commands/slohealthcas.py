@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from mama_cas.breaker import get_breaker
+from mama_cas.breaker import get_endpoints
+
+
+class Command(BaseCommand):
+    """
+    A management command for showing the health of the endpoints that
+    single logout requests are sent to. For each endpoint, the state of
+    its circuit breaker is shown along with the number of requests, the
+    failure rate and the average latency.
+
+    An endpoint that has recovered can be reset, closing its circuit
+    without waiting for a trial request.
+    """
+    help = "Show the health of single logout endpoints"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', metavar='URL', action='append', default=[],
+                            help='Reset the circuit breaker for a logout URL')
+
+    def handle(self, **options):
+        for url in options['reset']:
+            breaker = get_breaker(url)
+            breaker.reset()
+            self.stdout.write("Reset %s" % breaker.url)
+        if options['reset']:
+            return
+
+        endpoints = get_endpoints()
+        if not endpoints:
+            self.stdout.write("No single logout requests have been recorded")
+            return
+        for endpoint in endpoints:
+            health = get_breaker(endpoint).get_health()
+            self.stdout.write("%(url)s: %(state)s, %(requests)d requests, "
+                              "%(failure_rate).1f%% failed, %(latency).3fs average latency" %
+                              dict(health, failure_rate=health['failure_rate'] * 100))
@@ -0,0 +1,192 @@
+"""
+Matching of service URLs against the configured service patterns.
+
+Most service patterns begin with a literal scheme and hostname, so the
+patterns are indexed by their literal prefixes in a trie. Only patterns
+whose prefix matches the URL are tested, and patterns that are entirely
+literal are matched by the trie alone. The remaining patterns at each
+node of the trie are combined into alternations, so they can be tested
+in a single pass.
+"""
+import re
+
+from django.utils import six
+
+from mama_cas.compat import sre_parse
+
+
+# Python 2 limits the number of groups in a single expression
+MAX_GROUPS = 99
+
+# The maximum number of prefixes created from optional literals
+MAX_PREFIXES = 8
+
+# Below this number of patterns, testing each in turn is faster
+MIN_INDEXED = 16
+
+
+def get_literal_prefixes(regex):
+    """
+    Return a tuple of the literal prefixes of a compiled regular
+    expression, and whether the expression consists only of those
+    prefixes when used with ``match()``. Optional literals, such as the
+    ``s`` in ``https?``, are expanded into separate prefixes.
+    """
+    if regex.flags & (re.IGNORECASE | re.LOCALE):
+        return [''], False
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:  # pragma: no cover
+        return [''], False
+
+    to_char = six.unichr if isinstance(regex.pattern, six.text_type) else chr
+    prefixes = ['']
+    items = list(parsed)
+    if items and items[0] == (sre_parse.AT, sre_parse.AT_BEGINNING):
+        items = items[1:]
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            prefixes = [prefix + to_char(av) for prefix in prefixes]
+            continue
+        repeat = op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+        if repeat and av[:2] == (0, 1) and len(prefixes) < MAX_PREFIXES:
+            if all(o == sre_parse.LITERAL for o, _ in av[2]):
+                optional = ''.join(to_char(c) for _, c in av[2])
+                prefixes = [p + suffix for p in prefixes for suffix in (optional, '')]
+                continue
+        return prefixes, False
+    return prefixes, True
+
+
+def has_backreferences(regex):
+    return bool(re.search(r'\\[1-9]|\(\?P=', regex.pattern))
+
+
+class ServiceMatcher(object):
+    """
+    Find the first of a list of compiled regular expressions matching a
+    service URL, with the same result as testing each in turn.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.literal = []
+        self.trie = {}
+        self.indexed = len(self.patterns) >= MIN_INDEXED
+        if not self.indexed:
+            return
+        nodes = []
+
+        for index, regex in enumerate(self.patterns):
+            prefixes, literal = get_literal_prefixes(regex)
+            self.literal.append(literal)
+            for prefix in prefixes:
+                node = self.trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                if None not in node:
+                    node[None] = []
+                    nodes.append(node)
+                if index not in node[None]:
+                    node[None].append(index)
+
+        for node in nodes:
+            indexes = node[None]
+            literal = [index for index in indexes if self.literal[index]]
+            patterns = [index for index in indexes if not self.literal[index]]
+            node[None] = (min(indexes), literal[0] if literal else None,
+                          self.compile_alternations(patterns))
+
+    def compile_alternations(self, indexes):
+        """
+        Combine patterns into alternations. Each alternation is a tuple
+        of the index of its first pattern, a compiled expression, a
+        mapping of group numbers to pattern indexes and the indexes of
+        patterns that could not be combined and are tested individually.
+        """
+        alternations = []
+        default_flags = re.compile('').flags
+        group, alternatives = 1, []
+        for index in indexes:
+            regex = self.patterns[index]
+            combinable = regex.flags == default_flags and not has_backreferences(regex)
+            if not combinable or group + regex.groups + 1 > MAX_GROUPS:
+                if alternatives:
+                    alternations.append(self.compile_alternation(alternatives))
+                group, alternatives = 1, []
+            if not combinable:
+                alternations.append((index, None, {}, [index]))
+                continue
+            alternatives.append((group, index))
+            group += regex.groups + 1
+        if alternatives:
+            alternations.append(self.compile_alternation(alternatives))
+        return alternations
+
+    def compile_alternation(self, alternatives):
+        pattern = '|'.join('(%s)' % self.patterns[index].pattern for _, index in alternatives)
+        first = alternatives[0][1]
+        try:
+            return first, re.compile(pattern), dict(alternatives), []
+        except (re.error, AssertionError, OverflowError, RuntimeError):  # pragma: no cover
+            return first, None, {}, [index for _, index in alternatives]
+
+    def match_alternations(self, alternations, s, limit=None):
+        """
+        Return the index of the first pattern in the alternations that
+        matches the provided string, ignoring patterns after ``limit``.
+        """
+        for first, regex, groups, indexes in alternations:
+            if limit is not None and first > limit:
+                break
+            if regex is not None:
+                m = regex.match(s)
+                if m:
+                    return groups[m.lastindex]
+            for index in indexes:
+                if limit is not None and index > limit:
+                    break
+                if self.patterns[index].match(s):
+                    return index
+        return None
+
+    def match_node(self, node, s, limit):
+        """
+        Return the index of the first pattern at a trie node matching
+        the provided string, if it comes before ``limit``.
+        """
+        first, literal, alternations = node[None]
+        if limit is not None and first > limit:
+            return None
+        if literal is not None and (limit is None or literal < limit):
+            limit = literal
+        index = self.match_alternations(alternations, s, limit)
+        if index is None or (limit is not None and index > limit):
+            index = literal
+        if index is not None and limit is not None and index > limit:
+            return None
+        return index
+
+    def match(self, s):
+        """
+        Return the index of the first pattern matching the provided
+        string, or ``None`` if no pattern matches.
+        """
+        if not self.indexed:
+            for index, regex in enumerate(self.patterns):
+                if regex.match(s):
+                    return index
+            return None
+
+        best = None
+        node = self.trie
+        if None in node:
+            best = self.match_node(node, s, best)
+        for char in s:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                index = self.match_node(node, s, best)
+                if index is not None:
+                    best = index
+        return best
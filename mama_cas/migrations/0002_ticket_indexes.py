@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='proxygrantingticket',
+            name='consumed',
+            field=models.DateTimeField(db_index=True, null=True, verbose_name='consumed'),
+        ),
+        migrations.AlterField(
+            model_name='proxygrantingticket',
+            name='expires',
+            field=models.DateTimeField(db_index=True, verbose_name='expires'),
+        ),
+        migrations.AlterField(
+            model_name='proxyticket',
+            name='consumed',
+            field=models.DateTimeField(db_index=True, null=True, verbose_name='consumed'),
+        ),
+        migrations.AlterField(
+            model_name='proxyticket',
+            name='expires',
+            field=models.DateTimeField(db_index=True, verbose_name='expires'),
+        ),
+        migrations.AlterField(
+            model_name='serviceticket',
+            name='consumed',
+            field=models.DateTimeField(db_index=True, null=True, verbose_name='consumed'),
+        ),
+        migrations.AlterField(
+            model_name='serviceticket',
+            name='expires',
+            field=models.DateTimeField(db_index=True, verbose_name='expires'),
+        ),
+        migrations.AlterIndexTogether(
+            name='proxygrantingticket',
+            index_together=set([('user', 'consumed', 'expires')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='proxyticket',
+            index_together=set([('user', 'consumed', 'expires')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='serviceticket',
+            index_together=set([('user', 'consumed', 'expires')]),
+        ),
+    ]
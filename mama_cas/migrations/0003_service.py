@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0002_ticket_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Service',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255, verbose_name='name')),
+                ('pattern', models.CharField(help_text='A regular expression matching the service URL', max_length=255, verbose_name='pattern')),
+                ('position', models.PositiveIntegerField(default=0, verbose_name='position')),
+                ('enabled', models.BooleanField(default=True, verbose_name='enabled')),
+                ('proxy_allow', models.BooleanField(default=False, verbose_name='proxy allow')),
+                ('proxy_pattern', models.CharField(max_length=255, verbose_name='proxy pattern', blank=True)),
+                ('callbacks', models.TextField(help_text='Dotted paths to attribute callbacks, one per line', verbose_name='callbacks', blank=True)),
+                ('logout_allow', models.BooleanField(default=False, verbose_name='logout allow')),
+                ('logout_url', models.CharField(max_length=255, verbose_name='logout URL', blank=True)),
+            ],
+            options={
+                'ordering': ('position', 'pk'),
+                'verbose_name': 'service',
+                'verbose_name_plural': 'services',
+            },
+        ),
+    ]
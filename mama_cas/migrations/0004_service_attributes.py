@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0003_service'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='attributes',
+            field=models.TextField(help_text='Names of the attributes released, one per line. Leave blank to release all attributes.', verbose_name='attributes', blank=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0004_service_attributes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SignOutMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=255, verbose_name='url')),
+                ('service', models.CharField(max_length=255, verbose_name='service')),
+                ('ticket', models.CharField(max_length=255, verbose_name='ticket')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='next attempt')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('dead', models.BooleanField(default=False, verbose_name='dead')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+            ],
+            options={
+                'verbose_name': 'single logout message',
+                'verbose_name_plural': 'single logout messages',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='signoutmessage',
+            index_together=set([('dead', 'next_attempt')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0005_signoutmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='logout_batch',
+            field=models.BooleanField(default=False, help_text='Send one logout request with every session index for the logout URL', verbose_name='logout batch'),
+        ),
+    ]
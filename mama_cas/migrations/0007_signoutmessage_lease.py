@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mama_cas', '0006_service_logout_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='signoutmessage',
+            name='lease',
+            field=models.CharField(blank=True, db_index=True, max_length=32, verbose_name='lease'),
+        ),
+    ]
@@ -31,12 +31,19 @@ class CasResponseMixin(object):
     """
     View mixin for building CAS XML responses. Expects the view to
     implement ``get_context_data()`` and define ``response_class``.
+
+    If the view defines ``json_response_class``, a JSON response is
+    built instead when the ``format`` parameter is ``JSON``. [CAS 3.0]
     """
     content_type = 'text/xml'
+    json_content_type = 'application/json'
+    json_response_class = None
 
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
         return self.render_to_response(context)
 
     def render_to_response(self, context):
+        if self.json_response_class and self.request.GET.get('format', '').upper() == 'JSON':
+            return self.json_response_class(context, content_type=self.json_content_type)
         return self.response_class(context, content_type=self.content_type)
@@ -1,21 +1,35 @@
 from __future__ import unicode_literals
 
+from collections import OrderedDict
 from datetime import timedelta
 import logging
-import os
 import re
 import time
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ValidationError as FieldValidationError
 from django.db import models
-from django.db.models import Q
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils.crypto import get_random_string
+from django.utils.encoding import force_text
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.module_loading import import_string
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
 import requests
 
+from mama_cas import stats
+from mama_cas.backends import get_backend
+from mama_cas.bloom import get_ticket_filter
+from mama_cas.breaker import CircuitOpenError
+from mama_cas.breaker import get_breaker
+from mama_cas.client import get_session
+from mama_cas.client import get_timeout
 from mama_cas.compat import gevent
 from mama_cas.exceptions import InvalidProxyCallback
 from mama_cas.exceptions import InvalidRequest
@@ -23,29 +37,35 @@ from mama_cas.exceptions import InvalidService
 from mama_cas.exceptions import InvalidTicket
 from mama_cas.exceptions import UnauthorizedServiceProxy
 from mama_cas.exceptions import ValidationError
+from mama_cas.pool import is_gevent_patched
+from mama_cas.pool import run_concurrently
 from mama_cas.request import SingleSignOutRequest
 from mama_cas.utils import add_query_params
 from mama_cas.utils import clean_service_url
-from mama_cas.utils import get_config
+from mama_cas.utils import get_service_policy
 from mama_cas.utils import is_scheme_https
-from mama_cas.utils import is_valid_service
 from mama_cas.utils import is_valid_proxy_callback
 from mama_cas.utils import match_service
-
-if gevent:
-    from gevent.pool import Pool
-    from gevent import monkey
-    monkey.patch_all(thread=False, select=False)
+from mama_cas.utils import parse_url
+from mama_cas.utils import services as service_config
 
 
 logger = logging.getLogger(__name__)
 
 
 class TicketManager(models.Manager):
+    @property
+    def backend(self):
+        """
+        The ticket storage backend for this model, as configured by
+        ``MAMA_CAS_TICKET_BACKEND``.
+        """
+        return get_backend(self.model)
+
     def create_ticket(self, ticket=None, **kwargs):
         """
         Create a new ``Ticket``. Additional arguments are passed to the
-        ``create()`` function. Return the newly created ``Ticket``.
+        ticket backend. Return the newly created ``Ticket``.
         """
         if not ticket:
             ticket = self.create_ticket_str()
@@ -54,7 +74,12 @@ class TicketManager(models.Manager):
         if 'expires' not in kwargs:
             expires = now() + timedelta(seconds=self.model.TICKET_EXPIRE)
             kwargs['expires'] = expires
-        t = self.create(ticket=ticket, **kwargs)
+        t = self.backend.create(ticket=ticket, **kwargs)
+        ticket_filter = get_ticket_filter()
+        if ticket_filter is not None:
+            issued = self.get_issued(t.ticket)
+            if issued is not None:
+                ticket_filter.add(t.ticket, issued)
         logger.debug("Created %s %s" % (t.name, t.ticket))
         return t
 
@@ -68,6 +93,13 @@ class TicketManager(models.Manager):
         return "%s-%d-%s" % (prefix, int(time.time()),
                              get_random_string(length=self.model.TICKET_RAND_LEN))
 
+    def get_issued(self, ticket):
+        """
+        Return the issue time embedded in a ticket string as a Unix
+        timestamp, or ``None`` if it cannot be parsed.
+        """
+        return self.backend.get_issued(ticket)
+
     def validate_ticket(self, ticket, service, renew=False, require_https=False):
         """
         Given a ticket string and service identifier, validate the
@@ -84,12 +116,38 @@ class TicketManager(models.Manager):
         if not ticket:
             raise InvalidRequest("No ticket string provided")
 
-        if not self.model.TICKET_RE.match(ticket):
+        if not self.backend.is_valid_format(ticket):
             raise InvalidTicket("Ticket string %s is invalid" % ticket)
 
+        # Reject tickets that are too old or too new to be valid based
+        # on their embedded issue time, before looking them up
+        issued = self.get_issued(ticket)
+        if issued is not None:
+            skew = getattr(settings, 'MAMA_CAS_TICKET_CLOCK_SKEW', 30)
+            current = time.time()
+            if issued + self.model.TICKET_EXPIRE + skew < current:
+                stats.incr('tickets.fast_rejected')
+                raise InvalidTicket("%s %s has expired" % (self.model._meta.verbose_name, ticket))
+            if issued > current + skew:
+                stats.incr('tickets.fast_rejected')
+                raise InvalidTicket("%s %s was issued in the future" %
+                                    (self.model._meta.verbose_name, ticket))
+
+        # Reject tickets that were definitely never issued, before
+        # looking them up
+        found = None
+        ticket_filter = get_ticket_filter()
+        if ticket_filter is not None and issued is not None:
+            found = ticket_filter.lookup(ticket, issued)
+            if found is False:
+                stats.incr('tickets.filter_rejected')
+                raise InvalidTicket("Ticket %s does not exist" % ticket)
+
         try:
-            t = self.get(ticket=ticket)
+            t = self.backend.get(ticket, service)
         except self.model.DoesNotExist:
+            if found:
+                stats.incr('tickets.filter_false_positives')
             raise InvalidTicket("Ticket %s does not exist" % ticket)
 
         if t.is_consumed():
@@ -101,15 +159,16 @@ class TicketManager(models.Manager):
         if not service:
             raise InvalidRequest("No service identifier provided")
 
-        if require_https and not is_scheme_https(service):
+        service_url = parse_url(service)
+        if require_https and not is_scheme_https(service_url):
             raise InvalidService("Service %s is not HTTPS" % service)
 
-        if not is_valid_service(service):
+        if not get_service_policy(service).valid:
             raise InvalidService("Service %s is not a valid %s URL" %
                                  (service, t.name))
 
         try:
-            if not match_service(t.service, service):
+            if not match_service(t.service, service_url):
                 raise InvalidService("%s %s for service %s is invalid for "
                         "service %s" % (t.name, ticket, t.service, service))
         except AttributeError:
@@ -125,21 +184,25 @@ class TicketManager(models.Manager):
         logger.debug("Validated %s %s" % (t.name, ticket))
         return t
 
-    def delete_invalid_tickets(self):
+    def delete_invalid_tickets(self, batch_size=1000, deadline=None, dry_run=False):
         """
         Delete consumed or expired ``Ticket``s that are not referenced
         by other ``Ticket``s. Invalid tickets are no longer valid for
         authentication and can be safely deleted.
 
+        Tickets are deleted in batches of ``batch_size``, stopping once
+        the ``deadline`` timestamp has passed. Return a dictionary
+        mapping model labels to the number of deleted rows. If
+        ``dry_run`` is ``True``, nothing is deleted and the number of
+        invalid tickets not referenced by other tickets is returned
+        instead. This does not include rows deleted in cascade, or
+        tickets only referenced by other invalid tickets.
+
         A custom management command is provided that executes this method
         on all applicable models by running ``manage.py cleanupcas``.
         """
-        for ticket in self.filter(Q(consumed__isnull=False) |
-                                  Q(expires__lte=now())).order_by('-expires'):
-            try:
-                ticket.delete()
-            except models.ProtectedError:
-                pass
+        return self.backend.delete_invalid_tickets(batch_size=batch_size, deadline=deadline,
+                                                   dry_run=dry_run)
 
     def consume_tickets(self, user):
         """
@@ -147,9 +210,15 @@ class TicketManager(models.Manager):
         when the user logs out to ensure all issued tickets are no longer
         valid for future authentication attempts.
         """
-        for ticket in self.filter(user=user, consumed__isnull=True,
-                                  expires__gt=now()):
-            ticket.consume()
+        self.bulk_consume_tickets([user])
+
+    def bulk_consume_tickets(self, users):
+        """
+        Consume all valid ``Ticket``s for each of the specified users,
+        given as a list or queryset of users or user primary keys. The
+        database backend does this with a single ``UPDATE``.
+        """
+        self.backend.consume_tickets(users)
 
 
 @python_2_unicode_compatible
@@ -164,13 +233,16 @@ class Ticket(models.Model):
 
     ticket = models.CharField(_('ticket'), max_length=255, unique=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'))
-    expires = models.DateTimeField(_('expires'))
-    consumed = models.DateTimeField(_('consumed'), null=True)
+    expires = models.DateTimeField(_('expires'), db_index=True)
+    consumed = models.DateTimeField(_('consumed'), null=True, db_index=True)
 
     objects = TicketManager()
 
     class Meta:
         abstract = True
+        # Matches the per-user lookups made when consuming tickets
+        # and sending single logout requests
+        index_together = [['user', 'consumed', 'expires']]
 
     def __str__(self):
         return self.ticket
@@ -184,17 +256,18 @@ class Ticket(models.Model):
         Consume a ``Ticket`` by populating the ``consumed`` field with
         the current datetime. A consumed ``Ticket`` is invalid for future
         authentication attempts.
+
+        Return ``True`` if the ``Ticket`` was consumed by this call, or
+        ``False`` if it was already consumed.
         """
-        self.consumed = now()
-        self.save()
+        return self.__class__._default_manager.backend.consume(self)
 
     def is_consumed(self):
         """
         Check a ``Ticket``s consumed state, consuming it in the process.
         """
         if self.consumed is None:
-            self.consume()
-            return False
+            return not self.consume()
         return True
 
     def is_expired(self):
@@ -205,6 +278,98 @@ class Ticket(models.Model):
         return self.expires <= now()
 
 
+def send_sign_out_request(url, ticket):
+    """
+    POST a single logout request for a ticket, or a batched request for
+    a list of tickets, to a service logout URL, raising a
+    ``RequestException`` if the request fails.
+
+    The result is recorded by the circuit breaker for the URL, where
+    connection errors, timeouts and server errors count as failures.
+    While the circuit is open, no request is sent and
+    ``CircuitOpenError`` is raised.
+    """
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        raise CircuitOpenError("Circuit for %s is open" % url)
+    if isinstance(ticket, (list, tuple)):
+        context = {'tickets': ticket}
+    else:
+        context = {'ticket': ticket}
+    request = SingleSignOutRequest(context=context)
+    start = time.time()
+    try:
+        resp = get_session().post(url, data={'logoutRequest': request.render_content()},
+                                  timeout=get_timeout())
+        resp.raise_for_status()
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        breaker.record_failure(time.time() - start)
+        raise
+    except requests.exceptions.HTTPError as e:
+        # A client error, such as from a misconfigured logout URL, does
+        # not mean the endpoint is unavailable
+        if e.response is not None and e.response.status_code < 500:
+            breaker.record_success(time.time() - start)
+        else:
+            breaker.record_failure(time.time() - start)
+        raise
+    except requests.exceptions.RequestException:
+        breaker.release()
+        raise
+    breaker.record_success(time.time() - start)
+
+
+def get_sign_out_requests(tickets):
+    """
+    Return a list of ``(url, tickets)`` pairs for the single logout
+    requests to send for a list of ``ServiceTicket``s. Tickets for
+    services with ``LOGOUT_BATCH`` enabled are sent together in one
+    request to each logout URL, and other tickets are sent separately.
+    """
+    sign_out_requests = OrderedDict()
+    for ticket in tickets:
+        policy = get_service_policy(ticket.service)
+        if not policy.logout_allow:
+            continue
+        url = policy.logout_url or ticket.service
+        key = (url, None) if policy.logout_batch else (url, ticket.ticket)
+        sign_out_requests.setdefault(key, []).append(ticket)
+    return [(logout_url, batch) for (logout_url, ticket_id), batch in sign_out_requests.items()]
+
+
+def get_host_lanes(sign_out_requests, size):
+    """
+    Divide a list of ``(url, tickets)`` pairs into lanes of requests to
+    be sent one after another, with at most ``size`` lanes for each
+    host, so no host receives more than ``size`` requests at once.
+    """
+    hosts = OrderedDict()
+    for url, tickets in sign_out_requests:
+        hosts.setdefault(parse_url(url).netloc, []).append((url, tickets))
+    lanes = []
+    for host_requests in hosts.values():
+        count = min(size, len(host_requests)) if size else len(host_requests)
+        lanes.extend(host_requests[i::count] for i in range(count))
+    return lanes
+
+
+def send_sign_out_requests(sign_out_requests):
+    """
+    Send a list of ``(url, tickets)`` single logout requests one after
+    another, logging any failures.
+    """
+    for url, tickets in sign_out_requests:
+        try:
+            send_sign_out_request(url, tickets if len(tickets) > 1 else tickets[0])
+        except CircuitOpenError as e:
+            stats.incr('slo.skipped', len(tickets))
+            logger.warning("Single sign-out request to %s skipped: %s" % (url, e))
+        except requests.exceptions.RequestException as e:
+            logger.warning("Single sign-out request to %s returned %s" % (url, e))
+        else:
+            logger.debug("Single sign-out request sent to %s" % url)
+
+
 class ServiceTicketManager(TicketManager):
     def request_sign_out(self, user):
         """
@@ -212,26 +377,61 @@ class ServiceTicketManager(TicketManager):
         specified user. This is called at logout when single logout
         is enabled.
 
-        If gevent is installed, asynchronous requests will be sent.
-        Otherwise, synchronous requests will be sent. Setting
-        ``MAMA_CAS_ASYNC_CONCURRENCY`` limits concurrent requests for
-        a logout event to the specified value.
+        If ``MAMA_CAS_SLO_OUTBOX`` is set, the requests are queued as
+        ``SignOutMessage``s and sent by the ``signoutcas`` management
+        command instead.
+
+        Otherwise, the requests are sent as configured by
+        ``MAMA_CAS_SLO_DISPATCHER``: one at a time, by a pool of worker
+        threads or by gevent. The gevent dispatcher falls back to worker
+        threads if the process is not monkey-patched.
+        ``MAMA_CAS_ASYNC_CONCURRENCY`` sets the number of worker threads
+        shared by all logouts in the process, or the number of
+        greenlets for each logout, and ``MAMA_CAS_SLO_HOST_CONCURRENCY``
+        limits concurrent requests to each host. Concurrent requests
+        that have not finished within ``MAMA_CAS_SLO_DEADLINE`` seconds
+        are no longer waited for. Requests rejected by a full worker
+        thread queue are sent by the calling thread, and are not limited
+        by the deadline.
         """
-        def spawn(ticket, pool=None):
-            if pool is not None:
-                return pool.spawn(ticket.request_sign_out)
-            return gevent.spawn(ticket.request_sign_out)
+        tickets = list(self.backend.get_consumed_tickets(user, user.last_login))
 
-        tickets = list(self.filter(user=user, consumed__gte=user.last_login))
+        if getattr(settings, 'MAMA_CAS_SLO_OUTBOX', False):
+            SignOutMessage.objects.enqueue(tickets)
+            return
 
-        if gevent:
-            size = getattr(settings, 'MAMA_CAS_ASYNC_CONCURRENCY', 2)
-            pool = Pool(size) if size else None
-            sign_out_requests = [spawn(t, pool=pool) for t in tickets]
-            gevent.joinall(sign_out_requests)
+        dispatcher = getattr(settings, 'MAMA_CAS_SLO_DISPATCHER', 'sync')
+        if dispatcher not in ('sync', 'threads', 'gevent'):
+            raise ImproperlyConfigured("Unknown MAMA_CAS_SLO_DISPATCHER '%s'" % dispatcher)
+        if dispatcher == 'gevent' and not gevent:
+            raise ImproperlyConfigured("MAMA_CAS_SLO_DISPATCHER 'gevent' requires gevent to be installed")
+        if dispatcher == 'gevent' and not is_gevent_patched():
+            # Greenlets in an unpatched process would send the requests
+            # one after another
+            logger.warning("MAMA_CAS_SLO_DISPATCHER 'gevent' requires a monkey-patched process, "
+                           "sending single sign-out requests with 'threads' instead")
+            dispatcher = 'threads'
+
+        sign_out_requests = get_sign_out_requests(tickets)
+        stats.incr('slo.requests', len(sign_out_requests))
+        size = getattr(settings, 'MAMA_CAS_ASYNC_CONCURRENCY', 2)
+        lanes = get_host_lanes(sign_out_requests, getattr(settings, 'MAMA_CAS_SLO_HOST_CONCURRENCY', 2))
+        if dispatcher == 'gevent' or (dispatcher == 'threads' and size and len(lanes) > 1):
+            calls = [(send_sign_out_requests, (lane,)) for lane in lanes]
+            # Every lane is sent, even when the pool is saturated or the
+            # deadline passes before a lane has started
+            results = run_concurrently(calls, size, greenlets=dispatcher == 'gevent', name='slo',
+                                       timeout=getattr(settings, 'MAMA_CAS_SLO_DEADLINE', 10.0), run_all=True)
+            for lane, (finished, value, exc_info) in zip(lanes, results):
+                urls = ', '.join(url for url, tickets in lane)
+                if not finished:
+                    stats.incr('slo.timeouts', len(lane))
+                    logger.warning("Single sign-out requests to %s did not finish before the deadline" %
+                                   urls)
+                elif exc_info is not None:
+                    logger.error("Single sign-out requests to %s failed: %s" % (urls, exc_info[1]))
         else:
-            for ticket in tickets:
-                ticket.request_sign_out()
+            send_sign_out_requests(sign_out_requests)
 
 
 class ServiceTicket(Ticket):
@@ -247,7 +447,7 @@ class ServiceTicket(Ticket):
 
     objects = ServiceTicketManager()
 
-    class Meta:
+    class Meta(Ticket.Meta):
         verbose_name = _('service ticket')
         verbose_name_plural = _('service tickets')
 
@@ -266,17 +466,7 @@ class ServiceTicket(Ticket):
         Send a POST request to the ``ServiceTicket``s logout URL to
         request sign-out.
         """
-        if not get_config(self.service, 'LOGOUT_ALLOW'):
-            return
-        request = SingleSignOutRequest(context={'ticket': self})
-        url = get_config(self.service, 'LOGOUT_URL') or self.service
-        try:
-            resp = requests.post(url, data={'logoutRequest': request.render_content()})
-            resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logger.warning("Single sign-out request to %s returned %s" % (url, e))
-        else:
-            logger.debug("Single sign-out request sent to %s" % url)
+        send_sign_out_requests(get_sign_out_requests([self]))
 
 
 class ProxyTicket(Ticket):
@@ -292,7 +482,7 @@ class ProxyTicket(Ticket):
     granted_by_pgt = models.ForeignKey('ProxyGrantingTicket',
                                        verbose_name=_('granted by proxy-granting ticket'))
 
-    class Meta:
+    class Meta(Ticket.Meta):
         verbose_name = _('proxy ticket')
         verbose_name_plural = _('proxy tickets')
 
@@ -319,20 +509,20 @@ class ProxyGrantingTicketManager(TicketManager):
 
     def validate_callback(self, service, pgturl, pgtid, pgtiou):
         """Verify the provided proxy callback URL."""
-        if not get_config(service, 'PROXY_ALLOW'):
+        if not get_service_policy(service).proxy_allow:
             raise UnauthorizedServiceProxy("%s is not authorized to use proxy authentication" % service)
 
-        if not is_scheme_https(pgturl):
+        pgturl_parsed = parse_url(pgturl)
+        if not is_scheme_https(pgturl_parsed):
             raise InvalidProxyCallback("Proxy callback %s is not HTTPS" % pgturl)
 
         if not is_valid_proxy_callback(service, pgturl):
             raise InvalidProxyCallback("%s is not an authorized proxy callback URL" % pgturl)
 
         # Check the proxy callback URL and SSL certificate
-        pgturl_params = add_query_params(pgturl, {'pgtId': pgtid, 'pgtIou': pgtiou})
-        verify = os.environ.get('REQUESTS_CA_BUNDLE', True)
+        pgturl_params = add_query_params(pgturl_parsed, {'pgtId': pgtid, 'pgtIou': pgtiou})
         try:
-            r = requests.get(pgturl_params, verify=verify, timeout=3.0)
+            r = get_session().get(pgturl_params, timeout=get_timeout())
         except requests.exceptions.SSLError:
             msg = "SSL cert validation failed for proxy callback %s" % pgturl
             raise InvalidProxyCallback(msg)
@@ -372,10 +562,307 @@ class ProxyGrantingTicket(Ticket):
 
     objects = ProxyGrantingTicketManager()
 
-    class Meta:
+    class Meta(Ticket.Meta):
         verbose_name = _('proxy-granting ticket')
         verbose_name_plural = _('proxy-granting tickets')
 
     def is_consumed(self):
         """Check a ``ProxyGrantingTicket``s consumed state."""
         return self.consumed is not None
+
+
+@python_2_unicode_compatible
+class Service(models.Model):
+    """
+    A ``Service`` is a service URL pattern and its configuration, stored
+    in the database as an alternative to ``MAMA_CAS_VALID_SERVICES``.
+    Services are only used when ``MAMA_CAS_SERVICE_REGISTRY`` is enabled,
+    and are matched in ``position`` order after the services configured
+    in settings.
+    """
+    name = models.CharField(_('name'), max_length=255)
+    pattern = models.CharField(_('pattern'), max_length=255,
+                               help_text=_('A regular expression matching the service URL'))
+    position = models.PositiveIntegerField(_('position'), default=0)
+    enabled = models.BooleanField(_('enabled'), default=True)
+    proxy_allow = models.BooleanField(_('proxy allow'), default=False)
+    proxy_pattern = models.CharField(_('proxy pattern'), max_length=255, blank=True)
+    callbacks = models.TextField(_('callbacks'), blank=True,
+                                 help_text=_('Dotted paths to attribute callbacks, one per line'))
+    attributes = models.TextField(_('attributes'), blank=True,
+                                  help_text=_('Names of the attributes released, one per line. '
+                                              'Leave blank to release all attributes.'))
+    logout_allow = models.BooleanField(_('logout allow'), default=False)
+    logout_url = models.CharField(_('logout URL'), max_length=255, blank=True)
+    logout_batch = models.BooleanField(_('logout batch'), default=False,
+                                       help_text=_('Send one logout request with every session '
+                                                   'index for the logout URL'))
+
+    class Meta:
+        ordering = ('position', 'pk')
+        verbose_name = _('service')
+        verbose_name_plural = _('services')
+
+    def __str__(self):
+        return self.name
+
+    def clean(self):
+        for field in ('pattern', 'proxy_pattern'):
+            try:
+                re.compile(getattr(self, field))
+            except re.error as e:
+                raise FieldValidationError({field: _('Invalid regular expression: %s') % e})
+        for path in self.get_config()['CALLBACKS']:
+            try:
+                import_string(path)
+            except ImportError as e:
+                raise FieldValidationError({'callbacks': _('Invalid callback: %s') % e})
+
+    def get_config(self):
+        """
+        Return the configuration of this ``Service`` in the format of
+        ``MAMA_CAS_VALID_SERVICES``.
+        """
+        config = {
+            'SERVICE': self.pattern,
+            'PROXY_ALLOW': self.proxy_allow,
+            'CALLBACKS': [c.strip() for c in self.callbacks.splitlines() if c.strip()],
+            'LOGOUT_ALLOW': self.logout_allow,
+            'LOGOUT_URL': self.logout_url or None,
+            'LOGOUT_BATCH': self.logout_batch,
+        }
+        if self.proxy_pattern:
+            config['PROXY_PATTERN'] = self.proxy_pattern
+        attributes = [a.strip() for a in self.attributes.splitlines() if a.strip()]
+        if attributes:
+            config['ATTRIBUTES'] = attributes
+        return config
+
+
+class SignOutMessageManager(models.Manager):
+    def enqueue(self, tickets):
+        """
+        Queue a single logout request for each of the ``ServiceTicket``s
+        whose service allows single logout. The requests are inserted
+        with a single query.
+        """
+        messages = []
+        for ticket in tickets:
+            policy = get_service_policy(ticket.service)
+            if policy.logout_allow:
+                messages.append(self.model(url=policy.logout_url or ticket.service,
+                                           service=ticket.service, ticket=ticket.ticket))
+        self.bulk_create(messages)
+        stats.incr('slo.enqueued', len(messages))
+        return len(messages)
+
+    def pending(self):
+        """Return the messages that have not been dead-lettered."""
+        return self.filter(dead=False)
+
+    def due(self):
+        """Return the pending messages whose next attempt is due."""
+        return self.pending().filter(next_attempt__lte=now())
+
+    def get_lease(self, lease):
+        """
+        Return the number of seconds to lease claimed messages for,
+        which is at least as long as one request can take.
+        """
+        return max(lease, sum(get_timeout()) + 1)
+
+    def claim(self, batch_size=100, lease=60):
+        """
+        Claim up to ``batch_size`` due messages for delivery, and return
+        them. Claimed messages are not due again for ``lease`` seconds,
+        so concurrent workers do not send the same message while it is
+        being delivered.
+
+        The batch is claimed with a single ``UPDATE`` that marks the
+        messages with a random lease token, and the messages are then
+        selected by that token.
+        """
+        pks = list(self.due().order_by('next_attempt', 'pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return []
+        token = get_random_string(32)
+        # Only the messages still due are claimed, so messages claimed
+        # by another worker in the meantime are skipped
+        self.due().filter(pk__in=pks).update(next_attempt=now() + timedelta(seconds=self.get_lease(lease)),
+                                             lease=token)
+        return list(self.filter(lease=token).order_by('pk'))
+
+    def group(self, messages):
+        """
+        Return a list of ``(url, messages)`` pairs for the requests to
+        send for a list of messages. Messages for services with
+        ``LOGOUT_BATCH`` enabled are sent together in one request to
+        each logout URL, and other messages are sent separately.
+        """
+        groups = OrderedDict()
+        for message in messages:
+            if get_service_policy(message.service).logout_batch:
+                key = (message.url, None)
+            else:
+                key = (message.url, message.pk)
+            groups.setdefault(key, []).append(message)
+        return [(logout_url, batch) for (logout_url, message_pk), batch in groups.items()]
+
+    def send(self, url, messages):
+        """
+        Send one single logout request for a list of messages to a URL.
+        The messages are deleted if the request was delivered, and
+        otherwise scheduled to be retried or marked as dead. Return
+        ``True`` if the request was delivered.
+        """
+        try:
+            send_sign_out_request(url, messages if len(messages) > 1 else messages[0])
+        except CircuitOpenError:
+            delay = get_breaker(url).get_retry_delay()
+            for message in messages:
+                message.defer(delay)
+            return False
+        except requests.exceptions.RequestException as e:
+            for message in messages:
+                message.fail(e)
+            return False
+        logger.debug("Single sign-out request sent to %s" % url)
+        stats.incr('slo.delivered', len(messages))
+        self.filter(pk__in=[message.pk for message in messages]).delete()
+        return True
+
+    def renew(self, messages, lease=60):
+        """
+        Extend the lease of claimed messages by ``lease`` seconds, and
+        return those still held by the claim. Messages whose lease
+        expired and that were claimed by another worker are omitted.
+        """
+        pks = [message.pk for message in messages]
+        held = self.filter(pk__in=pks, lease=messages[0].lease)
+        count = held.update(next_attempt=now() + timedelta(seconds=self.get_lease(lease)))
+        if count == len(messages):
+            return messages
+        held_pks = set(held.values_list('pk', flat=True))
+        return [message for message in messages if message.pk in held_pks]
+
+    def deliver(self, batch_size=100, lease=60):
+        """
+        Claim and send a batch of due messages. Return the number of
+        messages attempted.
+
+        The lease is renewed before each request, as sending a whole
+        batch can take longer than the lease, so a message is not sent
+        again by another worker while the batch is being delivered.
+        """
+        messages = self.claim(batch_size=batch_size, lease=lease)
+        for url, batch in self.group(messages):
+            batch = self.renew(batch, lease)
+            if batch:
+                self.send(url, batch)
+        return len(messages)
+
+    def get_queue_depth(self):
+        """
+        Return the number of pending messages, the number of those that
+        are due and the number of dead-lettered messages.
+        """
+        return {
+            'pending': self.pending().count(),
+            'due': self.due().count(),
+            'dead': self.filter(dead=True).count(),
+        }
+
+    def requeue(self, messages=None):
+        """
+        Return dead-lettered messages, or the specified queryset of
+        messages, to the queue to be sent again.
+        """
+        if messages is None:
+            messages = self.filter(dead=True)
+        return messages.update(dead=False, attempts=0, next_attempt=now())
+
+
+@python_2_unicode_compatible
+class SignOutMessage(models.Model):
+    """
+    A ``SignOutMessage`` is a single logout request queued for delivery
+    to a service, when ``MAMA_CAS_SLO_OUTBOX`` is enabled. Messages for
+    services with ``LOGOUT_BATCH`` enabled are delivered together in one
+    request to each logout URL. Messages are deleted once delivered.
+    Failed deliveries are retried with an exponential backoff, and after
+    ``MAMA_CAS_SLO_MAX_ATTEMPTS`` attempts the message is marked as dead
+    and kept for inspection.
+    """
+    url = models.CharField(_('url'), max_length=255)
+    service = models.CharField(_('service'), max_length=255)
+    ticket = models.CharField(_('ticket'), max_length=255)
+    created = models.DateTimeField(_('created'), default=now)
+    next_attempt = models.DateTimeField(_('next attempt'), default=now)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    dead = models.BooleanField(_('dead'), default=False)
+    last_error = models.TextField(_('last error'), blank=True)
+    lease = models.CharField(_('lease'), max_length=32, blank=True, db_index=True)
+
+    objects = SignOutMessageManager()
+
+    class Meta:
+        index_together = [['dead', 'next_attempt']]
+        verbose_name = _('single logout message')
+        verbose_name_plural = _('single logout messages')
+
+    def __str__(self):
+        return self.ticket
+
+    def get_retry_delay(self):
+        """
+        Return the delay in seconds before the next attempt, doubling
+        with each failed attempt up to ``MAMA_CAS_SLO_RETRY_MAX_DELAY``.
+        """
+        delay = getattr(settings, 'MAMA_CAS_SLO_RETRY_DELAY', 30)
+        max_delay = getattr(settings, 'MAMA_CAS_SLO_RETRY_MAX_DELAY', 3600)
+        return min(delay * 2 ** (self.attempts - 1), max_delay)
+
+    def send(self):
+        """
+        Send the single logout request. The message is deleted if it
+        was delivered, and otherwise scheduled to be retried or marked
+        as dead. Return ``True`` if the message was delivered.
+        """
+        return SignOutMessage.objects.send(self.url, [self])
+
+    def defer(self, delay):
+        """
+        Postpone the message by ``delay`` seconds without counting an
+        attempt, as the circuit for its URL is open.
+        """
+        self.next_attempt = now() + timedelta(seconds=delay)
+        self.save(update_fields=['next_attempt'])
+        stats.incr('slo.deferred')
+
+    def fail(self, error):
+        """Record a failed delivery attempt."""
+        self.attempts += 1
+        self.last_error = force_text(error)
+        if self.attempts >= getattr(settings, 'MAMA_CAS_SLO_MAX_ATTEMPTS', 5):
+            self.dead = True
+            stats.incr('slo.dead')
+            logger.error("Single sign-out request to %s failed %d times and was dead-lettered: %s" %
+                         (self.url, self.attempts, error))
+        else:
+            self.next_attempt = now() + timedelta(seconds=self.get_retry_delay())
+            stats.incr('slo.retries')
+            logger.warning("Single sign-out request to %s returned %s" % (self.url, error))
+        self.save(update_fields=['attempts', 'last_error', 'dead', 'next_attempt'])
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def service_changed(sender, **kwargs):
+    """
+    Reload the service registry in every process once the change has
+    been committed, so no process reloads the services before the
+    change is visible to it.
+    """
+    # Django 1.8 has no on_commit(), so reload immediately
+    on_commit = getattr(transaction, 'on_commit', lambda func: func())
+    on_commit(service_config.reload)
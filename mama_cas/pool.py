@@ -0,0 +1,247 @@
+"""
+Bounded pools for running blocking calls concurrently. When gevent is
+installed and has patched the process, greenlets are used. Otherwise, a
+fixed number of worker threads is started for each named pool and size,
+and shared by the process. Separate names keep slow calls of one kind,
+such as single logout requests, from holding the workers used by
+another. At most ``MAMA_CAS_POOL_QUEUE_SIZE`` calls wait for a
+worker thread, and further calls are rejected rather than queued.
+
+Threads cannot be cancelled, so a worker held by a call its caller has
+stopped waiting for is replaced with a new worker, up to
+``MAMA_CAS_POOL_MAX_REPLACEMENTS`` at once for each pool. The held
+worker exits once its call returns.
+"""
+import logging
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.six.moves import queue
+
+from mama_cas import stats
+from mama_cas.compat import gevent
+
+if gevent:
+    from gevent import monkey
+    from gevent.pool import Pool as GeventPool
+
+
+logger = logging.getLogger(__name__)
+
+
+class Task(object):
+    """The pending result of a call submitted to a ``ThreadPool``."""
+    def __init__(self, func, args, deadline=None):
+        self.func = func
+        self.args = args
+        self.deadline = deadline
+        self.started = None
+        self.done = False
+        self.replaced = False
+        self.value = None
+        self.exc_info = None
+        self.start_event = threading.Event()
+        self.event = threading.Event()
+
+    def run(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            # The caller is no longer waiting for the result
+            stats.incr('pool.expired')
+            self.event.set()
+            return
+        self.started = time.time()
+        self.start_event.set()
+        try:
+            self.value = self.func(*self.args)
+            self.done = True
+        except Exception:
+            # Keep the traceback, so the caller can raise it again
+            self.exc_info = sys.exc_info()
+            self.done = True
+        finally:
+            self.event.set()
+
+    def wait_started(self, timeout=None):
+        """Wait for the call to start. Return ``True`` if it started."""
+        return self.start_event.wait(timeout)
+
+    def wait(self, timeout=None):
+        """Wait for the call to finish. Return ``True`` if it finished."""
+        return self.event.wait(timeout) and self.done
+
+
+class ThreadPool(object):
+    """
+    A fixed number of daemon worker threads taking calls from a queue
+    holding at most ``maxsize`` calls. Each worker closes its database
+    connection after every call, as the worker threads outlive any
+    single request. At most ``replacements`` workers held by abandoned
+    calls are replaced at once.
+    """
+    def __init__(self, size, maxsize=0, name='default', replacements=0):
+        self.size = size
+        self.name = name
+        self.replacements = replacements
+        self.replaced = 0
+        self.started = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize)
+        for i in range(size):
+            self.start_worker()
+
+    def start_worker(self):
+        worker = threading.Thread(target=self.work, name='mama_cas-%s-worker-%d' % (self.name, self.started))
+        worker.daemon = True
+        worker.start()
+        self.started += 1
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                task.run()
+            finally:
+                connection.close()
+            with self.lock:
+                if task.replaced:
+                    # Another worker took the place of this one while
+                    # the call was abandoned
+                    self.replaced -= 1
+                    return
+
+    def submit(self, func, args, deadline=None):
+        """
+        Queue a call and return its ``Task``. If the queue is full,
+        return ``None`` without queueing the call.
+        """
+        task = Task(func, args, deadline)
+        try:
+            self.queue.put_nowait(task)
+        except queue.Full:
+            stats.incr('pool.rejected')
+            return None
+        return task
+
+    def abandon(self, task):
+        """
+        Start a worker to replace the one running a ``Task`` its caller
+        has stopped waiting for, unless ``replacements`` workers have
+        already been replaced. The number of workers returns to ``size``
+        as abandoned calls return.
+        """
+        with self.lock:
+            if task.started is None or task.event.is_set() or task.replaced:
+                return
+            if self.replaced >= self.replacements:
+                stats.incr('pool.stuck')
+                logger.warning("Worker in pool %s is held by an abandoned call and cannot be replaced" %
+                               self.name)
+                return
+            task.replaced = True
+            self.replaced += 1
+            self.start_worker()
+        stats.incr('pool.replaced')
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_thread_pool(size, name='default'):
+    """
+    Return the process-wide ``ThreadPool`` with the given name and
+    ``size`` workers.
+    """
+    with _pools_lock:
+        try:
+            return _pools[(name, size)]
+        except KeyError:
+            pool = _pools[(name, size)] = ThreadPool(size, getattr(settings, 'MAMA_CAS_POOL_QUEUE_SIZE', 100), name,
+                                                     getattr(settings, 'MAMA_CAS_POOL_MAX_REPLACEMENTS', 10))
+            return pool
+
+
+def is_gevent_patched():
+    """
+    Return ``True`` if gevent is installed and the server has patched
+    the socket module, so greenlets can run blocking calls concurrently.
+    MamaCAS never patches the process itself.
+    """
+    return bool(gevent) and monkey.is_module_patched('socket')
+
+
+def run_concurrently(calls, size, timeout=None, greenlets=None, name='default', run_all=False,
+                     call_timeout=None):
+    """
+    Run a list of ``(func, args)`` calls with up to ``size`` running at
+    once, waiting up to ``timeout`` seconds for all of them to finish.
+    Return a list of ``(finished, value, exc_info)`` tuples in the
+    order of the calls, where ``exc_info`` is the ``sys.exc_info()`` of
+    an exception raised by the call. Calls that have not finished in
+    time are left running and reported as unfinished. Calls rejected by
+    a full thread pool are reported as unfinished without waiting for
+    them, and calls still queued when the time is up are skipped.
+
+    If ``call_timeout`` is set, ``timeout`` only limits the wait for a
+    call to start, and each call is waited for up to ``call_timeout``
+    seconds from when it starts.
+
+    If ``run_all`` is ``True``, no call is dropped: calls rejected by a
+    full thread pool are run in the calling thread, and queued calls are
+    run even after the time is up. Calls run in the calling thread are
+    not limited by ``timeout``, and are counted by ``mama_cas.stats``
+    as ``pool.inline``.
+
+    If ``greenlets`` is ``True``, the calls are run by gevent, and a
+    ``size`` of zero does not limit them. Greenlets are killed once they
+    exceed ``call_timeout``. By default, gevent is used if it has patched
+    the process. Otherwise, the calls are run by the thread pool with
+    the given ``name``.
+    """
+    if greenlets is None:
+        greenlets = is_gevent_patched()
+    deadline = time.time() + timeout if timeout is not None else None
+
+    def remaining():
+        if deadline is None:
+            return None
+        return max(deadline - time.time(), 0)
+
+    if greenlets:
+        pool = GeventPool(size or None)
+        tasks = [Task(func, args) for func, args in calls]
+        if call_timeout is None:
+            spawned = [pool.spawn(task.run) for task in tasks]
+            gevent.joinall(spawned, timeout=remaining())
+        else:
+            spawned = [pool.spawn(gevent.with_timeout, call_timeout, task.run, timeout_value=None)
+                       for task in tasks]
+            gevent.joinall(spawned)
+        return [(task.done, task.value, task.exc_info) for task in tasks]
+
+    pool = get_thread_pool(size, name)
+    tasks = [pool.submit(func, args, None if run_all else deadline) for func, args in calls]
+    results = []
+    for (func, args), task in zip(calls, tasks):
+        if task is None:
+            if run_all:
+                stats.incr('pool.inline')
+                task = Task(func, args)
+                task.run()
+                results.append((True, task.value, task.exc_info))
+            else:
+                results.append((False, None, None))
+            continue
+        if call_timeout is None:
+            finished = task.wait(remaining())
+        elif task.wait_started(remaining()):
+            finished = task.wait(max(task.started + call_timeout - time.time(), 0))
+        else:
+            finished = False
+        if not finished:
+            pool.abandon(task)
+        results.append((finished, task.value, task.exc_info))
+    return results
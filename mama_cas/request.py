@@ -40,20 +40,24 @@ class SingleSignOutRequest(CasRequestBase):
         <saml:NameID>@NOT_USED@</saml:NameID>
         <samlp:SessionIndex>[SESSION IDENTIFIER]</samlp:SessionIndex>
     </samlp:LogoutRequest>
+
+    If the context contains a list of ``tickets``, a batched request is
+    rendered with a ``SessionIndex`` for each ticket.
     """
     prefixes = {'samlp': 'urn:oasis:names:tc:SAML:2.0:protocol',
                 'saml': 'urn:oasis:names:tc:SAML:2.0:assertion'}
 
     def render_content(self):
-        ticket = self.context.get('ticket')
+        tickets = self.context.get('tickets') or [self.context.get('ticket')]
 
         logout_request = etree.Element(self.ns('samlp', 'LogoutRequest'))
         logout_request.set('ID', get_random_string(length=32))
         logout_request.set('Version', '2.0')
         logout_request.set('IssueInstant', self.instant())
         etree.SubElement(logout_request, self.ns('saml', 'NameID'))
-        session_index = etree.SubElement(logout_request, self.ns('samlp', 'SessionIndex'))
-        session_index.text = ticket.ticket
+        for ticket in tickets:
+            session_index = etree.SubElement(logout_request, self.ns('samlp', 'SessionIndex'))
+            session_index.text = ticket.ticket
 
         return etree.tostring(logout_request)
 
@@ -1,12 +1,32 @@
 import datetime
+import json
 
 from django.http import HttpResponse
 from django.utils.crypto import get_random_string
+from django.utils.encoding import force_bytes
 from django.utils.encoding import force_text
 
 from .compat import etree
 
 
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+
+# Serialized failure envelopes, keyed by response class and error code
+_failures = {}
+
+
+def escape_text(text):
+    """Escape a value for use as XML character data, encoded as UTF-8."""
+    text = force_text(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text.encode('utf-8')
+
+
+def escape_attrib(text):
+    """Escape a value for use as an XML attribute value, encoded as UTF-8."""
+    text = escape_text(text).decode('utf-8')
+    return text.replace('"', '&quot;').replace('\n', '&#10;').encode('utf-8')
+
+
 class CasResponseBase(HttpResponse):
     """
     Base class for CAS 2.0 XML format responses.
@@ -15,7 +35,6 @@ class CasResponseBase(HttpResponse):
     uri = 'http://www.yale.edu/tp/cas'
 
     def __init__(self, context, **kwargs):
-        etree.register_namespace(self.prefix, self.uri)
         content = self.render_content(context)
         super(CasResponseBase, self).__init__(content, **kwargs)
 
@@ -26,6 +45,55 @@ class CasResponseBase(HttpResponse):
         """
         return etree.QName(self.uri, tag)
 
+    def tag(self, name):
+        """Return the prefixed name of an XML tag, encoded as UTF-8."""
+        return force_bytes('%s:%s' % (self.prefix, name))
+
+    def element(self, name, text, code=None):
+        """
+        Serialize an XML element containing only text, with an optional
+        ``code`` attribute, matching the output of ``etree.tostring()``.
+        """
+        tag = self.tag(name)
+        start = b'<' + tag
+        if code is not None:
+            start += b' code="' + escape_attrib(code) + b'"'
+        text = escape_text(text)
+        if not text:
+            return start + b' />'
+        return start + b'>' + text + b'</' + tag + b'>'
+
+    def serialize(self, children):
+        """
+        Serialize a service response envelope around a list of
+        serialized child elements.
+        """
+        tag = self.tag('serviceResponse')
+        start = XML_DECLARATION + b'<' + tag + b' xmlns:' + force_bytes(self.prefix) + \
+            b'="' + force_bytes(self.uri) + b'"'
+        if not children:
+            return start + b' />'
+        return start + b'>' + b''.join(children) + b'</' + tag + b'>'
+
+    def serialize_failure(self, error):
+        """
+        Serialize a service response for a validation error, within a
+        ``failure_tag`` element. The envelope is serialized once for
+        each error code, so only the error message is escaped for each
+        response.
+        """
+        text = escape_text(error)
+        if not text:
+            return self.serialize([self.element(self.failure_tag, text, code=error.code)])
+        key = (self.__class__, error.code)
+        try:
+            start, end = _failures[key]
+        except KeyError:
+            # Split the envelope around a placeholder for the message
+            envelope = self.serialize([self.element(self.failure_tag, '\0', code=error.code)])
+            start, end = _failures[key] = tuple(envelope.split(b'\0'))
+        return start + text + end
+
 
 class ValidationResponse(CasResponseBase):
     """
@@ -53,6 +121,8 @@ class ValidationResponse(CasResponseBase):
         </cas:authenticationFailure>
     </cas:serviceResponse>
     """
+    failure_tag = 'authenticationFailure'
+
     def render_content(self, context):
         ticket = context.get('ticket')
         error = context.get('error')
@@ -60,30 +130,27 @@ class ValidationResponse(CasResponseBase):
         pgt = context.get('pgt')
         proxies = context.get('proxies')
 
-        service_response = etree.Element(self.ns('serviceResponse'))
+        children = []
         if ticket:
-            auth_success = etree.SubElement(service_response, self.ns('authenticationSuccess'))
-            user = etree.SubElement(auth_success, self.ns('user'))
-            user.text = ticket.user.get_username()
+            children.append(b'<' + self.tag('authenticationSuccess') + b'>')
+            children.append(self.element('user', ticket.user.get_username()))
             if attributes:
-                attribute_set = etree.SubElement(auth_success, self.ns('attributes'))
+                children.append(b'<' + self.tag('attributes') + b'>')
                 for name, value in attributes.items():
-                    attr = etree.SubElement(attribute_set, self.ns(name))
-                    attr.text = force_text(value)
+                    children.append(self.element(name, value))
+                children.append(b'</' + self.tag('attributes') + b'>')
             if pgt:
-                proxy_granting_ticket = etree.SubElement(auth_success, self.ns('proxyGrantingTicket'))
-                proxy_granting_ticket.text = pgt.iou
+                children.append(self.element('proxyGrantingTicket', pgt.iou))
             if proxies:
-                proxy_list = etree.SubElement(auth_success, self.ns('proxies'))
+                children.append(b'<' + self.tag('proxies') + b'>')
                 for p in proxies:
-                    proxy = etree.SubElement(proxy_list, self.ns('proxy'))
-                    proxy.text = p
+                    children.append(self.element('proxy', p))
+                children.append(b'</' + self.tag('proxies') + b'>')
+            children.append(b'</' + self.tag('authenticationSuccess') + b'>')
         elif error:  # pragma: no branch
-            auth_failure = etree.SubElement(service_response, self.ns('authenticationFailure'))
-            auth_failure.set('code', error.code)
-            auth_failure.text = str(error)
+            return self.serialize_failure(error)
 
-        return etree.tostring(service_response, encoding='UTF-8')
+        return self.serialize(children)
 
 
 class ProxyResponse(CasResponseBase):
@@ -107,21 +174,104 @@ class ProxyResponse(CasResponseBase):
         </cas:proxyFailure>
     </cas:serviceResponse>
     """
+    failure_tag = 'proxyFailure'
+
     def render_content(self, context):
         ticket = context.get('ticket')
         error = context.get('error')
 
-        service_response = etree.Element(self.ns('serviceResponse'))
+        children = []
         if ticket:
-            proxy_success = etree.SubElement(service_response, self.ns('proxySuccess'))
-            proxy_ticket = etree.SubElement(proxy_success, self.ns('proxyTicket'))
-            proxy_ticket.text = ticket.ticket
+            children.append(b'<' + self.tag('proxySuccess') + b'>')
+            children.append(self.element('proxyTicket', ticket.ticket))
+            children.append(b'</' + self.tag('proxySuccess') + b'>')
         elif error:  # pragma: no branch
-            proxy_failure = etree.SubElement(service_response, self.ns('proxyFailure'))
-            proxy_failure.set('code', error.code)
-            proxy_failure.text = str(error)
+            return self.serialize_failure(error)
 
-        return etree.tostring(service_response, encoding='UTF-8')
+        return self.serialize(children)
+
+
+class CasJsonResponseBase(HttpResponse):
+    """
+    Base class for CAS 3.0 JSON format responses, requested with the
+    ``format=JSON`` parameter.
+    """
+    encoder = json.JSONEncoder(separators=(',', ':'), default=force_text)
+
+    def __init__(self, context, **kwargs):
+        content = self.encoder.encode({'serviceResponse': self.render_content(context)})
+        super(CasJsonResponseBase, self).__init__(content, **kwargs)
+
+    def failure(self, error):
+        """Return the error code and description of a validation failure."""
+        return {'code': error.code, 'description': force_text(error)}
+
+
+class ValidationJsonResponse(CasJsonResponseBase):
+    """
+    (2.5.2) Render a JSON format CAS service response for a ticket
+    validation success or failure.
+
+    On validation success:
+
+    {"serviceResponse": {"authenticationSuccess": {
+        "user": "username",
+        "proxyGrantingTicket": "PGTIOU-84678-8a9d...",
+        "proxies": ["https://proxy2/pgtUrl", "https://proxy1/pgtUrl"],
+        "attributes": {"email": "ellen@example.com"}}}}
+
+    On validation failure:
+
+    {"serviceResponse": {"authenticationFailure": {
+        "code": "INVALID_TICKET",
+        "description": "ticket PT-1856376-1HMgO86Z2ZKeByc5XdYD not recognized"}}}
+    """
+    def render_content(self, context):
+        ticket = context.get('ticket')
+        error = context.get('error')
+        attributes = context.get('attributes')
+        pgt = context.get('pgt')
+        proxies = context.get('proxies')
+
+        if ticket:
+            auth_success = {'user': ticket.user.get_username()}
+            if attributes:
+                auth_success['attributes'] = attributes
+            if pgt:
+                auth_success['proxyGrantingTicket'] = pgt.iou
+            if proxies:
+                auth_success['proxies'] = list(proxies)
+            return {'authenticationSuccess': auth_success}
+        elif error:  # pragma: no branch
+            return {'authenticationFailure': self.failure(error)}
+        return {}
+
+
+class ProxyJsonResponse(CasJsonResponseBase):
+    """
+    (2.7.2) Render a JSON format CAS service response for a proxy
+    request success or failure.
+
+    On request success:
+
+    {"serviceResponse": {"proxySuccess": {
+        "proxyTicket": "PT-1856392-b98xZrQN4p90ASrw96c8"}}}
+
+    On request failure:
+
+    {"serviceResponse": {"proxyFailure": {
+        "code": "INVALID_REQUEST",
+        "description": "'pgt' and 'targetService' parameters are both required"}}}
+    """
+    def render_content(self, context):
+        ticket = context.get('ticket')
+        error = context.get('error')
+
+        if ticket:
+            return {'proxySuccess': {'proxyTicket': ticket.ticket}}
+        elif error:  # pragma: no branch
+            return {'proxyFailure': self.failure(error)}
+        return {}
 
 
 class SamlValidationResponse(CasResponseBase):
@@ -259,3 +409,9 @@ class SamlValidationResponse(CasResponseBase):
         method = etree.SubElement(subject_confirmation, 'ConfirmationMethod')
         method.text = self.confirmation_method
         return subject
+
+
+# The namespace registry is global, so the prefixes used when building
+# responses with ElementTree are registered once
+etree.register_namespace(CasResponseBase.prefix, CasResponseBase.uri)
+etree.register_namespace(SamlValidationResponse.prefix, SamlValidationResponse.uri)
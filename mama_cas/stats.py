@@ -0,0 +1,71 @@
+"""
+In-process counters and histograms for monitoring MamaCAS. Values are
+kept for the lifetime of each server process and are not shared between
+processes.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_histograms = {}
+
+
+def incr(name, value=1):
+    """Increment the named counter by ``value``."""
+    with _lock:
+        _counters[name] += value
+
+
+def get(name):
+    """Return the current value of the named counter."""
+    return _counters.get(name, 0)
+
+
+def snapshot():
+    """Return a dictionary of all counter values."""
+    with _lock:
+        return dict(_counters)
+
+
+def observe(name, value):
+    """Record a value, such as a duration in seconds, in the named histogram."""
+    with _lock:
+        try:
+            histogram = _histograms[name]
+        except KeyError:
+            histogram = _histograms[name] = {'count': 0, 'sum': 0.0,
+                                             'buckets': [0] * len(BUCKETS)}
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['buckets'][bisect_left(BUCKETS, value)] += 1
+
+
+def get_histogram(name):
+    """
+    Return a dictionary of the count and sum of values recorded in the
+    named histogram, and a list of ``(upper bound, count)`` tuples for
+    each bucket.
+    """
+    with _lock:
+        histogram = _histograms.get(name, {'count': 0, 'sum': 0.0,
+                                           'buckets': [0] * len(BUCKETS)})
+        return {'count': histogram['count'], 'sum': histogram['sum'],
+                'buckets': list(zip(BUCKETS, histogram['buckets']))}
+
+
+def histograms():
+    """Return a dictionary of all histograms."""
+    return dict((name, get_histogram(name)) for name in list(_histograms))
+
+
+def reset():
+    """Reset all counters and histograms."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
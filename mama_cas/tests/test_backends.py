@@ -0,0 +1,312 @@
+import time
+
+from mock import patch
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.timezone import now
+
+from .factories import ConsumedServiceTicketFactory
+from .factories import ExpiredServiceTicketFactory
+from .factories import ProxyGrantingTicketFactory
+from .factories import ProxyTicketFactory
+from .factories import ServiceTicketFactory
+from .factories import UserFactory
+from mama_cas.backends import CacheTicketBackend
+from mama_cas.backends import DatabaseTicketBackend
+from mama_cas.models import ProxyGrantingTicket
+from mama_cas.models import ProxyTicket
+from mama_cas.models import ServiceTicket
+from mama_cas.exceptions import InvalidService
+from mama_cas.exceptions import InvalidTicket
+
+
+class DatabaseTicketBackendTests(TestCase):
+    """
+    Test the ``DatabaseTicketBackend`` ticket backend.
+    """
+    def test_default_backend(self):
+        """
+        When no backend is configured, tickets should be stored in
+        the database.
+        """
+        self.assertIsInstance(ServiceTicket.objects.backend, DatabaseTicketBackend)
+        st = ServiceTicketFactory()
+        self.assertTrue(ServiceTicket.objects.filter(ticket=st.ticket).exists())
+
+
+@override_settings(MAMA_CAS_TICKET_BACKEND='mama_cas.backends.CacheTicketBackend')
+class CacheTicketBackendTests(TestCase):
+    """
+    Test the ``CacheTicketBackend`` ticket backend.
+    """
+    url = 'http://www.example.com/'
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserFactory()
+
+    def test_backend(self):
+        """
+        The configured backend should be used by each ticket manager.
+        """
+        self.assertIsInstance(ServiceTicket.objects.backend, CacheTicketBackend)
+        self.assertIsInstance(ProxyTicket.objects.backend, CacheTicketBackend)
+        self.assertIsInstance(ProxyGrantingTicket.objects.backend, CacheTicketBackend)
+
+    def test_create_ticket(self):
+        """
+        A ticket ought to be created without touching the database.
+        """
+        st = ServiceTicketFactory()
+        self.assertEqual(ServiceTicket.objects.count(), 0)
+        self.assertEqual(ServiceTicket.objects.backend.get(st.ticket).user, self.user)
+
+    def test_validate_ticket(self):
+        """
+        Validation ought to succeed when provided with a valid ticket
+        string. The ticket ought to be consumed in the process.
+        """
+        st = ServiceTicketFactory()
+        ticket = ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+        self.assertEqual(ticket.ticket, st.ticket)
+        self.assertIsNotNone(ticket.consumed)
+        self.assertIsNotNone(ServiceTicket.objects.backend.get(st.ticket).consumed)
+
+    def test_validate_ticket_twice(self):
+        """
+        A ticket ought to validate successfully only once.
+        """
+        st = ServiceTicketFactory()
+        ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+        with self.assertRaises(InvalidTicket):
+            ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+
+    def test_validate_ticket_consumed_ticket(self):
+        """
+        The validation process ought to fail when a consumed ticket
+        is provided.
+        """
+        st = ConsumedServiceTicketFactory()
+        with self.assertRaises(InvalidTicket):
+            ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+
+    def test_validate_ticket_does_not_exist(self):
+        """
+        The validation process ought to fail when a valid ticket string
+        cannot be found in the cache.
+        """
+        ticket = 'ST-0000000000-aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'
+        with self.assertRaises(InvalidTicket):
+            ServiceTicket.objects.validate_ticket(ticket, self.url)
+
+    def test_consume(self):
+        """
+        Consuming a ticket should only succeed once.
+        """
+        st = ServiceTicketFactory()
+        self.assertTrue(st.consume())
+        self.assertFalse(ServiceTicket.objects.backend.get(st.ticket).consume())
+
+    def test_consume_tickets(self):
+        """
+        All tickets belonging to the specified user should be consumed.
+        """
+        st1 = ServiceTicketFactory()
+        st2 = ServiceTicketFactory()
+        ServiceTicket.objects.consume_tickets(self.user)
+        self.assertTrue(ServiceTicket.objects.backend.get(st1.ticket).is_consumed())
+        self.assertTrue(ServiceTicket.objects.backend.get(st2.ticket).is_consumed())
+
+    def test_index_counter_evicted(self):
+        """
+        When an index counter is evicted before it is incremented, the
+        ticket should still be created and indexed without overwriting
+        existing index entries.
+        """
+        backend = ServiceTicket.objects.backend
+        st1 = ServiceTicketFactory()
+        incr = backend.cache.incr
+
+        def evict(key, *args, **kwargs):
+            backend.cache.delete(key)
+            mock.side_effect = incr
+            return incr(key, *args, **kwargs)
+
+        with patch.object(backend.cache, 'incr', side_effect=evict) as mock:
+            st2 = ServiceTicketFactory()
+        st3 = ServiceTicketFactory()
+        tickets = set(t.ticket for t in backend.get_user_tickets(self.user))
+        self.assertEqual(tickets, set([st1.ticket, st2.ticket, st3.ticket]))
+
+    def test_proxy_ticket_chain(self):
+        """
+        Proxy tickets and proxy-granting tickets ought to keep their
+        relationships when stored in the cache.
+        """
+        pt = ProxyTicketFactory()
+        ticket = ProxyTicket.objects.validate_ticket(pt.ticket, self.url)
+        self.assertEqual(ticket.granted_by_pgt.ticket, pt.granted_by_pgt.ticket)
+        self.assertEqual(ProxyGrantingTicket.objects.count(), 0)
+
+    def test_validate_proxy_granting_ticket(self):
+        """
+        A proxy-granting ticket should validate without being consumed.
+        """
+        pgt = ProxyGrantingTicketFactory()
+        ticket = ProxyGrantingTicket.objects.validate_ticket(pgt.ticket, 'https://www.example.com')
+        self.assertFalse(ticket.is_consumed())
+
+    @override_settings(MAMA_CAS_ENABLE_SINGLE_SIGN_OUT=True)
+    def test_request_sign_out(self):
+        """
+        Single logout requests should be sent for consumed tickets
+        stored in the cache.
+        """
+        ConsumedServiceTicketFactory()
+        ConsumedServiceTicketFactory()
+        with patch('requests.Session.post') as mock:
+            mock.return_value.status_code = 200
+            ServiceTicket.objects.request_sign_out(self.user)
+            self.assertEqual(mock.call_count, 2)
+
+    @override_settings(MAMA_CAS_ENABLE_SINGLE_SIGN_OUT=True)
+    def test_request_sign_out_after_expiry(self):
+        """
+        Single logout requests should be sent for consumed tickets
+        after the tickets themselves have expired.
+        """
+        since = now()
+        st = ServiceTicketFactory()
+        ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+        with patch('time.time', return_value=time.time() + 600):
+            self.assertEqual(len(ServiceTicket.objects.backend.get_consumed_tickets(self.user, since)), 1)
+
+
+@override_settings(MAMA_CAS_TICKET_BACKEND='mama_cas.backends.SignedTicketBackend')
+class SignedTicketBackendTests(TestCase):
+    """
+    Test the ``SignedTicketBackend`` ticket backend.
+    """
+    url = 'http://www.example.com/'
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserFactory()
+
+    def test_create_ticket(self):
+        """
+        A signed service ticket ought to be created without touching
+        the database or the cache.
+        """
+        with patch.object(cache, 'set') as mock:
+            st = ServiceTicketFactory()
+            self.assertEqual(mock.call_count, 0)
+        self.assertTrue(st.ticket.startswith('ST-'))
+        self.assertTrue(ServiceTicket.objects.backend.is_valid_format(st.ticket))
+        self.assertEqual(ServiceTicket.objects.count(), 0)
+
+    def test_validate_ticket(self):
+        """
+        Validation ought to succeed when provided with a valid signed
+        ticket, restoring the user, service and primary flag.
+        """
+        st = ServiceTicketFactory(primary=True)
+        with self.assertNumQueries(1):
+            ticket = ServiceTicket.objects.validate_ticket(st.ticket, self.url, renew=True)
+        self.assertEqual(ticket.user, self.user)
+        self.assertEqual(ticket.service, self.url)
+        self.assertTrue(ticket.is_primary())
+        self.assertIsNotNone(ticket.consumed)
+
+    def test_validate_ticket_twice(self):
+        """
+        A signed ticket ought to validate successfully only once.
+        """
+        st = ServiceTicketFactory()
+        ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+        with self.assertRaises(InvalidTicket):
+            ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+
+    def test_validate_ticket_tampered(self):
+        """
+        The validation process ought to fail when the contents of a
+        signed ticket have been altered.
+        """
+        st = ServiceTicketFactory()
+        ticket = st.ticket.replace('-0-', '-1-', 1)
+        with self.assertRaises(InvalidTicket):
+            ServiceTicket.objects.validate_ticket(ticket, self.url)
+
+    def test_validate_ticket_service_mismatch(self):
+        """
+        The validation process ought to fail when the provided service
+        does not match the signed service digest.
+        """
+        st = ServiceTicketFactory()
+        with self.assertRaises(InvalidService):
+            ServiceTicket.objects.validate_ticket(st.ticket, 'http://sub.example.com/')
+
+    def test_validate_ticket_expired(self):
+        """
+        The validation process ought to fail when the signed expiry
+        has passed.
+        """
+        st = ExpiredServiceTicketFactory()
+        with self.assertRaises(InvalidTicket):
+            ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+
+    def test_consume_tickets(self):
+        """
+        Consuming a user's tickets ought to revoke signed tickets that
+        have not yet been validated.
+        """
+        st = ServiceTicketFactory()
+        ServiceTicket.objects.consume_tickets(self.user)
+        with self.assertRaises(InvalidTicket):
+            ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+
+    def test_validate_ticket_after_consume_tickets(self):
+        """
+        A signed ticket issued after the user's tickets were consumed
+        ought to validate, even within the same second.
+        """
+        ServiceTicket.objects.consume_tickets(self.user)
+        st = ServiceTicketFactory()
+        ticket = ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+        self.assertEqual(ticket.user, self.user)
+
+    @override_settings(MAMA_CAS_ENABLE_SINGLE_SIGN_OUT=True)
+    def test_request_sign_out(self):
+        """
+        Single logout requests should be sent for validated signed
+        tickets.
+        """
+        st = ServiceTicketFactory()
+        ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+        with patch('requests.Session.post') as mock:
+            mock.return_value.status_code = 200
+            ServiceTicket.objects.request_sign_out(self.user)
+            self.assertEqual(mock.call_count, 1)
+
+    def test_request_sign_out_after_expiry(self):
+        """
+        Validated signed tickets should be found for single logout
+        after the tickets themselves have expired.
+        """
+        since = now()
+        st = ServiceTicketFactory()
+        ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+        with patch('time.time', return_value=time.time() + 600):
+            self.assertEqual(len(ServiceTicket.objects.backend.get_consumed_tickets(self.user, since)), 1)
+
+    def test_proxy_granting_ticket(self):
+        """
+        Proxy-granting tickets granted by a signed service ticket ought
+        to be stored in the cache.
+        """
+        pgt = ProxyGrantingTicketFactory()
+        self.assertEqual(ProxyGrantingTicket.objects.count(), 0)
+        ticket = ProxyGrantingTicket.objects.validate_ticket(pgt.ticket, 'https://www.example.com')
+        self.assertEqual(ticket.granted_by_st.ticket, pgt.granted_by_st.ticket)
@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from .factories import ServiceTicketFactory
+from .factories import UserFactory
+from mama_cas import stats
+from mama_cas.bloom import get_ticket_filter
+from mama_cas.bloom import TicketFilter
+from mama_cas.exceptions import InvalidTicket
+from mama_cas.models import ServiceTicket
+
+
+class TicketFilterTests(TestCase):
+    """
+    Test the ``TicketFilter`` Bloom filter.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'filter')
+        self.filter = TicketFilter(self.path, 1000, 0.01, 600)
+        # Issue times after the current generation was created
+        self.issued = int(time.time()) + 1
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        """
+        A lookup should report added tickets as possibly present and
+        others as definitely absent.
+        """
+        self.filter.add('ST-1', self.issued)
+        self.assertTrue(self.filter.lookup('ST-1', self.issued))
+        self.assertFalse(self.filter.lookup('ST-2', self.issued))
+
+    def test_lookup_not_covered(self):
+        """
+        A lookup for an issue time outside the retained generations
+        should be inconclusive.
+        """
+        self.filter.add('ST-1', self.issued)
+        self.assertIsNone(self.filter.lookup('ST-2', self.issued - 6000))
+        self.assertIsNone(self.filter.lookup('ST-2', self.issued + 6000))
+
+    def test_lookup_before_created(self):
+        """
+        A lookup for a ticket issued before its generation was created
+        should be inconclusive.
+        """
+        self.filter.add('ST-1', self.issued)
+        self.assertIsNone(self.filter.lookup('ST-2', self.issued - 2))
+
+    def test_rotation(self):
+        """
+        Adding a ticket to a new generation should reuse the slot of
+        the oldest generation.
+        """
+        self.filter.add('ST-1', self.issued)
+        self.filter.add('ST-2', self.issued + 3 * 600)
+        self.assertIsNone(self.filter.lookup('ST-1', self.issued))
+
+    def test_shared(self):
+        """
+        Tickets added by one process should be visible to every filter
+        opened on the same file.
+        """
+        other = TicketFilter(self.path, 1000, 0.01, 600)
+        self.filter.add('ST-1', self.issued)
+        self.assertTrue(other.lookup('ST-1', self.issued))
+
+    def test_settings_mismatch(self):
+        """
+        A file created with different settings should not be changed
+        while other processes may have it mapped.
+        """
+        self.filter.add('ST-1', self.issued)
+        with self.assertRaises(ImproperlyConfigured):
+            TicketFilter(self.path, 2000, 0.01, 600)
+        self.assertTrue(self.filter.lookup('ST-1', self.issued))
+
+    def test_get_stats(self):
+        """
+        The filter should report its size and the estimated false
+        positive rate of each generation.
+        """
+        for i in range(100):
+            self.filter.add('ST-%d' % i, self.issued)
+        filter_stats = self.filter.get_stats()
+        self.assertEqual(filter_stats['size'], os.path.getsize(self.path))
+        self.assertEqual(len(filter_stats['generations']), 1)
+        self.assertLess(filter_stats['generations'][0]['false_positive_rate'], 0.001)
+
+
+class TicketFilterValidationTests(TestCase):
+    """
+    Test ticket validation with ``MAMA_CAS_TICKET_FILTER`` enabled.
+    """
+    url = 'http://www.example.com/'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = override_settings(MAMA_CAS_TICKET_FILTER=os.path.join(self.tmpdir, 'filter'),
+                                          MAMA_CAS_TICKET_FILTER_SINGLE_HOST=True)
+        self.settings.enable()
+        self.user = UserFactory()
+        stats.reset()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_ticket_filter(self):
+        """
+        The configured filter should be shared by each caller.
+        """
+        self.assertIsInstance(get_ticket_filter(), TicketFilter)
+        self.assertIs(get_ticket_filter(), get_ticket_filter())
+        with override_settings(MAMA_CAS_TICKET_FILTER=None):
+            self.assertIsNone(get_ticket_filter())
+
+    def test_get_ticket_filter_not_single_host(self):
+        """
+        The filter should not be enabled unless tickets are validated
+        on the host that issued them.
+        """
+        with override_settings(MAMA_CAS_TICKET_FILTER_SINGLE_HOST=False):
+            with self.assertRaises(ImproperlyConfigured):
+                get_ticket_filter()
+
+    def test_validate_ticket(self):
+        """
+        Validation ought to succeed for a ticket added to the filter.
+        """
+        ticket_filter = get_ticket_filter()
+        issued = int(time.time()) + 1
+        ticket = 'ST-%d-%s' % (issued, 'a' * 32)
+        st = ServiceTicketFactory(ticket=ticket)
+        self.assertTrue(ticket_filter.lookup(st.ticket, issued))
+        self.assertEqual(ServiceTicket.objects.validate_ticket(st.ticket, self.url), st)
+
+    def test_validate_ticket_does_not_exist(self):
+        """
+        A ticket that was never issued ought to be rejected without
+        a database query.
+        """
+        issued = int(time.time()) + 1
+        ServiceTicketFactory(ticket='ST-%d-%s' % (issued, 'a' * 32))
+        ticket = 'ST-%d-%s' % (issued, 'b' * 32)
+        with self.assertNumQueries(0):
+            with self.assertRaises(InvalidTicket):
+                ServiceTicket.objects.validate_ticket(ticket, self.url)
+        self.assertEqual(stats.get('tickets.filter_rejected'), 1)
@@ -0,0 +1,270 @@
+from mock import patch
+
+from django.core import management
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+
+import requests
+
+from .factories import ConsumedServiceTicketFactory
+from .factories import UserFactory
+from mama_cas.breaker import CircuitOpenError
+from mama_cas.breaker import get_breaker
+from mama_cas.breaker import get_endpoints
+from mama_cas.models import send_sign_out_request
+from mama_cas.models import ServiceTicket
+from mama_cas.models import SignOutMessage
+
+
+@override_settings(MAMA_CAS_SLO_BREAKER_THRESHOLD=2, MAMA_CAS_SLO_BREAKER_RESET=60)
+class CircuitBreakerTests(TestCase):
+    """
+    Test the single logout circuit breakers.
+    """
+    url = 'https://example.com/logout'
+
+    def setUp(self):
+        cache.clear()
+        self.breaker = get_breaker(self.url)
+
+    def test_open(self):
+        """
+        The circuit should open after the threshold of consecutive
+        failures, and stop allowing requests.
+        """
+        self.breaker.record_failure(0.1)
+        self.assertEqual(self.breaker.get_state(), 'closed')
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure(0.1)
+        self.assertEqual(self.breaker.get_state(), 'open')
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(get_endpoints(), [self.url])
+
+    def test_endpoint(self):
+        """
+        Each logout URL should have its own circuit breaker, so a
+        broken logout URL does not affect other services on the host.
+        """
+        self.breaker.record_failure(0.1)
+        self.breaker.record_failure(0.1)
+        self.assertFalse(get_breaker(self.url).allow())
+        self.assertTrue(get_breaker('https://example.com/app/logout').allow())
+
+    @override_settings(MAMA_CAS_SLO_BREAKER_ENDPOINTS=1)
+    def test_max_endpoints(self):
+        """
+        Once the maximum number of endpoints are tracked, requests to
+        other endpoints should not be recorded.
+        """
+        url = 'https://example.com/app/logout'
+        self.breaker.record_failure(0.1)
+        get_breaker(url).record_failure(0.1)
+        get_breaker(url).record_failure(0.1)
+        self.assertTrue(get_breaker(url).allow())
+        self.assertEqual(get_breaker(url).get_health()['requests'], 0)
+        self.assertEqual(get_endpoints(), [self.url])
+
+    def test_concurrent_failures(self):
+        """
+        Failures of overlapping requests should all be counted, opening
+        the circuit.
+        """
+        breakers = [get_breaker(self.url) for _ in range(3)]
+        for breaker in breakers:
+            self.assertTrue(breaker.allow())
+        for breaker in breakers:
+            breaker.record_failure(0.1)
+        self.assertEqual(self.breaker.get_state(), 'open')
+        self.assertEqual(self.breaker.get_health()['consecutive_failures'], 3)
+
+    def test_concurrent_success(self):
+        """
+        A success of a request allowed before the circuit opened should
+        not close the circuit.
+        """
+        breaker = get_breaker(self.url)
+        self.assertTrue(breaker.allow())
+        self.breaker.record_failure(0.1)
+        self.breaker.record_failure(0.1)
+        breaker.record_success(0.1)
+        self.assertEqual(self.breaker.get_state(), 'open')
+        with override_settings(MAMA_CAS_SLO_BREAKER_RESET=0):
+            self.assertTrue(breaker.allow())
+            self.assertFalse(self.breaker.allow())
+            self.breaker.record_success(0.1)
+            self.assertEqual(self.breaker.get_state(), 'half-open')
+            breaker.record_success(0.1)
+        self.assertEqual(self.breaker.get_state(), 'closed')
+
+    def test_record_timeout(self):
+        """
+        Health records should expire, and expired endpoints should no
+        longer be listed.
+        """
+        self.breaker.record_failure(0.1)
+        with patch.object(cache, 'set') as mock:
+            self.breaker.record_failure(0.1)
+            self.assertEqual(mock.call_args[0][2], self.breaker.record_timeout)
+        cache.delete(self.breaker.key)
+        self.assertEqual(get_endpoints(), [])
+
+    def test_reset_record_timeout(self):
+        """
+        Resetting an endpoint should keep the endpoint index expiring.
+        """
+        self.breaker.record_failure(0.1)
+        get_breaker('https://www.example.com/logout').record_failure(0.1)
+        with patch.object(cache, 'set') as mock:
+            self.breaker.reset()
+            self.assertEqual(mock.call_args[0][2], 2 * self.breaker.record_timeout)
+
+    def test_half_open(self):
+        """
+        After the reset timeout, a single trial request should be
+        allowed, closing the circuit if it succeeds.
+        """
+        self.breaker.record_failure(0.1)
+        self.breaker.record_failure(0.1)
+        with override_settings(MAMA_CAS_SLO_BREAKER_RESET=0):
+            self.assertEqual(self.breaker.get_state(), 'half-open')
+            self.assertTrue(self.breaker.allow())
+            self.assertFalse(self.breaker.allow())
+            self.breaker.record_success(0.2)
+        self.assertEqual(self.breaker.get_state(), 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_failure(self):
+        """
+        A failed trial request should open the circuit again.
+        """
+        self.breaker.record_failure(0.1)
+        self.breaker.record_failure(0.1)
+        with override_settings(MAMA_CAS_SLO_BREAKER_RESET=0):
+            self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure(0.1)
+        self.assertEqual(self.breaker.get_state(), 'open')
+
+    def test_retry_delay_half_open(self):
+        """
+        While another process holds the trial request, a rejected
+        request should wait at least the trial timeout.
+        """
+        self.breaker.record_failure(0.1)
+        self.breaker.record_failure(0.1)
+        with override_settings(MAMA_CAS_SLO_BREAKER_RESET=0):
+            self.assertTrue(self.breaker.allow())
+            self.assertFalse(self.breaker.allow())
+            self.assertGreaterEqual(self.breaker.get_retry_delay(), self.breaker.trial_timeout)
+
+    def test_health(self):
+        """
+        The health of an endpoint should report its failure rate and
+        average latency.
+        """
+        self.breaker.record_success(0.2)
+        self.breaker.record_success(0.4)
+        self.breaker.record_failure(0.6)
+        self.breaker.record_success(0.4)
+        health = self.breaker.get_health()
+        self.assertEqual(health['state'], 'closed')
+        self.assertEqual(health['requests'], 4)
+        self.assertEqual(health['failure_rate'], 0.25)
+        self.assertAlmostEqual(health['latency'], 0.4)
+
+    def test_send_sign_out_request(self):
+        """
+        Requests should not be sent to an endpoint with an open circuit.
+        """
+        st = ConsumedServiceTicketFactory()
+        with patch('requests.Session.post') as mock:
+            mock.side_effect = requests.exceptions.Timeout
+            for _ in range(2):
+                with self.assertRaises(requests.exceptions.Timeout):
+                    send_sign_out_request(self.url, st)
+            with self.assertRaises(CircuitOpenError):
+                send_sign_out_request(self.url, st)
+            self.assertEqual(mock.call_count, 2)
+
+    def test_send_sign_out_request_client_error(self):
+        """
+        A client error response should not count against the endpoint,
+        while a server error should.
+        """
+        st = ConsumedServiceTicketFactory()
+        response = requests.Response()
+        response.status_code = 404
+        with patch('requests.Session.post', return_value=response):
+            for _ in range(3):
+                with self.assertRaises(requests.exceptions.HTTPError):
+                    send_sign_out_request(self.url, st)
+        self.assertEqual(self.breaker.get_state(), 'closed')
+        self.assertEqual(self.breaker.get_health()['failures'], 0)
+
+        response.status_code = 503
+        with patch('requests.Session.post', return_value=response):
+            for _ in range(2):
+                with self.assertRaises(requests.exceptions.HTTPError):
+                    send_sign_out_request(self.url, st)
+        self.assertEqual(self.breaker.get_state(), 'open')
+
+    def test_send_sign_out_request_cache_calls(self):
+        """
+        A successful request to a closed circuit should read the state
+        of the endpoint once and write its health record once.
+        """
+        st = ConsumedServiceTicketFactory()
+        self.breaker.record_success(0.1)
+        with patch('requests.Session.post') as mock:
+            mock.return_value.status_code = 200
+            with patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+                with patch.object(cache, 'set', wraps=cache.set) as set_:
+                    with patch.object(cache, 'delete', wraps=cache.delete) as delete:
+                        send_sign_out_request(self.url, st)
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(set_.call_count, 1)
+        self.assertEqual(delete.call_count, 0)
+
+    def test_request_sign_out_skipped(self):
+        """
+        Logging out should skip requests to endpoints with an open
+        circuit.
+        """
+        ConsumedServiceTicketFactory()
+        self.breaker.record_failure(0.1)
+        self.breaker.record_failure(0.1)
+        with patch('requests.Session.post') as mock:
+            ServiceTicket.objects.request_sign_out(UserFactory())
+            self.assertEqual(mock.call_count, 0)
+
+    def test_outbox_deferred(self):
+        """
+        Queued messages for an endpoint with an open circuit should be
+        postponed without counting an attempt.
+        """
+        message = SignOutMessage.objects.create(url=self.url, service='http://www.example.com/',
+                                                ticket='ST-0000000000-abc')
+        self.breaker.record_failure(0.1)
+        self.breaker.record_failure(0.1)
+        with patch('requests.Session.post') as mock:
+            SignOutMessage.objects.deliver()
+            self.assertEqual(mock.call_count, 0)
+        message = SignOutMessage.objects.get(pk=message.pk)
+        self.assertEqual(message.attempts, 0)
+        self.assertEqual(SignOutMessage.objects.get_queue_depth()['due'], 0)
+
+    def test_slohealthcas_management_command(self):
+        """
+        The ``slohealthcas`` management command should show the health
+        of each endpoint, and reset circuits.
+        """
+        self.breaker.record_failure(0.5)
+        self.breaker.record_failure(0.5)
+        out = StringIO()
+        management.call_command('slohealthcas', stdout=out)
+        self.assertIn('https://example.com/logout: open, 2 requests, 100.0% failed', out.getvalue())
+
+        management.call_command('slohealthcas', reset=[self.url], stdout=StringIO())
+        self.assertEqual(self.breaker.get_state(), 'closed')
+        self.assertEqual(get_endpoints(), [])
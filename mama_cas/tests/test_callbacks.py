@@ -1,14 +1,29 @@
+from mock import patch
+
 from django.test import TestCase
+from django.test.utils import modify_settings
 
+from .factories import ServiceTicketFactory
 from .factories import UserFactory
+from mama_cas.callbacks import callback_registry
+from mama_cas.callbacks import get_deferred_user_fields
+from mama_cas.callbacks import get_plan
+from mama_cas.callbacks import user_info_attributes
 from mama_cas.callbacks import user_model_attributes
+from mama_cas.callbacks import user_model_extractors
 from mama_cas.callbacks import user_name_attributes
+from mama_cas.models import ServiceTicket
+from mama_cas.utils import get_service_policy
+from mama_cas.utils import services as service_config
 
 
 class CallbacksTests(TestCase):
     def setUp(self):
         self.user = UserFactory()
 
+    def tearDown(self):
+        service_config.__dict__.pop('services', None)
+
     def test_user_name_attributes(self):
         """
         The callback should return a username, full_name and
@@ -27,3 +42,69 @@ class CallbacksTests(TestCase):
         attributes = user_model_attributes(self.user, 'http://www.example.com/')
         self.assertIn('username', attributes)
         self.assertEqual(attributes['username'], 'ellen')
+
+        self.assertNotIn('id', attributes)
+        self.assertNotIn('password', attributes)
+
+    def test_user_info_attributes(self):
+        """
+        The callback should return name and contact attributes without
+        writing to stdout.
+        """
+        with patch('sys.stdout') as mock:
+            attributes = user_info_attributes(self.user, 'http://www.example.com/')
+            self.assertFalse(mock.write.called)
+        self.assertEqual(attributes['email'], self.user.email)
+        self.assertEqual(attributes['uid'], self.user.pk)
+
+    def test_get_plan(self):
+        """
+        A plan should be computed once for a user model and set of
+        allowed attributes.
+        """
+        model = self.user.__class__
+        plan = get_plan(user_model_extractors, model)
+        self.assertIs(get_plan(user_model_extractors, model), plan)
+        allowed = get_plan(user_model_extractors, model, frozenset(['email']))
+        self.assertEqual([extractor[0] for extractor in allowed], ['email'])
+
+    @modify_settings(MAMA_CAS_VALID_SERVICES={
+        'prepend': [{'SERVICE': 'http://attributes\\.example\\.com', 'ATTRIBUTES': ['email']}]
+    })
+    def test_service_attributes(self):
+        """
+        Only the attributes allowed for the service should be returned.
+        """
+        attributes = user_model_attributes(self.user, 'http://attributes.example.com/')
+        self.assertEqual(attributes, {'email': self.user.email})
+
+    @modify_settings(MAMA_CAS_VALID_SERVICES={
+        'prepend': [{'SERVICE': 'http://attributes\\.example\\.com',
+                     'CALLBACKS': ['mama_cas.callbacks.user_name_attributes',
+                                   'mama_cas.callbacks.user_info_attributes'],
+                     'ATTRIBUTES': ['email']}]
+    })
+    def test_release_plan(self):
+        """
+        Callbacks producing none of the allowed attributes should be
+        skipped, and only the fields read by the others loaded.
+        """
+        policy = get_service_policy('http://attributes.example.com/')
+        paths, callbacks, fields = callback_registry.get_release_plan(policy, self.user.__class__)
+        self.assertEqual(paths, ('mama_cas.callbacks.user_info_attributes',))
+        self.assertEqual(fields, frozenset(['username', 'email']))
+
+    def test_deferred_user_fields(self):
+        """
+        Validating a ticket for a service without attribute callbacks
+        should only load the user fields needed for the response.
+        """
+        self.assertEqual(get_deferred_user_fields('http://www.example.com/', self.user.__class__), ())
+        deferred = get_deferred_user_fields('http://example.com/', self.user.__class__)
+        self.assertIn('email', deferred)
+        self.assertNotIn('username', deferred)
+
+        st = ServiceTicketFactory(service='http://example.com/')
+        t = ServiceTicket.objects.validate_ticket(st.ticket, 'http://example.com/')
+        self.assertIn('email', t.user.get_deferred_fields())
+        self.assertEqual(t.user.get_username(), self.user.get_username())
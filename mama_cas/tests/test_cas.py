@@ -0,0 +1,335 @@
+import sys
+import threading
+import time
+import traceback
+import warnings
+
+from mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from .factories import ProxyTicketFactory
+from .factories import ServiceTicketFactory
+from .factories import UserFactory
+from mama_cas.callbacks import CallbackRegistry
+from mama_cas.callbacks import user_name_attributes
+from mama_cas import stats
+from mama_cas.cas import get_attributes
+from mama_cas.cas import invalidate_attributes
+from mama_cas.cas import revoke_tickets
+from mama_cas.models import ProxyGrantingTicket
+from mama_cas.models import ProxyTicket
+from mama_cas.models import ServiceTicket
+from mama_cas.pool import ThreadPool
+from mama_cas.utils import get_service_policy
+from mama_cas.utils import services as service_config
+
+
+def fast_attributes(user, service):
+    return {'fast': True}
+
+
+def slow_attributes(user, service):
+    time.sleep(0.5)
+    return {'slow': True}
+
+
+def medium_attributes(user, service):
+    time.sleep(0.15)
+    return {'medium': True}
+
+
+def failing_attributes(user, service):
+    raise ValueError('failed')
+
+
+def service_attributes(user, service):
+    return {'service': service}
+
+
+def invalidating_attributes(user, service):
+    invalidate_attributes(user)
+    return {'invalidated': True}
+
+
+class RevokeTicketsTests(TestCase):
+    """
+    Test the ``revoke_tickets()`` function.
+    """
+    def setUp(self):
+        self.user = UserFactory()
+
+    def test_revoke_tickets(self):
+        """
+        All valid tickets of every type belonging to the specified
+        users should be consumed.
+        """
+        ServiceTicketFactory()
+        ProxyTicketFactory()
+        revoke_tickets([self.user])
+        self.assertFalse(ServiceTicket.objects.filter(consumed__isnull=True).exists())
+        self.assertFalse(ProxyTicket.objects.filter(consumed__isnull=True).exists())
+        self.assertFalse(ProxyGrantingTicket.objects.filter(consumed__isnull=True).exists())
+
+    def test_revoke_tickets_queryset(self):
+        """
+        When provided a queryset of users, tickets ought to be consumed
+        with a constant number of queries.
+        """
+        ServiceTicketFactory()
+        ServiceTicketFactory(user=UserFactory(first_name='Michelle'))
+        with self.assertNumQueries(3):
+            revoke_tickets(User.objects.all())
+        self.assertFalse(ServiceTicket.objects.filter(consumed__isnull=True).exists())
+
+
+class CallbackRegistryTests(TestCase):
+    """
+    Test the ``CallbackRegistry`` attribute callback registry.
+    """
+    def setUp(self):
+        self.registry = CallbackRegistry()
+
+    def test_get_callbacks(self):
+        """
+        Callbacks should be imported once and returned for each
+        service policy.
+        """
+        policy = get_service_policy('http://www.example.com')
+        with patch('mama_cas.callbacks.import_string', return_value=user_name_attributes) as mock:
+            self.assertEqual(self.registry.get_callbacks(policy), (user_name_attributes,))
+            self.registry.get_callbacks(policy)
+            self.assertEqual(mock.call_count, 1)
+
+    def test_resolve_invalid(self):
+        """
+        An invalid callback path should raise ``ImproperlyConfigured``.
+        """
+        with self.assertRaises(ImproperlyConfigured):
+            self.registry.resolve('mama_cas.callbacks.invalid_attributes')
+
+    @override_settings(MAMA_CAS_VALID_SERVICES=[{'SERVICE': 'http://example\\.com',
+                                                 'CALLBACKS': ['invalid.path']}])
+    def test_load_invalid(self):
+        """
+        Loading the registry should fail when an invalid callback is
+        configured for a service.
+        """
+        with self.assertRaises(ImproperlyConfigured):
+            self.registry.load()
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.callbacks.user_name_attributes',))
+    def test_deprecation_warning(self):
+        """
+        The deprecated global callbacks setting should only be warned
+        about once.
+        """
+        policy = get_service_policy('http://www.example.org')
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.registry.get_callbacks(policy)
+            self.registry.get_callbacks(policy)
+        self.assertEqual(len(w), 1)
+
+    @override_settings(MAMA_CAS_VALID_SERVICES=[{
+        'SERVICE': 'http://www\\.example\\.com',
+        'CALLBACKS': ['mama_cas.tests.test_cas.fast_attributes',
+                      'mama_cas.callbacks.user_name_attributes'],
+        'ATTRIBUTES': ['fast', 'username'],
+    }])
+    def test_get_attributes_allowed(self):
+        """
+        Only the attributes allowed for the service should be released.
+        """
+        service_config.__dict__.pop('services', None)
+        try:
+            attributes = get_attributes(UserFactory(), 'http://www.example.com')
+        finally:
+            service_config.__dict__.pop('services', None)
+        self.assertEqual(set(attributes), set(['fast', 'username']))
+
+    def test_get_attributes(self):
+        """
+        Attributes should be gathered from the callbacks configured for
+        the service.
+        """
+        user = UserFactory()
+        attributes = get_attributes(user, 'http://www.example.com')
+        self.assertEqual(attributes['username'], user.get_username())
+        self.assertEqual(get_attributes(user, 'http://www.example.org'), {})
+
+
+@override_settings(MAMA_CAS_ATTRIBUTE_CACHE_TIMEOUT=60)
+class AttributeCacheTests(TestCase):
+    """
+    Test caching of attributes returned by ``get_attributes()``.
+    """
+    url = 'http://www.example.com'
+
+    def setUp(self):
+        cache.clear()
+        stats.reset()
+        self.user = UserFactory()
+
+    def test_cached(self):
+        """
+        Attributes should be gathered once for a user and set of
+        callbacks.
+        """
+        attributes = get_attributes(self.user, self.url)
+        self.assertEqual(get_attributes(self.user, self.url), attributes)
+        self.assertEqual(stats.get('attributes.cache_misses'), 1)
+        self.assertEqual(stats.get('attributes.cache_hits'), 1)
+
+    def test_user_saved(self):
+        """
+        Saving a user should discard their cached attributes.
+        """
+        get_attributes(self.user, self.url)
+        self.user.first_name = 'Michelle'
+        self.user.save()
+        self.assertEqual(get_attributes(self.user, self.url)['short_name'], 'Michelle')
+        self.assertEqual(stats.get('attributes.cache_misses'), 2)
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.tests.test_cas.service_attributes',))
+    def test_cached_per_service(self):
+        """
+        Attributes should be cached separately for each service URL.
+        """
+        url = 'http://www.example.com/other'
+        self.assertEqual(get_attributes(self.user, self.url)['service'], self.url)
+        self.assertEqual(get_attributes(self.user, url)['service'], url)
+        self.assertEqual(get_attributes(self.user, self.url)['service'], self.url)
+        self.assertEqual(stats.get('attributes.cache_hits'), 1)
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.tests.test_cas.invalidating_attributes',))
+    def test_invalidated_while_gathering(self):
+        """
+        Attributes gathered while a user's attributes are invalidated
+        should not be returned from the cache.
+        """
+        get_attributes(self.user, self.url)
+        get_attributes(self.user, self.url)
+        self.assertEqual(stats.get('attributes.cache_misses'), 2)
+        self.assertEqual(stats.get('attributes.cache_hits'), 0)
+
+    def test_invalidate_attributes(self):
+        """
+        Invalidating a user's attributes should discard them from the
+        cache.
+        """
+        get_attributes(self.user, self.url)
+        invalidate_attributes(self.user.pk)
+        get_attributes(self.user, self.url)
+        self.assertEqual(stats.get('attributes.cache_misses'), 2)
+        self.assertEqual(stats.get('attributes.cache_hits'), 0)
+
+
+@override_settings(MAMA_CAS_CALLBACK_CONCURRENCY=2, MAMA_CAS_CALLBACK_TIMEOUT=0.2,
+                   MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.tests.test_cas.fast_attributes',))
+class ConcurrentCallbackTests(TestCase):
+    """
+    Test running attribute callbacks concurrently.
+    """
+    url = 'http://www.example.com'
+
+    def setUp(self):
+        stats.reset()
+        self.user = UserFactory()
+
+    def test_get_attributes(self):
+        """
+        Attributes from every callback should be merged, and the
+        duration of each callback recorded.
+        """
+        attributes = get_attributes(self.user, self.url)
+        self.assertTrue(attributes['fast'])
+        self.assertEqual(attributes['username'], self.user.get_username())
+        histogram = stats.get_histogram('callbacks.mama_cas.tests.test_cas.fast_attributes')
+        self.assertEqual(histogram['count'], 1)
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.tests.test_cas.slow_attributes',))
+    def test_get_attributes_timeout(self):
+        """
+        A callback that does not finish in time should be omitted.
+        """
+        start = time.time()
+        attributes = get_attributes(self.user, self.url)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertNotIn('slow', attributes)
+        self.assertEqual(attributes['username'], self.user.get_username())
+        self.assertEqual(stats.get('callbacks.timeouts'), 1)
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.tests.test_cas.failing_attributes',))
+    def test_get_attributes_exception(self):
+        """
+        An exception raised by a callback should be raised to the caller
+        with its original traceback.
+        """
+        with self.assertRaises(ValueError):
+            try:
+                get_attributes(self.user, self.url)
+            except ValueError:
+                frames = traceback.extract_tb(sys.exc_info()[2])
+                self.assertEqual(frames[-1][2], 'failing_attributes')
+                raise
+
+    @override_settings(MAMA_CAS_CALLBACK_CONCURRENCY=1,
+                       MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.tests.test_cas.medium_attributes',
+                                                     'mama_cas.tests.test_cas.medium_attributes'))
+    def test_get_attributes_timeout_per_callback(self):
+        """
+        Each callback should be given the timeout from when it starts,
+        rather than sharing one deadline.
+        """
+        attributes = get_attributes(self.user, 'http://example.com')
+        self.assertTrue(attributes['medium'])
+        self.assertEqual(stats.get('callbacks.timeouts'), 0)
+
+    @override_settings(MAMA_CAS_CALLBACK_CONCURRENCY=1,
+                       MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.tests.test_cas.slow_attributes',
+                                                     'mama_cas.tests.test_cas.fast_attributes'))
+    def test_get_attributes_timeout_replaces_worker(self):
+        """
+        A worker held by a callback that timed out should be replaced,
+        so later callbacks do not wait for it.
+        """
+        pool = ThreadPool(1, 10, 'test', replacements=1)
+        with patch('mama_cas.pool.get_thread_pool', return_value=pool):
+            self.assertNotIn('slow', get_attributes(self.user, 'http://example.com'))
+            self.assertEqual(stats.get('pool.replaced'), 1)
+            with override_settings(MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.tests.test_cas.fast_attributes',
+                                                                 'mama_cas.tests.test_cas.fast_attributes')):
+                self.assertTrue(get_attributes(self.user, 'http://example.com')['fast'])
+
+    @override_settings(MAMA_CAS_ATTRIBUTE_CALLBACKS=('mama_cas.tests.test_cas.fast_attributes',
+                                                     'mama_cas.tests.test_cas.fast_attributes'))
+    def test_get_attributes_saturated(self):
+        """
+        When every worker is busy and the queue is full, callbacks
+        should be omitted without waiting for the timeout.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        pool = ThreadPool(1, 1)
+        pool.submit(block, ())
+        started.wait()
+        pool.submit(block, ())
+        try:
+            with patch('mama_cas.pool.get_thread_pool', return_value=pool):
+                start = time.time()
+                attributes = get_attributes(self.user, self.url)
+                self.assertLess(time.time() - start, 0.1)
+        finally:
+            release.set()
+        self.assertNotIn('fast', attributes)
+        self.assertEqual(stats.get('pool.rejected'), 3)
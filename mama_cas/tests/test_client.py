@@ -0,0 +1,83 @@
+from mock import patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+import requests
+from requests.cookies import create_cookie
+from requests.cookies import MockRequest
+
+from mama_cas.client import get_pool_stats
+from mama_cas.client import get_session
+from mama_cas.client import get_timeout
+from mama_cas.client import reset_session
+
+
+class ClientTests(TestCase):
+    def setUp(self):
+        reset_session()
+
+    def tearDown(self):
+        reset_session()
+
+    def test_get_session(self):
+        """
+        A single session should be shared until it is reset.
+        """
+        session = get_session()
+        self.assertIs(get_session(), session)
+        reset_session()
+        self.assertIsNot(get_session(), session)
+
+    @override_settings(MAMA_CAS_HTTP_POOL_CONNECTIONS=2, MAMA_CAS_HTTP_POOL_MAXSIZE=20)
+    def test_session_pool_size(self):
+        """
+        The session's connection pools should be sized by the settings.
+        """
+        adapter = get_session().get_adapter('https://www.example.com/')
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 20)
+
+    def test_session_ca_bundle(self):
+        """
+        When ``REQUESTS_CA_BUNDLE`` is set, the session should verify
+        certificates against it.
+        """
+        self.assertTrue(get_session().verify)
+        reset_session()
+        with patch.dict('os.environ', {'REQUESTS_CA_BUNDLE': '/etc/ssl/ca.pem'}):
+            self.assertEqual(get_session().verify, '/etc/ssl/ca.pem')
+
+    def test_session_no_cookies(self):
+        """
+        Cookies set by a service should not be stored by the session.
+        """
+        session = get_session()
+        request = MockRequest(requests.Request('GET', 'https://www.example.com/').prepare())
+        cookie = create_cookie('sessionid', 'secret', domain='www.example.com')
+        session.cookies.set_cookie_if_ok(cookie, request)
+        self.assertEqual(len(session.cookies), 0)
+
+    def test_get_timeout(self):
+        """
+        The timeout should be a ``(connect, read)`` pair.
+        """
+        self.assertEqual(get_timeout(), (3.0, 3.0))
+        with override_settings(MAMA_CAS_HTTP_TIMEOUT=(1, 5)):
+            self.assertEqual(get_timeout(), (1, 5))
+
+    def test_get_pool_stats(self):
+        """
+        The pool statistics should report the proportion of requests
+        that reused a connection.
+        """
+        self.assertEqual(get_pool_stats()['hit_rate'], 0.0)
+        adapter = get_session().get_adapter('https://www.example.com/')
+        pool = adapter.poolmanager.connection_from_url('https://www.example.com/')
+        pool.num_requests = 4
+        pool.num_connections = 1
+        stats = get_pool_stats()
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['hit_rate'], 0.75)
+        self.assertIn('https://www.example.com:443', stats['hosts'])
@@ -0,0 +1,99 @@
+import re
+
+from mock import patch
+
+from django.test import TestCase
+
+from mama_cas.matcher import get_literal_prefixes
+from mama_cas.matcher import ServiceMatcher
+
+
+@patch('mama_cas.matcher.MIN_INDEXED', 0)
+class ServiceMatcherTests(TestCase):
+    """
+    Test the ``ServiceMatcher`` service pattern matcher.
+    """
+    patterns = [
+        r'^https://www\.example\.com/secure',
+        r'https?://.+\.example\.com',
+        r'http://example\.com',
+        r'(?i)https://EXAMPLE\.org',
+        r'.*\.example\.net/(a|b)',
+        r'https://www\.example\.com',
+        r'(ht)tps://\1\.example\.edu',
+        '.*',
+    ]
+    service_urls = [
+        'https://www.example.com/secure/page',
+        'https://www.example.com/',
+        'http://sub.example.com/',
+        'http://example.com/',
+        'https://example.org/',
+        'http://www.example.net/b',
+        'https://ht.example.edu/',
+        'ftp://example.com/',
+        '',
+    ]
+
+    def linear_match(self, patterns, s):
+        for index, regex in enumerate(patterns):
+            if regex.match(s):
+                return index
+        return None
+
+    def assertMatchesLinear(self, patterns, urls):
+        compiled = [re.compile(p) for p in patterns]
+        matcher = ServiceMatcher(compiled)
+        for url in urls:
+            self.assertEqual(matcher.match(url), self.linear_match(compiled, url), url)
+
+    def test_get_literal_prefixes(self):
+        """
+        The literal prefixes of a pattern should end at the first
+        non-literal element, expanding optional literals.
+        """
+        self.assertEqual(get_literal_prefixes(re.compile('^https?://a')),
+                         (['https://a', 'http://a'], True))
+        self.assertEqual(get_literal_prefixes(re.compile(r'http://a\.com/.+')),
+                         (['http://a.com/'], False))
+        self.assertEqual(get_literal_prefixes(re.compile('http://a|https://b')), (['http'], False))
+        self.assertEqual(get_literal_prefixes(re.compile('(?i)http://a')), ([''], False))
+
+    def test_match(self):
+        """
+        The first matching pattern should be returned, as when testing
+        each pattern in turn.
+        """
+        self.assertMatchesLinear(self.patterns, self.service_urls)
+
+    def test_match_ordering(self):
+        """
+        Without the catch-all pattern first, every URL should match it.
+        """
+        patterns = ['.*'] + self.patterns
+        matcher = ServiceMatcher([re.compile(p) for p in patterns])
+        for url in self.service_urls:
+            self.assertEqual(matcher.match(url), 0)
+        self.assertMatchesLinear(self.patterns[:-1], self.service_urls)
+
+    def test_match_many_patterns(self):
+        """
+        Large numbers of patterns should be split across alternations
+        and keep first-match ordering.
+        """
+        patterns = []
+        for i in range(500):
+            patterns.append(r'https://host%d\.example\.com/' % i)
+            patterns.append(r'(https?)://(.*)\.service%d\.example\.com' % i)
+        urls = ['https://host%d.example.com/' % i for i in range(0, 500, 7)]
+        urls += ['http://a.service%d.example.com' % i for i in range(0, 500, 7)]
+        urls += ['https://host1.example.com', 'https://unknown.example.com/']
+        self.assertMatchesLinear(patterns, urls)
+
+    def test_match_unindexed(self):
+        """
+        A small number of patterns should be tested in turn.
+        """
+        with patch('mama_cas.matcher.MIN_INDEXED', 16):
+            self.assertFalse(ServiceMatcher([re.compile('.*')]).indexed)
+            self.assertMatchesLinear(self.patterns, self.service_urls)
@@ -1,10 +1,18 @@
 from datetime import timedelta
+from mock import Mock
 from mock import patch
 import re
+import threading
+import time
 
 from django.core import management
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
+from django.test.utils import modify_settings
 from django.test.utils import override_settings
+from django.utils.encoding import force_text
+from django.utils.six import StringIO
 from django.utils.timezone import now
 
 import requests
@@ -18,9 +26,14 @@ from .factories import ProxyGrantingTicketFactory
 from .factories import ProxyTicketFactory
 from .factories import ServiceTicketFactory
 from .factories import UserFactory
+from mama_cas import stats
+from mama_cas.models import get_host_lanes
 from mama_cas.models import ProxyGrantingTicket
 from mama_cas.models import ProxyTicket
 from mama_cas.models import ServiceTicket
+from mama_cas.models import SignOutMessage
+from mama_cas.pool import ThreadPool
+from mama_cas.utils import services as service_config
 from mama_cas.exceptions import InvalidProxyCallback
 from mama_cas.exceptions import InvalidRequest
 from mama_cas.exceptions import InvalidService
@@ -103,6 +116,37 @@ class TicketManagerTests(TestCase):
         self.assertEqual(ticket, st)
         self.assertTrue(ticket.is_consumed())
 
+    def test_validate_ticket_queries(self):
+        """
+        Validation ought to fetch the ticket along with its user and
+        consume it with a single conditional update.
+        """
+        st = ServiceTicketFactory()
+        with self.assertNumQueries(2):
+            ticket = ServiceTicket.objects.validate_ticket(st.ticket, self.url)
+            self.assertEqual(ticket.user, self.user)
+
+    def test_validate_ticket_concurrent(self):
+        """
+        When the same ticket is validated concurrently, only one
+        validation ought to succeed.
+        """
+        st = ServiceTicketFactory()
+        st1 = ServiceTicket.objects.get(ticket=st.ticket)
+        st2 = ServiceTicket.objects.get(ticket=st.ticket)
+        self.assertFalse(st1.is_consumed())
+        self.assertTrue(st2.is_consumed())
+        self.assertEqual(st1.consumed, st2.consumed)
+
+    def test_validate_ticket_deleted(self):
+        """
+        The validation process ought to fail when the ticket is deleted
+        after it was looked up.
+        """
+        st = ServiceTicketFactory()
+        ServiceTicket.objects.filter(ticket=st.ticket).delete()
+        self.assertTrue(st.is_consumed())
+
     def test_validate_ticket_no_ticket(self):
         """
         The validation process ought to fail when no ticket string is
@@ -128,6 +172,42 @@ class TicketManagerTests(TestCase):
         with self.assertRaises(InvalidTicket):
             ServiceTicket.objects.validate_ticket(ticket, self.url)
 
+    def test_validate_ticket_stale_ticket(self):
+        """
+        The validation process ought to fail without a database lookup
+        when the ticket string was issued before the ticket lifetime.
+        """
+        stats.reset()
+        ticket = ServiceTicket.objects.create_ticket_str()
+        issued = int(time.time()) - ServiceTicket.TICKET_EXPIRE - 60
+        ticket = re.sub('-[0-9]+-', '-%d-' % issued, ticket)
+        with self.assertNumQueries(0):
+            with self.assertRaises(InvalidTicket):
+                ServiceTicket.objects.validate_ticket(ticket, self.url)
+        self.assertEqual(stats.get('tickets.fast_rejected'), 1)
+
+    def test_validate_ticket_future_ticket(self):
+        """
+        The validation process ought to fail without a database lookup
+        when the ticket string was issued in the future.
+        """
+        ticket = ServiceTicket.objects.create_ticket_str()
+        ticket = re.sub('-[0-9]+-', '-%d-' % (time.time() + 3600), ticket)
+        with self.assertNumQueries(0):
+            with self.assertRaises(InvalidTicket):
+                ServiceTicket.objects.validate_ticket(ticket, self.url)
+
+    @override_settings(MAMA_CAS_TICKET_CLOCK_SKEW=60)
+    def test_validate_ticket_clock_skew(self):
+        """
+        Tickets issued slightly in the future, within the allowed
+        clock skew, ought to validate.
+        """
+        ticket = ServiceTicket.objects.create_ticket_str()
+        ticket = re.sub('-[0-9]+-', '-%d-' % (time.time() + 30), ticket)
+        st = ServiceTicketFactory(ticket=ticket)
+        self.assertEqual(ServiceTicket.objects.validate_ticket(ticket, self.url), st)
+
     def test_validate_ticket_consumed_ticket(self):
         """
         The validation process ought to fail when a consumed ticket
@@ -229,6 +309,21 @@ class TicketManagerTests(TestCase):
         self.assertTrue(ServiceTicket.objects.get(ticket=st1).is_consumed())
         self.assertTrue(ServiceTicket.objects.get(ticket=st2).is_consumed())
 
+    def test_bulk_consume_tickets(self):
+        """
+        All tickets belonging to the specified users should be consumed
+        with a single query.
+        """
+        user2 = UserFactory(first_name='Michelle')
+        st1 = ServiceTicketFactory()
+        st2 = ServiceTicketFactory(user=user2)
+        st3 = ServiceTicketFactory(user=UserFactory(first_name='John'))
+        with self.assertNumQueries(1):
+            ServiceTicket.objects.bulk_consume_tickets([self.user, user2])
+        self.assertTrue(ServiceTicket.objects.get(ticket=st1).is_consumed())
+        self.assertTrue(ServiceTicket.objects.get(ticket=st2).is_consumed())
+        self.assertFalse(ServiceTicket.objects.get(ticket=st3).is_consumed())
+
 
 class TicketTests(TestCase):
     """
@@ -271,6 +366,8 @@ class ServiceTicketManagerTests(TestCase):
     Test the ``ServiceTicketManager`` model manager.
     """
     def setUp(self):
+        # Discard the circuit breaker state of the logout URLs
+        cache.clear()
         self.user = UserFactory()
 
     def test_request_sign_out(self):
@@ -281,7 +378,7 @@ class ServiceTicketManagerTests(TestCase):
         """
         ConsumedServiceTicketFactory()
         ConsumedServiceTicketFactory()
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.return_value.status_code = 200
             ServiceTicket.objects.request_sign_out(self.user)
             self.assertEqual(mock.call_count, 2)
@@ -295,16 +392,317 @@ class ServiceTicketManagerTests(TestCase):
         """
         ConsumedServiceTicketFactory()
         ConsumedServiceTicketFactory()
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.return_value.status_code = 200
             ServiceTicket.objects.request_sign_out(self.user)
             self.assertEqual(mock.call_count, 2)
 
+    @override_settings(MAMA_CAS_SLO_DISPATCHER='threads')
+    def test_request_sign_out_threads(self):
+        """
+        When the threads dispatcher is configured, calling the
+        ``request_sign_out()`` manager method should issue a POST
+        request for each consumed ticket from the single logout pool.
+        """
+        ConsumedServiceTicketFactory()
+        ConsumedServiceTicketFactory()
+        threads = []
+
+        def post(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return Mock(status_code=200)
+
+        with patch('requests.Session.post', side_effect=post):
+            ServiceTicket.objects.request_sign_out(self.user)
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith('mama_cas-slo-') for name in threads))
+
+    @modify_settings(MAMA_CAS_VALID_SERVICES={
+        'prepend': [{'SERVICE': r'https://batch\.example\.com', 'LOGOUT_ALLOW': True,
+                     'LOGOUT_URL': 'https://example.com/logout', 'LOGOUT_BATCH': True}]
+    })
+    def test_request_sign_out_batch(self):
+        """
+        Tickets for services sharing a logout URL with batching enabled
+        should be sent in a single request.
+        """
+        service_config.__dict__.pop('services', None)
+        self.addCleanup(service_config.__dict__.pop, 'services', None)
+        st1 = ConsumedServiceTicketFactory(service='https://batch.example.com/a')
+        st2 = ConsumedServiceTicketFactory(service='https://batch.example.com/b')
+        ConsumedServiceTicketFactory()
+        with patch('requests.Session.post') as mock:
+            mock.return_value.status_code = 200
+            ServiceTicket.objects.request_sign_out(self.user)
+            self.assertEqual(mock.call_count, 2)
+        contents = [call[1]['data']['logoutRequest'] for call in mock.call_args_list]
+        batched = [c for c in contents if st1.ticket in force_text(c)]
+        self.assertEqual(len(batched), 1)
+        self.assertIn(st2.ticket, force_text(batched[0]))
+
+    def test_get_host_lanes(self):
+        """
+        Requests should be divided into at most the given number of
+        lanes for each host.
+        """
+        sign_out_requests = [('https://a.example.com/logout', [1]), ('https://a.example.com/logout', [2]),
+                             ('https://a.example.com/logout', [3]), ('https://b.example.com/logout', [4])]
+        lanes = get_host_lanes(sign_out_requests, 2)
+        self.assertEqual(lanes, [[sign_out_requests[0], sign_out_requests[2]], [sign_out_requests[1]],
+                                 [sign_out_requests[3]]])
+
+    @override_settings(MAMA_CAS_SLO_DISPATCHER='threads', MAMA_CAS_SLO_DEADLINE=0.1)
+    def test_request_sign_out_deadline(self):
+        """
+        Calling the ``request_sign_out()`` manager method should not
+        wait for requests past the deadline.
+        """
+        ConsumedServiceTicketFactory()
+        ConsumedServiceTicketFactory()
+        stats.reset()
+        event = threading.Event()
+        with patch('requests.Session.post') as mock:
+            mock.side_effect = lambda *args, **kwargs: event.wait(5)
+            start = time.time()
+            ServiceTicket.objects.request_sign_out(self.user)
+            self.assertLess(time.time() - start, 1)
+            event.set()
+        self.assertEqual(stats.get('slo.timeouts'), 2)
+
+    @override_settings(MAMA_CAS_SLO_DISPATCHER='threads', MAMA_CAS_SLO_HOST_CONCURRENCY=0)
+    def test_request_sign_out_saturated(self):
+        """
+        When the worker threads are busy and their queue is full, every
+        single logout request should still be sent, and counted as sent
+        by the calling thread.
+        """
+        for _ in range(4):
+            ConsumedServiceTicketFactory()
+        stats.reset()
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        pool = ThreadPool(1, 1)
+        pool.submit(block, ())
+        started.wait()
+        pool.submit(block, ())
+        try:
+            with patch('mama_cas.pool.get_thread_pool', return_value=pool):
+                with patch('requests.Session.post') as mock:
+                    mock.return_value.status_code = 200
+                    ServiceTicket.objects.request_sign_out(self.user)
+                    self.assertEqual(mock.call_count, 4)
+        finally:
+            release.set()
+        self.assertEqual(stats.get('pool.inline'), 4)
+
+    @override_settings(MAMA_CAS_SLO_DISPATCHER='threads', MAMA_CAS_SLO_DEADLINE=0.1)
+    def test_request_sign_out_queued_past_deadline(self):
+        """
+        Single logout requests still queued when the deadline passes
+        should be sent in the background rather than dropped.
+        """
+        for _ in range(3):
+            ConsumedServiceTicketFactory()
+        event = threading.Event()
+        sent = []
+
+        def post(*args, **kwargs):
+            event.wait(0.2)
+            sent.append(args[0])
+            return Mock(status_code=200)
+
+        with patch('mama_cas.pool.get_thread_pool', return_value=ThreadPool(1)):
+            with patch('requests.Session.post', side_effect=post):
+                ServiceTicket.objects.request_sign_out(self.user)
+                deadline = time.time() + 2
+                while len(sent) < 3 and time.time() < deadline:
+                    time.sleep(0.05)
+        self.assertEqual(len(sent), 3)
+
+    @override_settings(MAMA_CAS_SLO_DISPATCHER='gevent')
+    def test_request_sign_out_gevent_missing(self):
+        """
+        When the gevent dispatcher is configured without gevent
+        installed, ``ImproperlyConfigured`` should be raised.
+        """
+        ConsumedServiceTicketFactory()
+        with patch('mama_cas.models.gevent', None):
+            with self.assertRaises(ImproperlyConfigured):
+                ServiceTicket.objects.request_sign_out(self.user)
+
+    @override_settings(MAMA_CAS_SLO_DISPATCHER='gevent')
+    def test_request_sign_out_gevent_unpatched(self):
+        """
+        When the gevent dispatcher is configured and the process is not
+        monkey-patched, the requests should be sent by worker threads.
+        """
+        ConsumedServiceTicketFactory()
+        ConsumedServiceTicketFactory()
+        threads = []
+
+        def post(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return Mock(status_code=200)
+
+        # gevent is optional, so it is patched in for when it is not installed
+        with patch('mama_cas.models.gevent', Mock()):
+            with patch('mama_cas.models.is_gevent_patched', return_value=False):
+                with patch('requests.Session.post', side_effect=post):
+                    ServiceTicket.objects.request_sign_out(self.user)
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith('mama_cas-slo-') for name in threads))
+
+    @override_settings(MAMA_CAS_SLO_OUTBOX=True)
+    def test_request_sign_out_outbox(self):
+        """
+        When the outbox is enabled, calling the ``request_sign_out()``
+        manager method should queue a message for each consumed ticket
+        instead of sending requests.
+        """
+        ConsumedServiceTicketFactory()
+        ConsumedServiceTicketFactory(service='http://example.com')
+        with patch('requests.Session.post') as mock:
+            ServiceTicket.objects.request_sign_out(self.user)
+            self.assertEqual(mock.call_count, 0)
+        message = SignOutMessage.objects.get()
+        self.assertEqual(message.url, 'https://example.com/logout')
+        self.assertEqual(message.service, 'http://www.example.com/')
+
+
+class SignOutMessageTests(TestCase):
+    """
+    Test the ``SignOutMessage`` model and manager.
+    """
+    def setUp(self):
+        cache.clear()
+        self.message = SignOutMessage.objects.create(url='https://example.com/logout',
+                                                     service='http://www.example.com/',
+                                                     ticket='ST-0000000000-abc')
+
+    def test_deliver(self):
+        """
+        A delivered message should be removed from the outbox.
+        """
+        with patch('requests.Session.post') as mock:
+            mock.return_value.status_code = 200
+            self.assertEqual(SignOutMessage.objects.deliver(), 1)
+            self.assertEqual(mock.call_args[0][0], 'https://example.com/logout')
+        self.assertEqual(SignOutMessage.objects.count(), 0)
+
+    @override_settings(MAMA_CAS_SLO_RETRY_DELAY=10, MAMA_CAS_SLO_MAX_ATTEMPTS=3)
+    def test_deliver_retry(self):
+        """
+        A failed delivery should be retried with an exponential backoff,
+        and dead-lettered after the maximum number of attempts.
+        """
+        with patch('requests.Session.post') as mock:
+            mock.side_effect = requests.exceptions.ConnectionError('Refused')
+            for attempts, delay in [(1, 10), (2, 20)]:
+                SignOutMessage.objects.filter(pk=self.message.pk).update(next_attempt=now())
+                SignOutMessage.objects.deliver()
+                message = SignOutMessage.objects.get()
+                self.assertEqual(message.attempts, attempts)
+                self.assertFalse(message.dead)
+                self.assertAlmostEqual((message.next_attempt - now()).total_seconds(), delay, delta=2)
+                self.assertEqual(SignOutMessage.objects.deliver(), 0)
+
+            SignOutMessage.objects.filter(pk=self.message.pk).update(next_attempt=now())
+            SignOutMessage.objects.deliver()
+        message = SignOutMessage.objects.get()
+        self.assertTrue(message.dead)
+        self.assertEqual(message.last_error, 'Refused')
+        self.assertEqual(SignOutMessage.objects.get_queue_depth(), {'pending': 0, 'due': 0, 'dead': 1})
+
+        SignOutMessage.objects.requeue()
+        self.assertEqual(SignOutMessage.objects.get_queue_depth(), {'pending': 1, 'due': 1, 'dead': 0})
+
+    def test_claim(self):
+        """
+        A claimed message should not be claimed again until its lease
+        expires.
+        """
+        self.assertEqual(SignOutMessage.objects.claim(), [self.message])
+        self.assertEqual(SignOutMessage.objects.claim(), [])
+
+    def test_deliver_lease_expired(self):
+        """
+        A message whose lease expired while the batch was being sent,
+        and that was claimed by another worker, should not be sent.
+        """
+        message = SignOutMessage.objects.create(url='https://example.com/logout',
+                                                service='http://www.example.com/',
+                                                ticket='ST-0000000000-def')
+        claimed = []
+
+        def post(*args, **kwargs):
+            if not claimed:
+                SignOutMessage.objects.filter(pk=message.pk).update(next_attempt=now())
+                claimed.extend(SignOutMessage.objects.claim())
+            return Mock(status_code=200)
+
+        with patch('requests.Session.post', side_effect=post) as mock:
+            self.assertEqual(SignOutMessage.objects.deliver(), 2)
+            self.assertEqual(mock.call_count, 1)
+        self.assertEqual(claimed, [message])
+        self.assertEqual(SignOutMessage.objects.get(), message)
+
+    @override_settings(MAMA_CAS_HTTP_TIMEOUT=(10, 100))
+    def test_claim_lease(self):
+        """
+        Messages should be leased for at least as long as one request
+        can take.
+        """
+        SignOutMessage.objects.claim(lease=5)
+        message = SignOutMessage.objects.get()
+        self.assertAlmostEqual((message.next_attempt - now()).total_seconds(), 111, delta=2)
+
+    def test_claim_batch(self):
+        """
+        A batch of messages should be claimed with a fixed number of
+        queries.
+        """
+        SignOutMessage.objects.bulk_create([SignOutMessage(url='https://example.com/logout',
+                                                           service='http://www.example.com/',
+                                                           ticket='ST-0000000000-%d' % i) for i in range(10)])
+        with self.assertNumQueries(3):
+            self.assertEqual(len(SignOutMessage.objects.claim()), 11)
+
+    @modify_settings(MAMA_CAS_VALID_SERVICES={
+        'prepend': [{'SERVICE': r'https://batch\.example\.com', 'LOGOUT_ALLOW': True,
+                     'LOGOUT_URL': 'https://example.com/batch', 'LOGOUT_BATCH': True}]
+    })
+    def test_deliver_batch(self):
+        """
+        Messages for a service with ``LOGOUT_BATCH`` enabled should be
+        delivered in one request to the logout URL.
+        """
+        service_config.__dict__.pop('services', None)
+        self.addCleanup(service_config.__dict__.pop, 'services', None)
+        SignOutMessage.objects.bulk_create([SignOutMessage(url='https://example.com/batch',
+                                                           service='https://batch.example.com/',
+                                                           ticket='ST-0000000000-%d' % i) for i in range(3)])
+        with patch('requests.Session.post') as mock:
+            mock.return_value.status_code = 200
+            self.assertEqual(SignOutMessage.objects.deliver(), 4)
+            self.assertEqual(mock.call_count, 2)
+            self.assertEqual(mock.call_args_list[1][0][0], 'https://example.com/batch')
+            content = force_text(mock.call_args_list[1][1]['data']['logoutRequest'])
+            self.assertEqual(content.count('SessionIndex>'), 6)
+        self.assertEqual(SignOutMessage.objects.count(), 0)
+
 
 class ServiceTicketTests(TestCase):
     """
     Test the ``ServiceTicket`` model.
     """
+    def setUp(self):
+        cache.clear()
+
     def test_create_service_ticket(self):
         """
         A ``ServiceTicket`` ought to be created with an appropriate
@@ -335,7 +733,7 @@ class ServiceTicketTests(TestCase):
         cause any side-effects.
         """
         st = ServiceTicketFactory()
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.return_value.status_code = 200
             st.request_sign_out()
 
@@ -345,7 +743,7 @@ class ServiceTicketTests(TestCase):
         it should be handled.
         """
         st = ServiceTicketFactory()
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.side_effect = requests.exceptions.RequestException
             st.request_sign_out()
 
@@ -355,7 +753,7 @@ class ServiceTicketTests(TestCase):
         status code, the resulting exception should be handled.
         """
         st = ServiceTicketFactory()
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.return_value.status_code = 500
             st.request_sign_out()
 
@@ -365,7 +763,7 @@ class ServiceTicketTests(TestCase):
         request should not be sent.
         """
         st = ServiceTicketFactory(service='http://example.com')
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.return_value.status_code = 500
             st.request_sign_out()
             self.assertEqual(mock.call_count, 0)
@@ -399,7 +797,7 @@ class ProxyGrantingTicketManager(TestCase):
         A ``ProxyGrantingTicket`` ought to be created with the
         appropriate ticket strings.
         """
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value.status_code = 200
             pgt = ProxyGrantingTicket.objects.create_ticket('https://www.example.com', 'https://www.example.com/',
                                                             user=self.user, granted_by_pt=self.pt)
@@ -411,7 +809,7 @@ class ProxyGrantingTicketManager(TestCase):
         If callback validation fails, ``None`` should be returned
         instead of a ``ProxyGrantingTicket``.
         """
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.side_effect = requests.exceptions.ConnectionError
             pgt = ProxyGrantingTicket.objects.create_ticket('https://www.example.com', 'https://www.example.com/',
                                                             user=self.user, granted_by_pt=self.pt)
@@ -421,7 +819,7 @@ class ProxyGrantingTicketManager(TestCase):
         """
         If a valid PGTURL is provided, an exception should not be raised.
         """
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value.status_code = 200
             try:
                 ProxyGrantingTicket.objects.validate_callback('https://www.example.com', 'https://www.example.com/',
@@ -457,7 +855,7 @@ class ProxyGrantingTicketManager(TestCase):
         If the validation request encounters an SSL error, an
         InvalidProxyCallback should be raised.
         """
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.side_effect = requests.exceptions.SSLError
             with self.assertRaises(InvalidProxyCallback):
                 ProxyGrantingTicket.objects.validate_callback('http://www.example.com/', 'https://www.example.org/',
@@ -468,7 +866,7 @@ class ProxyGrantingTicketManager(TestCase):
         If the validation request encounters a connection error, an
         InvalidProxyCallback should be raised.
         """
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.side_effect = requests.exceptions.ConnectionError
             with self.assertRaises(InvalidProxyCallback):
                 ProxyGrantingTicket.objects.validate_callback('http://www.example.com/', 'https://www.example.org/',
@@ -479,7 +877,7 @@ class ProxyGrantingTicketManager(TestCase):
         If the validation request times out, an InvalidProxyCallback
         should be raised.
         """
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.side_effect = requests.exceptions.Timeout
             with self.assertRaises(InvalidProxyCallback):
                 ProxyGrantingTicket.objects.validate_callback('http://www.example.com/', 'https://www.example.org/',
@@ -490,7 +888,7 @@ class ProxyGrantingTicketManager(TestCase):
         If the validation request returns an invalid status code, an
         InvalidProxyCallback should be raised.
         """
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError
             with self.assertRaises(InvalidProxyCallback):
                 ProxyGrantingTicket.objects.validate_callback('http://www.example.com/', 'https://www.example.org/',
@@ -617,3 +1015,63 @@ class ManagementCommandTests(TestCase):
         self.assertEqual(ServiceTicket.objects.count(), 0)
         self.assertEqual(ProxyGrantingTicket.objects.count(), 0)
         self.assertEqual(ProxyTicket.objects.count(), 0)
+
+    def test_cleanupcas_management_command_batch_size(self):
+        """
+        The ``cleanupcas`` management command should delete all
+        invalid tickets when they span multiple batches.
+        """
+        for _ in range(5):
+            ConsumedServiceTicketFactory()
+        st = ConsumedServiceTicketFactory()
+        pgt = ExpiredProxyGrantingTicketFactory(granted_by_st=st)
+        ConsumedProxyTicketFactory(granted_by_pgt=pgt)
+        ServiceTicketFactory()  # Should not be deleted
+        out = StringIO()
+        management.call_command('cleanupcas', batch_size=2, stdout=out)
+
+        self.assertEqual(ServiceTicket.objects.count(), 1)
+        self.assertEqual(ProxyGrantingTicket.objects.count(), 0)
+        self.assertEqual(ProxyTicket.objects.count(), 0)
+        self.assertIn('Deleted 6 service tickets', out.getvalue())
+
+    def test_cleanupcas_management_command_dry_run(self):
+        """
+        When ``--dry-run`` is provided, the ``cleanupcas`` management
+        command should report invalid tickets without deleting them.
+        """
+        ConsumedServiceTicketFactory()
+        ExpiredServiceTicketFactory()
+        out = StringIO()
+        management.call_command('cleanupcas', dry_run=True, stdout=out)
+
+        self.assertEqual(ServiceTicket.objects.count(), 2)
+        self.assertIn('Would delete 2 service tickets', out.getvalue())
+        self.assertIn('Only top-level candidates are counted', out.getvalue())
+
+    def test_cleanupcas_management_command_max_runtime(self):
+        """
+        When the maximum runtime has elapsed, the ``cleanupcas``
+        management command should stop deleting tickets.
+        """
+        ConsumedServiceTicketFactory()
+        management.call_command('cleanupcas', max_runtime=0, stdout=StringIO())
+        self.assertEqual(ServiceTicket.objects.count(), 1)
+
+    def test_signoutcas_management_command(self):
+        """
+        The ``signoutcas`` management command should send the queued
+        single logout requests and report the queue depth.
+        """
+        cache.clear()
+        for service in ('http://www.example.com/', 'https://www.example.com/'):
+            SignOutMessage.objects.create(url='https://example.com/logout',
+                                          service=service, ticket='ST-0000000000-abc')
+        out = StringIO()
+        with patch('requests.Session.post') as mock:
+            mock.return_value.status_code = 200
+            management.call_command('signoutcas', once=True, stdout=out)
+            self.assertEqual(mock.call_count, 2)
+        self.assertEqual(SignOutMessage.objects.count(), 0)
+        self.assertIn('Attempted 2 single logout requests', out.getvalue())
+        self.assertIn('Pending: 0, due: 0, dead: 0', out.getvalue())
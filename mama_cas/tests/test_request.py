@@ -23,3 +23,13 @@ class SingleSignOutRequestTests(TestCase):
         session_index = parse(content).find('./SessionIndex')
         self.assertIsNotNone(session_index)
         self.assertEqual(session_index.text, self.st.ticket)
+
+    def test_sso_request_batch(self):
+        """
+        A ``SingleSignOutRequest`` for a list of tickets should contain
+        a session index for each ticket.
+        """
+        st2 = ServiceTicketFactory()
+        content = SingleSignOutRequest(context={'tickets': [self.st, st2]}).render_content()
+        session_indexes = parse(content).findall('./SessionIndex')
+        self.assertEqual([s.text for s in session_indexes], [self.st.ticket, st2.ticket])
@@ -2,19 +2,95 @@
 
 from __future__ import unicode_literals
 
+import json
+
 from django.test import TestCase
+from django.utils.encoding import force_text
 
 from .factories import ProxyGrantingTicketFactory
 from .factories import ProxyTicketFactory
 from .factories import ServiceTicketFactory
 from .factories import ConsumedServiceTicketFactory
 from .utils import parse
+from mama_cas.compat import etree
+from mama_cas.exceptions import InvalidRequest
 from mama_cas.exceptions import InvalidTicket
+from mama_cas.response import _failures
 from mama_cas.response import ValidationResponse
 from mama_cas.response import ProxyResponse
+from mama_cas.response import ValidationJsonResponse
+from mama_cas.response import ProxyJsonResponse
 from mama_cas.response import SamlValidationResponse
 
 
+def tostring(element):
+    """
+    Serialize an ElementTree element with an XML declaration. Python 3
+    omits the declaration for UTF-8 output while Python 2 writes it, so
+    it is added here for the output to match on every version.
+    """
+    # Python 2's ElementTree requires a native string encoding
+    return b"<?xml version='1.0' encoding='UTF-8'?>\n" + etree.tostring(element, encoding=str('utf-8'))
+
+
+def render_validation_etree(response, context):
+    """
+    Reference renderer building a ``ValidationResponse`` with
+    ElementTree, used to check the hand-serialized output.
+    """
+    ticket = context.get('ticket')
+    error = context.get('error')
+    attributes = context.get('attributes')
+    pgt = context.get('pgt')
+    proxies = context.get('proxies')
+
+    service_response = etree.Element(response.ns('serviceResponse'))
+    if ticket:
+        auth_success = etree.SubElement(service_response, response.ns('authenticationSuccess'))
+        user = etree.SubElement(auth_success, response.ns('user'))
+        user.text = ticket.user.get_username()
+        if attributes:
+            attribute_set = etree.SubElement(auth_success, response.ns('attributes'))
+            for name, value in attributes.items():
+                attr = etree.SubElement(attribute_set, response.ns(name))
+                attr.text = force_text(value)
+        if pgt:
+            proxy_granting_ticket = etree.SubElement(auth_success, response.ns('proxyGrantingTicket'))
+            proxy_granting_ticket.text = pgt.iou
+        if proxies:
+            proxy_list = etree.SubElement(auth_success, response.ns('proxies'))
+            for p in proxies:
+                proxy = etree.SubElement(proxy_list, response.ns('proxy'))
+                proxy.text = p
+    elif error:
+        auth_failure = etree.SubElement(service_response, response.ns('authenticationFailure'))
+        auth_failure.set('code', error.code)
+        auth_failure.text = force_text(error)
+
+    return tostring(service_response)
+
+
+def render_proxy_etree(response, context):
+    """
+    Reference renderer building a ``ProxyResponse`` with
+    ElementTree, used to check the hand-serialized output.
+    """
+    ticket = context.get('ticket')
+    error = context.get('error')
+
+    service_response = etree.Element(response.ns('serviceResponse'))
+    if ticket:
+        proxy_success = etree.SubElement(service_response, response.ns('proxySuccess'))
+        proxy_ticket = etree.SubElement(proxy_success, response.ns('proxyTicket'))
+        proxy_ticket.text = ticket.ticket
+    elif error:
+        proxy_failure = etree.SubElement(service_response, response.ns('proxyFailure'))
+        proxy_failure.set('code', error.code)
+        proxy_failure.text = force_text(error)
+
+    return tostring(service_response)
+
+
 class ValidationResponseTests(TestCase):
     def setUp(self):
         self.st = ServiceTicketFactory()
@@ -129,6 +205,38 @@ class ValidationResponseTests(TestCase):
         self.assertEqual(attributes[0].tag, 'unicode')
         self.assertEqual(attributes[0].text, 'тнє мαмαѕ & тнє ραραѕ')
 
+    def test_validation_response_etree(self):
+        """
+        A ``ValidationResponse`` should serialize the same content as
+        when built with ElementTree, escaping special characters.
+        """
+        attrs = {'givenName': 'Ellen & <Co>', 'email': '', 'age': 32,
+                 'unicode': 'ä"\'\n'}
+        error = InvalidTicket('Ticket <"ST-1"> & more')
+        contexts = [{'ticket': self.st, 'error': None},
+                    {'ticket': self.st, 'error': None, 'attributes': attrs,
+                     'pgt': self.pgt, 'proxies': ['https://proxy2/pgtUrl?a=1&b=2']},
+                    {'ticket': None, 'error': error},
+                    {'ticket': None, 'error': None}]
+        for context in contexts:
+            resp = ValidationResponse(context=context, content_type='text/xml')
+            self.assertEqual(resp.content, render_validation_etree(resp, context))
+
+    def test_validation_response_cached_failure(self):
+        """
+        Failures with the same error code should reuse the serialized
+        envelope, with only the escaped message differing.
+        """
+        for error in [InvalidTicket('Ticket ST-1 not found'), InvalidTicket('Ticket <ST-2> & more'),
+                      InvalidTicket(''), InvalidRequest('Missing parameters')]:
+            context = {'ticket': None, 'error': error}
+            resp = ValidationResponse(context=context, content_type='text/xml')
+            self.assertEqual(resp.content, render_validation_etree(resp, context))
+            failure = parse(resp.content).find('./authenticationFailure')
+            self.assertEqual(failure.get('code'), error.code)
+            self.assertEqual(failure.text or '', force_text(error))
+        self.assertIn((ValidationResponse, 'INVALID_TICKET'), _failures)
+
 
 class ProxyResponseTests(TestCase):
     def setUp(self):
@@ -169,6 +277,74 @@ class ProxyResponseTests(TestCase):
         self.assertEqual(failure.get('code'), 'INVALID_TICKET')
         self.assertEqual(failure.text, 'Testing Error')
 
+    def test_proxy_response_etree(self):
+        """
+        A ``ProxyResponse`` should serialize the same content as when
+        built with ElementTree.
+        """
+        error = InvalidTicket('Ticket <"PGT-1"> & more')
+        for context in [{'ticket': self.pt, 'error': None},
+                        {'ticket': None, 'error': error}]:
+            resp = ProxyResponse(context=context, content_type='text/xml')
+            self.assertEqual(resp.content, render_proxy_etree(resp, context))
+
+
+class ValidationJsonResponseTests(TestCase):
+    def setUp(self):
+        self.st = ServiceTicketFactory()
+        self.pgt = ProxyGrantingTicketFactory()
+
+    def test_validation_json_response_ticket(self):
+        """
+        When given a ticket, a ``ValidationJsonResponse`` should return
+        an authentication success with the user, attributes,
+        proxy-granting ticket and proxies.
+        """
+        attrs = {'givenName': 'Ellen', 'unicode': 'тнє мαмαѕ', 'boolean': True}
+        proxy_list = ['https://proxy2/pgtUrl', 'https://proxy1/pgtUrl']
+        resp = ValidationJsonResponse(context={'ticket': self.st, 'error': None,
+                                               'attributes': attrs, 'pgt': self.pgt,
+                                               'proxies': proxy_list},
+                                      content_type='application/json')
+        self.assertEqual(resp.get('Content-Type'), 'application/json')
+        success = json.loads(resp.content.decode('utf-8'))['serviceResponse']['authenticationSuccess']
+        self.assertEqual(success['user'], 'ellen')
+        self.assertEqual(success['attributes'], attrs)
+        self.assertEqual(success['proxyGrantingTicket'], self.pgt.iou)
+        self.assertEqual(success['proxies'], proxy_list)
+
+    def test_validation_json_response_error(self):
+        """
+        When given an error, a ``ValidationJsonResponse`` should return
+        an authentication failure with the error code and description.
+        """
+        error = InvalidTicket('Testing Error')
+        resp = ValidationJsonResponse(context={'ticket': None, 'error': error},
+                                      content_type='application/json')
+        failure = json.loads(resp.content.decode('utf-8'))['serviceResponse']['authenticationFailure']
+        self.assertEqual(failure, {'code': 'INVALID_TICKET', 'description': 'Testing Error'})
+
+
+class ProxyJsonResponseTests(TestCase):
+    def setUp(self):
+        self.pt = ProxyTicketFactory()
+
+    def test_proxy_json_response(self):
+        """
+        A ``ProxyJsonResponse`` should return a proxy request success
+        with the proxy ticket, or a failure with the error code.
+        """
+        resp = ProxyJsonResponse(context={'ticket': self.pt, 'error': None},
+                                 content_type='application/json')
+        content = json.loads(resp.content.decode('utf-8'))
+        self.assertEqual(content, {'serviceResponse': {'proxySuccess': {'proxyTicket': self.pt.ticket}}})
+
+        error = InvalidTicket('Testing Error')
+        resp = ProxyJsonResponse(context={'ticket': None, 'error': error},
+                                 content_type='application/json')
+        failure = json.loads(resp.content.decode('utf-8'))['serviceResponse']['proxyFailure']
+        self.assertEqual(failure, {'code': 'INVALID_TICKET', 'description': 'Testing Error'})
+
 
 class SamlValidationResponseTests(TestCase):
     def setUp(self):
@@ -1,18 +1,27 @@
 # -*- coding: utf-8 -*-
 
+from mock import patch
+
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.test import TestCase
+from django.test import TransactionTestCase
 from django.test.utils import modify_settings
 from django.test.utils import override_settings
 
+from mama_cas.models import Service
 from mama_cas.utils import services as service_config
 from mama_cas.utils import add_query_params
 from mama_cas.utils import get_config
+from mama_cas.utils import get_service_policy
+from mama_cas.utils import LRUCache
 from mama_cas.utils import clean_service_url
 from mama_cas.utils import is_scheme_https
 from mama_cas.utils import is_valid_proxy_callback
 from mama_cas.utils import is_valid_service
 from mama_cas.utils import match_service
+from mama_cas.utils import parse_url
 from mama_cas.utils import redirect
 from mama_cas.utils import to_bool
 
@@ -80,7 +89,20 @@ class UtilsTests(TestCase):
         self.assertFalse(match_service('https://www.example.com:80/', 'https://www.example.com/'))
         self.assertFalse(match_service('https://www.example.com', 'https://www.example.com/'))
 
-    @override_settings(MAMA_CAS_VALID_SERVICES=('http://.*\.example\.com',))
+    @override_settings(MAMA_CAS_VALID_SERVICES=(r'http://.*\.example\.com',))
+    def test_parse_url(self):
+        """
+        When called with a URL, ``parse_url()`` should return its parsed
+        components, parsing each URL only once.
+        """
+        url = parse_url('https://www.example.com:9443/test?test3=blue#green')
+        self.assertEqual(url.scheme, 'https')
+        self.assertEqual(url.netloc, 'www.example.com:9443')
+        self.assertEqual(url.path, '/test')
+        self.assertEqual(url.clean, 'https://www.example.com:9443/test')
+        self.assertIs(parse_url('https://www.example.com:9443/test?test3=blue#green'), url)
+        self.assertIs(parse_url(url), url)
+
     def test_is_valid_service_tuple(self):
         """
         When valid services are configured, ``is_valid_service()``
@@ -125,7 +147,7 @@ class UtilsTests(TestCase):
             is_valid_service('http://www.example.com')
 
     @modify_settings(MAMA_CAS_VALID_SERVICES={
-        'append': [{'SERVICE': 'http://example\.com/proxy', 'PROXY_ALLOW': False}]
+        'append': [{'SERVICE': r'http://example\.com/proxy', 'PROXY_ALLOW': False}]
     })
     def test_get_config(self):
         """
@@ -137,6 +159,46 @@ class UtilsTests(TestCase):
                          ['mama_cas.callbacks.user_name_attributes'])
         self.assertEqual(get_config('http://example.org', 'CALLBACKS'), [])
 
+    def test_get_service_policy(self):
+        """
+        A service policy should resolve each setting for the matching
+        service.
+        """
+        policy = get_service_policy('http://www.example.com')
+        self.assertTrue(policy.valid)
+        self.assertTrue(policy.proxy_allow)
+        self.assertTrue(policy.logout_allow)
+        self.assertEqual(policy.logout_url, 'https://example.com/logout')
+        self.assertEqual(policy.callbacks, ('mama_cas.callbacks.user_name_attributes',))
+        self.assertFalse(get_service_policy('http://example.org').valid)
+        with self.assertRaises(AttributeError):
+            policy.valid = False
+
+    def test_get_service_policy_cached(self):
+        """
+        A service URL should only be matched against the configured
+        services once.
+        """
+        with patch('mama_cas.matcher.ServiceMatcher.match', return_value=0) as mock:
+            policy = get_service_policy('http://cached.example.com')
+            self.assertIs(get_service_policy('http://cached.example.com'), policy)
+            self.assertTrue(get_config('http://cached.example.com', 'PROXY_ALLOW'))
+            self.assertEqual(mock.call_count, 1)
+
+    def test_lru_cache(self):
+        """
+        The least recently used item should be discarded when the
+        cache is full.
+        """
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(len(lru), 2)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+
     def test_is_valid_proxy_callback(self):
         """
         When a valid pgturl is provided, `is_valid_proxy_callback()`
@@ -184,3 +246,92 @@ class UtilsTests(TestCase):
         self.assertFalse(to_bool(None))
         self.assertFalse(to_bool(''))
         self.assertFalse(to_bool('   '))
+
+
+@override_settings(MAMA_CAS_SERVICE_REGISTRY=True)
+class ServiceRegistryTests(TransactionTestCase):
+    """
+    Test the database-backed service registry. Services are reloaded
+    when changes are committed, so these tests run outside a
+    transaction.
+    """
+    def setUp(self):
+        cache.clear()
+        service_config.__dict__.pop('services', None)
+
+    def tearDown(self):
+        service_config.__dict__.pop('services', None)
+
+    def test_registry_service(self):
+        """
+        Services stored in the database should be matched after the
+        services configured in settings.
+        """
+        Service.objects.create(name='Org', pattern=r'https://www\.example\.org',
+                               proxy_allow=True, callbacks='mama_cas.callbacks.user_name_attributes\n')
+        self.assertTrue(is_valid_service('https://www.example.org/'))
+        self.assertTrue(get_config('https://www.example.org/', 'PROXY_ALLOW'))
+        self.assertEqual(get_config('https://www.example.org/', 'CALLBACKS'),
+                         ['mama_cas.callbacks.user_name_attributes'])
+        self.assertFalse(is_valid_service('https://www.example.net/'))
+
+    def test_registry_disabled_service(self):
+        """
+        Disabled services should not be matched.
+        """
+        Service.objects.create(name='Org', pattern=r'https://www\.example\.org', enabled=False)
+        self.assertFalse(is_valid_service('https://www.example.org/'))
+
+    def test_registry_invalid_service(self):
+        """
+        Services with an invalid pattern or callback should be skipped
+        rather than failing validation of every service.
+        """
+        Service.objects.create(name='Bad', pattern='https://(www')
+        Service.objects.create(name='Net', pattern=r'https://www\.example\.net',
+                               callbacks='mama_cas.callbacks.invalid')
+        Service.objects.create(name='Org', pattern=r'https://www\.example\.org')
+        self.assertTrue(is_valid_service('https://www.example.org/'))
+        self.assertFalse(is_valid_service('https://www.example.net/'))
+
+    def test_registry_snapshot(self):
+        """
+        Once loaded, services should be matched without querying the
+        database.
+        """
+        is_valid_service('https://www.example.org/')
+        with self.assertNumQueries(0):
+            is_valid_service('https://www.example.org/')
+            is_valid_service('https://www.example.net/')
+
+    def test_registry_reload(self):
+        """
+        Changing a service should reload the services, and other
+        processes should reload when the registry version changes.
+        """
+        service = Service.objects.create(name='Org', pattern=r'https://www\.example\.org')
+        self.assertTrue(is_valid_service('https://www.example.org/'))
+        service.delete()
+        self.assertFalse(is_valid_service('https://www.example.org/'))
+
+        # Add a service without sending signals, as if another process
+        # changed it
+        Service.objects.bulk_create([Service(name='Net', pattern=r'https://www\.example\.net')])
+        self.assertFalse(is_valid_service('https://www.example.net/'))
+        cache.set(service_config.REGISTRY_VERSION_KEY, 'changed')
+        service_config.registry_checked = 0
+        self.assertTrue(is_valid_service('https://www.example.net/'))
+
+    def test_registry_reload_on_commit(self):
+        """
+        The services should not be reloaded until a change to them has
+        been committed.
+        """
+        is_valid_service('https://www.example.org/')
+        version = cache.get(service_config.REGISTRY_VERSION_KEY)
+        with transaction.atomic():
+            Service.objects.create(name='Org', pattern=r'https://www\.example\.org')
+            self.assertEqual(cache.get(service_config.REGISTRY_VERSION_KEY), version)
+            self.assertIn('services', service_config.__dict__)
+        self.assertNotEqual(cache.get(service_config.REGISTRY_VERSION_KEY), version)
+        self.assertTrue(is_valid_service('https://www.example.org/'))
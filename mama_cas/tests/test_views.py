@@ -1,7 +1,10 @@
 from __future__ import unicode_literals
 
+import json
+
 from mock import patch
 
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import RequestFactory
@@ -223,6 +226,7 @@ class LogoutViewTests(TestCase):
     url = 'http://www.example.com'
 
     def setUp(self):
+        cache.clear()
         self.user = UserFactory()
 
     def test_logout_view(self):
@@ -268,7 +272,7 @@ class LogoutViewTests(TestCase):
         ConsumedServiceTicketFactory()
         ConsumedServiceTicketFactory()
         self.client.post(reverse('cas_login'), self.user_info)
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             self.client.get(reverse('cas_logout'))
             self.assertEqual(mock.call_count, 2)
 
@@ -394,7 +398,7 @@ class ServiceValidateViewTests(TestCase):
         request = self.rf.get(reverse('cas_service_validate'), {'service': self.url,
                                                                 'ticket': self.st.ticket,
                                                                 'pgtUrl': 'https://www.example.com'})
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value.status_code = 200
             response = ServiceValidateView.as_view()(request)
         self.assertContains(response, 'authenticationSuccess')
@@ -433,6 +437,19 @@ class ServiceValidateViewTests(TestCase):
         self.assertContains(response, 'attributes')
         self.assertContains(response, '<cas:username>ellen</cas:username>')
 
+    def test_service_validate_view_json(self):
+        """
+        When ``format`` is ``JSON``, the validation response should be
+        rendered as JSON.
+        """
+        request = self.rf.get(reverse('cas_p3_service_validate'), {'service': self.url,
+                                                                   'ticket': self.st.ticket,
+                                                                   'format': 'JSON'})
+        response = ServiceValidateView.as_view()(request)
+        self.assertEqual(response.get('Content-Type'), 'application/json')
+        success = json.loads(response.content.decode('utf-8'))['serviceResponse']['authenticationSuccess']
+        self.assertEqual(success['user'], 'ellen')
+
 
 class ProxyValidateViewTests(TestCase):
     url = 'http://www.example.com/'
@@ -522,7 +539,7 @@ class ProxyValidateViewTests(TestCase):
         request = self.rf.get(reverse('cas_proxy_validate'), {'service': self.url,
                                                               'ticket': self.pt.ticket,
                                                               'pgtUrl': 'https://ww2.example.com'})
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value.status_code = 200
             response = ProxyValidateView.as_view()(request)
         self.assertContains(response, 'authenticationSuccess')
@@ -596,6 +613,16 @@ class ProxyViewTests(TestCase):
         response = ProxyView.as_view()(request)
         self.assertContains(response, 'proxyTicket')
 
+    def test_proxy_view_json(self):
+        """
+        When ``format`` is ``JSON``, a proxy request failure should be
+        rendered as JSON.
+        """
+        request = self.rf.get(reverse('cas_proxy'), {'format': 'JSON'})
+        response = ProxyView.as_view()(request)
+        self.assertEqual(response.get('Content-Type'), 'application/json')
+        self.assertContains(response, '"proxyFailure":{"code":"INVALID_REQUEST"')
+
     def test_proxy_view_invalid_service_url(self):
         """
         When called with an invalid service identifier, a proxy
@@ -1,8 +1,14 @@
+from collections import OrderedDict
 import logging
 import re
+import threading
+import time
+import uuid
 import warnings
 
+from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.core.exceptions import PermissionDenied
 from django.core import urlresolvers
@@ -15,72 +21,285 @@ from .compat import parse_qsl
 from .compat import urlencode
 from .compat import urlparse
 from .compat import urlunparse
+from .matcher import ServiceMatcher
 
 
 logger = logging.getLogger(__name__)
 
 
+class LRUCache(object):
+    """
+    A thread-safe mapping holding at most ``maxsize`` items, discarding
+    the least recently used item when full.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ServicePolicy(object):
+    """
+    The resolved configuration for a service URL. Policies are immutable,
+    so a single policy is shared by every request for the same URL.
+    """
+    __slots__ = ('config', 'valid', 'proxy_allow', 'proxy_pattern',
+                 'callbacks', 'attributes', 'logout_allow', 'logout_url', 'logout_batch')
+
+    def __init__(self, config, valid):
+        object.__setattr__(self, 'config', config)
+        object.__setattr__(self, 'valid', valid)
+        object.__setattr__(self, 'proxy_allow', self.get('PROXY_ALLOW'))
+        object.__setattr__(self, 'proxy_pattern', config.get('PROXY_PATTERN'))
+        object.__setattr__(self, 'callbacks', tuple(self.get('CALLBACKS')))
+        attributes = self.get('ATTRIBUTES')
+        object.__setattr__(self, 'attributes', frozenset(attributes) if attributes is not None else None)
+        object.__setattr__(self, 'logout_allow', self.get('LOGOUT_ALLOW'))
+        object.__setattr__(self, 'logout_url', self.get('LOGOUT_URL'))
+        object.__setattr__(self, 'logout_batch', self.get('LOGOUT_BATCH'))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def get(self, setting):
+        """Return the configured value or default for a setting."""
+        try:
+            return self.config[setting]
+        except KeyError:
+            return getattr(ServiceConfig, setting + '_DEFAULT')
+
+
 class ServiceConfig(object):
     PROXY_ALLOW_DEFAULT = False
     CALLBACKS_DEFAULT = []
+    ATTRIBUTES_DEFAULT = None
     LOGOUT_ALLOW_DEFAULT = False
     LOGOUT_URL_DEFAULT = None
+    LOGOUT_BATCH_DEFAULT = False
+    REGISTRY_VERSION_KEY = 'mama_cas:services:version'
+
+    def __init__(self):
+        self.registry_version = None
+        self.registry_checked = 0
+
+    def get_registry_services(self):
+        """
+        Return the enabled services stored in the database, if the
+        service registry is enabled.
+        """
+        if not getattr(settings, 'MAMA_CAS_SERVICE_REGISTRY', False):
+            return []
+        self.registry_version = cache.get(self.REGISTRY_VERSION_KEY)
+        self.registry_checked = time.time()
+        Service = apps.get_model('mama_cas', 'Service')
+        return [service.get_config() for service in Service.objects.filter(enabled=True)]
+
+    def load_service(self, service):
+        """
+        Return a service configuration in the format of
+        ``MAMA_CAS_VALID_SERVICES`` with its patterns compiled and the
+        defaults set.
+        """
+        if isinstance(service, six.string_types):
+            warnings.warn(
+                'Service URL configuration is changing. Check the documentation '
+                'for the MAMA_CAS_VALID_SERVICES setting.', DeprecationWarning)
+            match = re.compile(service)
+            service = {'SERVICE': service}
+        else:
+            service = service.copy()
+            try:
+                match = re.compile(service['SERVICE'])
+            except KeyError:
+                raise ImproperlyConfigured(
+                    'Missing SERVICE key for service configuration. '
+                    'Check your MAMA_CAS_VALID_SERVICES setting.')
+
+        service['MATCH'] = match
+        # TODO For transitional backwards compatibility, this defaults to True.
+        service.setdefault('PROXY_ALLOW', True)
+        service.setdefault('CALLBACKS', self.CALLBACKS_DEFAULT)
+        service.setdefault('LOGOUT_ALLOW', self.LOGOUT_ALLOW_DEFAULT)
+        service.setdefault('LOGOUT_URL', self.LOGOUT_URL_DEFAULT)
+        try:
+            service['PROXY_PATTERN'] = re.compile(service['PROXY_PATTERN'])
+        except KeyError:
+            pass
+        return service
 
     @cached_property
     def services(self):
-        services = []
-
-        for service in getattr(settings, 'MAMA_CAS_VALID_SERVICES', []):
-            if isinstance(service, six.string_types):
-                warnings.warn(
-                    'Service URL configuration is changing. Check the documentation '
-                    'for the MAMA_CAS_VALID_SERVICES setting.', DeprecationWarning)
-                match = re.compile(service)
-                service = {'SERVICE': service}
-            else:
-                service = service.copy()
-                try:
-                    match = re.compile(service['SERVICE'])
-                except KeyError:
-                    raise ImproperlyConfigured(
-                        'Missing SERVICE key for service configuration. '
-                        'Check your MAMA_CAS_VALID_SERVICES setting.')
-
-            service['MATCH'] = match
-            # TODO For transitional backwards compatibility, this defaults to True.
-            service.setdefault('PROXY_ALLOW', True)
-            service.setdefault('CALLBACKS', self.CALLBACKS_DEFAULT)
-            service.setdefault('LOGOUT_ALLOW', self.LOGOUT_ALLOW_DEFAULT)
-            service.setdefault('LOGOUT_URL', self.LOGOUT_URL_DEFAULT)
+        from mama_cas.callbacks import callback_registry
+
+        services = [self.load_service(service)
+                    for service in getattr(settings, 'MAMA_CAS_VALID_SERVICES', [])]
+
+        # Services stored in the database are not validated when they
+        # are saved without cleaning, so an invalid service is skipped
+        # rather than failing every request
+        for service in self.get_registry_services():
             try:
-                service['PROXY_PATTERN'] = re.compile(service['PROXY_PATTERN'])
-            except KeyError:
-                pass
+                service = self.load_service(service)
+                for path in service['CALLBACKS']:
+                    callback_registry.resolve(path)
+            except (re.error, ImproperlyConfigured) as e:
+                logger.error("Skipping invalid registry service %s: %s" % (service['SERVICE'], e))
+                continue
             services.append(service)
 
         return services
 
+    def reload(self):
+        """
+        Discard the loaded services, and signal other processes to do the
+        same by changing the service registry version.
+        """
+        cache.set(self.REGISTRY_VERSION_KEY, uuid.uuid4().hex, None)
+        self.__dict__.pop('services', None)
+
+    def check_registry(self):
+        """
+        Discard the loaded services if the service registry version has
+        changed. The version is checked at most once every
+        ``MAMA_CAS_SERVICE_REGISTRY_POLL`` seconds.
+        """
+        if not getattr(settings, 'MAMA_CAS_SERVICE_REGISTRY', False):
+            return
+        current = time.time()
+        if current < self.registry_checked + getattr(settings, 'MAMA_CAS_SERVICE_REGISTRY_POLL', 5):
+            return
+        self.registry_checked = current
+        if cache.get(self.REGISTRY_VERSION_KEY) != self.registry_version:
+            self.__dict__.pop('services', None)
+
+    def get_matcher(self):
+        """
+        Return the configured services along with a ``ServiceMatcher``
+        and policy cache for them, rebuilding both when the services are
+        reloaded.
+        """
+        self.check_registry()
+        services = self.services
+        try:
+            matched, matcher, policies = self._matcher
+        except AttributeError:
+            matched = None
+        if matched is not services:
+            matcher = ServiceMatcher(service['MATCH'] for service in services)
+            policies = LRUCache(getattr(settings, 'MAMA_CAS_SERVICE_POLICY_CACHE_SIZE', 1000))
+            self._matcher = (services, matcher, policies)
+        return services, matcher, policies
+
     def get_service(self, s):
-        for service in self.services:
-            if service['MATCH'].match(s):
-                return service
-        return {}
+        services, matcher, _ = self.get_matcher()
+        index = matcher.match(s)
+        if index is None:
+            return {}
+        return services[index]
+
+    def get_policy(self, s):
+        """
+        Return the ``ServicePolicy`` for a service URL, matching it
+        against the configured services only once while it remains in
+        the policy cache.
+        """
+        services, matcher, policies = self.get_matcher()
+        policy = policies.get(s)
+        if policy is None:
+            index = matcher.match(s)
+            if index is None:
+                policy = ServicePolicy({}, not services)
+            else:
+                policy = ServicePolicy(services[index], True)
+            policies.set(s, policy)
+        return policy
 
     def is_valid(self, s):
-        if not self.services:
-            return True
-        return bool(self.get_service(s))
+        return self.get_policy(s).valid
 
 
 services = ServiceConfig()
 
 
+def get_service_policy(service):
+    """Return the resolved ``ServicePolicy`` for a given service."""
+    return services.get_policy(service)
+
+
 def get_config(service, setting):
     """Access the configuration for a given service and setting."""
-    try:
-        return services.get_service(service)[setting]
-    except KeyError:
-        return getattr(services, setting + '_DEFAULT')
+    return get_service_policy(service).get(setting)
+
+
+class ServiceURL(object):
+    """
+    A parsed URL. The components and cleaned form of a URL are computed
+    once, so a URL can be checked and compared repeatedly while handling
+    a request without being parsed again.
+    """
+    __slots__ = ('url', 'parts', 'clean')
+
+    def __init__(self, url):
+        self.url = url
+        self.parts = urlparse(url)
+        self.clean = urlunparse((self.parts.scheme, self.parts.netloc,
+                                 self.parts.path, '', '', ''))
+
+    def __str__(self):
+        return self.url
+
+    @property
+    def scheme(self):
+        return self.parts.scheme
+
+    @property
+    def netloc(self):
+        return self.parts.netloc
+
+    @property
+    def path(self):
+        return self.parts.path
+
+    @property
+    def key(self):
+        """The components compared when matching service URLs."""
+        return (self.parts.scheme, self.parts.netloc, self.parts.path)
+
+
+_urls = LRUCache(1000)
+
+
+def parse_url(url):
+    """
+    Return a ``ServiceURL`` for the parameter URL, reusing the result of
+    previous calls for the same URL.
+    """
+    if isinstance(url, ServiceURL):
+        return url
+    parsed = _urls.get(url)
+    if parsed is None:
+        parsed = ServiceURL(url)
+        _urls.set(url, parsed)
+    return parsed
 
 
 def add_query_params(url, params):
@@ -94,7 +313,7 @@ def add_query_params(url, params):
         return force_bytes(s, settings.DEFAULT_CHARSET)
     params = dict([(encode(k), encode(v)) for k, v in params.items() if v])
 
-    parts = list(urlparse(url))
+    parts = list(parse_url(url).parts)
     query = dict(parse_qsl(parts[4]))
     query.update(params)
     parts[4] = urlencode(query)
@@ -106,7 +325,7 @@ def is_scheme_https(url):
     Test the scheme of the parameter URL to see if it is HTTPS. If
     it is HTTPS return ``True``, otherwise return ``False``.
     """
-    return 'https' == urlparse(url).scheme
+    return 'https' == parse_url(url).scheme
 
 
 def clean_service_url(url):
@@ -114,8 +333,7 @@ def clean_service_url(url):
     Return only the scheme, hostname (with optional port) and path
     components of the parameter URL.
     """
-    parts = urlparse(url)
-    return urlunparse((parts.scheme, parts.netloc, parts.path, '', '', ''))
+    return parse_url(url).clean
 
 
 def match_service(service1, service2):
@@ -123,9 +341,8 @@ def match_service(service1, service2):
     Compare two service URLs. Return ``True`` if the scheme, hostname,
     optional port and path match.
     """
-    s1, s2 = urlparse(service1), urlparse(service2)
     try:
-        return (s1.scheme, s1.netloc, s1.path) == (s2.scheme, s2.netloc, s2.path)
+        return parse_url(service1).key == parse_url(service2).key
     except ValueError:
         return False
 
@@ -145,13 +362,13 @@ def is_valid_proxy_callback(service, pgturl):
     Check the provided proxy callback against the configured allowable
     callback pattern. If no pattern is configured, return `True`.
     """
-    try:
-        return get_config(service, 'PROXY_PATTERN').match(pgturl)
-    except AttributeError:
-        # TODO For transitional backwards compatibility, check against valid services
-        if is_valid_service(pgturl):
-            return True
-        return False
+    proxy_pattern = get_service_policy(service).proxy_pattern
+    if proxy_pattern is not None:
+        return proxy_pattern.match(pgturl)
+    # TODO For transitional backwards compatibility, check against valid services
+    if is_valid_service(pgturl):
+        return True
+    return False
 
 
 def redirect(to, *args, **kwargs):
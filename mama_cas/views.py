@@ -33,6 +33,8 @@ from mama_cas.models import ProxyTicket
 from mama_cas.models import ServiceTicket
 from mama_cas.response import ValidationResponse
 from mama_cas.response import ProxyResponse
+from mama_cas.response import ValidationJsonResponse
+from mama_cas.response import ProxyJsonResponse
 from mama_cas.response import SamlValidationResponse
 from mama_cas.utils import add_query_params
 from mama_cas.utils import clean_service_url
@@ -257,8 +259,12 @@ class ServiceValidateView(NeverCacheMixin, CasResponseMixin, View):
     If ``pgtUrl`` is specified, the response will include a
     ``ProxyGrantingTicket`` if the proxy callback URL has a valid SSL
     certificate and responds with a successful HTTP status code.
+
+    If ``format`` is ``JSON``, the response is rendered as JSON
+    instead of XML. [CAS 3.0]
     """
     response_class = ValidationResponse
+    json_response_class = ValidationJsonResponse
 
     def get_context_data(self, **kwargs):
         service = self.request.GET.get('service')
@@ -289,8 +295,12 @@ class ProxyValidateView(NeverCacheMixin, CasResponseMixin, View):
     If ``pgtUrl`` is specified, the response will include a
     ``ProxyGrantingTicket`` if the proxy callback URL has a valid SSL
     certificate and responds with a successful HTTP status code.
+
+    If ``format`` is ``JSON``, the response is rendered as JSON
+    instead of XML. [CAS 3.0]
     """
     response_class = ValidationResponse
+    json_response_class = ValidationJsonResponse
 
     def get_context_data(self, **kwargs):
         service = self.request.GET.get('service')
@@ -320,8 +330,12 @@ class ProxyView(NeverCacheMixin, CasResponseMixin, View):
     ``ProxyGrantingTicket`` validation success or failure. If
     validation succeeds, a ``ProxyTicket`` will be created and included
     in the response.
+
+    If ``format`` is ``JSON``, the response is rendered as JSON
+    instead of XML. [CAS 3.0]
     """
     response_class = ProxyResponse
+    json_response_class = ProxyJsonResponse
 
     def get_context_data(self, **kwargs):
         pgt = self.request.GET.get('pgt')